@@ -0,0 +1,240 @@
+'''
+    Benchmarks for every stage of the trajectory pipeline.
+
+    Each case is a synthetic path (a zigzag of waypoint_count waypoints whose heading swings by up to curvature
+    radians) with one of a few TrajectoryConfigs. Every stage is timed repeat times and the results are written as
+    JSON, e.g.
+
+        python benchmark.py --output master.json
+        python benchmark.py --output branch.json --compare master.json
+'''
+
+import argparse
+import json
+import math
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from structs.trajectory_config import TrajectoryConfig, ProfileType
+from structs.waypoint import Waypoint
+from spline_generator import SplineGenerator, FitType
+from spline_utils import SplineUtils
+from trajector_planner import TrajectoryPlanner
+from trajectory_generator import TrajectoryGenerator, BatchTrajectoryGenerator
+from tank_modifier import TankModifier
+from swerve_modifier import SwerveModifier
+from encoder_follower import EncoderFollower
+from distance_follower import DistanceFollower
+from pathfindr import Pathfinder
+from follower_simulator import FollowerSimulator, DrivetrainModel, gain_grid
+
+PATHS = {
+    'short_gentle': (3, 0.2),
+    'short_tight': (3, 0.7),
+    'long_gentle': (20, 0.2),
+    'long_tight': (20, 0.7),
+}
+
+CONFIGS = {
+    'default': {'dt': 0.01, 'sample_count': 10000, 'max_j': 60.0},
+    'fine_dt': {'dt': 0.001, 'sample_count': 10000, 'max_j': 60.0},
+    'high_samples': {'dt': 0.01, 'sample_count': 100000, 'max_j': 60.0},
+    'low_jerk': {'dt': 0.01, 'sample_count': 10000, 'max_j': 2.0},
+    'adaptive': {'dt': 0.01, 'sample_count': 10000, 'max_j': 60.0, 'arc_length_tolerance': 1e-6},
+    'curvature_limited': {'dt': 0.01, 'sample_count': 10000, 'max_j': 60.0, 'max_lateral_a': 3.0,
+                          'wheelbase_width': 0.6},
+    's_curve': {'dt': 0.01, 'sample_count': 10000, 'max_j': 60.0, 'profile_type': ProfileType.S_CURVE},
+}
+
+QUICK_PATHS = ('short_gentle', 'long_tight')
+QUICK_CONFIGS = ('default',)
+
+
+def make_waypoints(waypoint_count, curvature):
+    # Deterministic zigzag: 1.5m apart, alternating sideways offsets and headings
+    return [Waypoint(1.5 * i, 0.5 * curvature * (i % 2), curvature * (1 if i % 2 else -1) * (i > 0))
+            for i in range(waypoint_count)]
+
+
+def make_config(dt, sample_count, max_j, arc_length_tolerance=0.0, max_lateral_a=0.0, wheelbase_width=0.0,
+                profile_type=ProfileType.FILTER):
+    config = TrajectoryConfig()
+    config.dt = dt
+    config.max_v = 3.0
+    config.max_a = 4.0
+    config.max_j = max_j
+    config.sample_count = sample_count
+    config.arc_length_tolerance = arc_length_tolerance
+    config.max_lateral_a = max_lateral_a
+    config.wheelbase_width = wheelbase_width
+    config.profile_type = profile_type
+    return config
+
+
+def time_stage(function, repeat):
+    times = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        times.append(time.perf_counter() - start)
+    return times, result
+
+
+def run_case(path_name, config_name, repeat, folder):
+    waypoints = make_waypoints(*PATHS[path_name])
+    config_values = CONFIGS[config_name]
+    stages = {}
+
+    def record(name, function, count=None):
+        times, result = time_stage(function, repeat)
+        stages[name] = {
+            'min': min(times),
+            'median': statistics.median(times),
+            'mean': statistics.mean(times),
+            'repeat': repeat,
+        }
+        if count is not None:
+            stages[name]['count'] = count
+        return result
+
+    spline_generator = SplineGenerator(FitType.CUBIC)
+    spline_utils = SplineUtils()
+    pairs = list(zip(waypoints[:-1], waypoints[1:]))
+    splines = record('SplineGenerator.fit', lambda: [spline_generator.fit(a, b) for a, b in pairs], len(pairs))
+    tolerance = config_values.get('arc_length_tolerance', 0.0)
+    if tolerance > 0:
+        record('SplineUtils.get_arc_length_adaptive',
+               lambda: [spline_utils.get_arc_length_adaptive(s, tolerance) for s in splines], len(splines))
+    else:
+        record('SplineUtils.get_arc_length',
+               lambda: [spline_utils.get_arc_length(s, config_values['sample_count']) for s in splines], len(splines))
+
+    config = make_config(**config_values)
+    generator = record('TrajectoryGenerator.prepare', lambda: TrajectoryGenerator(waypoints, config, FitType.CUBIC))
+    planner = TrajectoryPlanner(config)
+    record('TrajectoryPlanner.prepare', planner.prepare)
+    planned = record('TrajectoryPlanner.create', planner.create, planner.info.length)
+    segments = record('TrajectoryGenerator.generate', generator.generate, len(planned))
+    record('BatchTrajectoryGenerator (8 paths)',
+           lambda: BatchTrajectoryGenerator([waypoints] * 8, config, FitType.CUBIC).generate(), 8 * len(segments))
+
+    tank = record('TankModifier', lambda: TankModifier(segments, 0.6), len(segments))
+    record('SwerveModifier', lambda: SwerveModifier(segments, 0.6, 0.7), len(segments))
+
+    p = Pathfinder()
+    p.setFolder(folder)
+    record('Pathfinder.writeSegments (csv)', lambda: p.writeSegments("trajectory", segments), len(segments))
+    p.setFileFormat('binary')
+    record('Pathfinder.writeSegments (binary)', lambda: p.writeSegments("trajectory", segments), len(segments))
+
+    left = tank.get_left_trajectory()
+    ticks = (left.displacement / 0.5 * 1000).tolist()
+
+    def follow_encoder():
+        follower = EncoderFollower(left)
+        follower.configureEncoder(0, 1000, 0.5)
+        follower.configurePIDVA(1.0, 0.0, 0.0, 1 / 3.0, 0.0)
+        for tick in ticks:
+            follower.calculate(tick)
+
+    def follow_distance():
+        follower = DistanceFollower(left)
+        follower.configurePIDVA(1.0, 0.0, 0.0, 1 / 3.0, 0.0)
+        for distance in left.displacement.tolist():
+            follower.calculate(distance)
+
+    def follow_distance_many():
+        follower = DistanceFollower(left)
+        follower.configurePIDVA(1.0, 0.0, 0.0, 1 / 3.0, 0.0)
+        follower.calculate_many(times, left.displacement)
+
+    times = np.arange(len(left)) * left.dt[0]
+    record('EncoderFollower.calculate', follow_encoder, len(left))
+    record('DistanceFollower.calculate', follow_distance, len(left))
+    record('DistanceFollower.calculate_many', follow_distance_many, len(left))
+
+    simulator = FollowerSimulator(left, DrivetrainModel(3.5))
+    gains = gain_grid(np.linspace(0.0, 2.0, 10), np.linspace(0.0, 0.2, 10), [1 / 3.5], np.linspace(0.0, 0.1, 10))
+    record('FollowerSimulator.simulate (1000 gain sets)', lambda: simulator.simulate(gains), len(left))
+
+    return {'path': path_name, 'config': config_name, 'waypoint_count': len(waypoints),
+            'segment_count': len(segments), 'stages': stages}
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline, threshold):
+    '''
+        Print the change in median time of every stage against a baseline run.
+        :return the number of stages more than threshold (a fraction) slower
+    '''
+    baseline_cases = {(case['path'], case['config']): case for case in baseline['cases']}
+    regressions = 0
+    for case in results['cases']:
+        old_case = baseline_cases.get((case['path'], case['config']))
+        if old_case is None:
+            continue
+        for stage, timing in case['stages'].items():
+            if stage not in old_case['stages']:
+                continue
+            old = old_case['stages'][stage]['median']
+            ratio = timing['median'] / old if old > 0 else math.inf
+            slower = ratio > 1 + threshold
+            regressions += slower
+            print("%-14s %-14s %-36s %10.6f -> %10.6f s  x%.2f%s" % (
+                case['path'], case['config'], stage, old, timing['median'], ratio, "  SLOWER" if slower else ""))
+    return regressions
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-o", "--output", required=False, help="File to write the JSON results to (defaults to stdout)")
+    ap.add_argument("-r", "--repeat", type=int, default=5, help="How many times each stage is timed")
+    ap.add_argument("-q", "--quick", action="store_true", help="Only run a couple of cases")
+    ap.add_argument("--compare", required=False, help="JSON results of an earlier run to compare against")
+    ap.add_argument("--threshold", type=float, default=0.2,
+                    help="How much slower (as a fraction) a stage can be before --compare reports it")
+    args = vars(ap.parse_args())
+
+    paths = QUICK_PATHS if args['quick'] else PATHS
+    configs = QUICK_CONFIGS if args['quick'] else CONFIGS
+
+    results = {
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'processor': platform.processor(),
+        'cases': [],
+    }
+    with tempfile.TemporaryDirectory() as folder:
+        for path_name in paths:
+            for config_name in configs:
+                print("benchmarking %s / %s" % (path_name, config_name), file=sys.stderr)
+                results['cases'].append(run_case(path_name, config_name, args['repeat'], folder))
+
+    text = json.dumps(results, indent=2)
+    if args['output']:
+        with open(args['output'], 'w') as f:
+            f.write(text)
+    else:
+        print(text)
+
+    if args['compare']:
+        with open(args['compare']) as f:
+            regressions = compare(results, json.load(f), args['threshold'])
+        sys.exit(1 if regressions else 0)
@@ -1,4 +1,7 @@
-class DistanceFollower:
+from time_indexed_follower import TimeIndexedFollower
+
+
+class DistanceFollower(TimeIndexedFollower):
     def __init__(self, trajectory):
         self.last_error = 0.0
         self.heading = 0.0
@@ -10,6 +13,9 @@ class DistanceFollower:
         self.kv = 0.0
         self.ka = 0.0
         self.trajectory = trajectory
+        # For the time based calculate_at and calculate_many: built when first needed
+        self.time_index = None
+        self.last_time = None
 
     def configurePIDVA(self, kp, ki, kd, kv, ka):
         '''
@@ -43,11 +49,15 @@ class DistanceFollower:
         else:
             return 0.0
 
+    def getDistanceCovered(self, distance):
+        return distance
+
     def setTrajectory(self, trajectory):
         '''
             Set a new trajectory to follow, and reset the cumulative errors and segment counts
         '''
         self.trajectory = trajectory
+        self.time_index = None
         self.reset()
 
     def reset(self):
@@ -56,6 +66,7 @@ class DistanceFollower:
         '''
         self.segment = 0
         self.last_error = 0
+        self.last_time = None
 
     def isFinished(self):
         '''
@@ -1,4 +1,7 @@
-class EncoderFollower:
+from time_indexed_follower import TimeIndexedFollower
+
+
+class EncoderFollower(TimeIndexedFollower):
     '''
         The EncoderFollower is an object designed to follow a trajectory based on encoder input. This class can be used
         for Tank or Swerve drive implementations.
@@ -17,6 +20,9 @@ class EncoderFollower:
         self.kv = 0.0
         self.ka = 0.0
         self.trajectory = trajectory
+        # For the time based calculate_at and calculate_many: built when first needed
+        self.time_index = None
+        self.last_time = None
 
     def configureEncoder(self, initial_position, ticks_per_revolution, wheel_circumference):
         '''
@@ -58,8 +64,7 @@ class EncoderFollower:
             :return             The desired output for your motor controller
         '''
         if(self.segment < len(self.trajectory)):
-            distance_covered = ((float(encoder_tick) - float(self.initial_position)) /
-                                float(self.ticks_per_revolution)) * self.wheel_circumference
+            distance_covered = self.getDistanceCovered(float(encoder_tick))
 
             seg = self.trajectory[self.segment]
 
@@ -73,11 +78,19 @@ class EncoderFollower:
         else:
             return 0.0
 
+    def getDistanceCovered(self, encoder_tick):
+        '''
+            :return the distance travelled for an encoder reading (or an array of them)
+        '''
+        return ((encoder_tick - float(self.initial_position)) /
+                float(self.ticks_per_revolution)) * self.wheel_circumference
+
     def setTrajectory(self, trajectory):
         '''
             Set a new trajectory to follow, and reset the cumulative errors and segment counts
         '''
         self.trajectory = trajectory
+        self.time_index = None
         self.reset()
 
     def reset(self):
@@ -86,6 +99,7 @@ class EncoderFollower:
         '''
         self.segment = 0
         self.last_error = 0
+        self.last_time = None
 
     def isFinished(self):
         '''
@@ -0,0 +1,172 @@
+'''
+    Offline simulation of the followers, for tuning their PID/VA gains without the robot.
+
+    The control law of EncoderFollower/DistanceFollower.calculate is run against a simple drivetrain model for a whole
+    trajectory, for a whole grid of gain sets at once, e.g.
+
+        python follower_simulator.py Trajectories/test/tank_left_trajectory.csv --max-velocity 3.5 \
+            --kp 0:2:21 --kd 0:0.2:11 --kv 0.2857 --ka 0:0.1:11
+'''
+
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from structs.segment_array import SegmentArray
+import trajectory_file
+
+# Order of the gains in a gain set
+GAINS = ('kp', 'kd', 'kv', 'ka')
+
+
+class DrivetrainModel:
+    '''
+        One side of a drivetrain: the wheel speed approaches output * max_velocity with a first order lag of
+        time_constant seconds, and the output is clipped to +/- max_output. noise is the standard deviation (in
+        meters) of the error of the distance measurements the follower is given; every gain set sees the same noise.
+    '''
+    def __init__(self, max_velocity, time_constant=0.1, max_output=1.0, noise=0.0, seed=0):
+        self.max_velocity = max_velocity
+        self.time_constant = time_constant
+        self.max_output = max_output
+        self.noise = noise
+        self.seed = seed
+
+
+def gain_grid(kp=(0.0,), kd=(0.0,), kv=(0.0,), ka=(0.0,)):
+    '''
+        :return every combination of the given values of each gain, as a (count, 4) array of kp, kd, kv, ka
+    '''
+    grid = np.meshgrid(*[np.atleast_1d(np.asarray(values, dtype=float)) for values in (kp, kd, kv, ka)],
+                       indexing='ij')
+    return np.stack([g.ravel() for g in grid], axis=1)
+
+
+class FollowerSimulator:
+    def __init__(self, trajectory, model):
+        if not isinstance(trajectory, SegmentArray):
+            trajectory = SegmentArray.from_segments(trajectory)
+        self.trajectory = trajectory
+        self.model = model
+
+    def simulate(self, gains):
+        '''
+            Follow the trajectory with every gain set, stepping all of them together one segment at a time.
+            :param gains (count, 4) array of kp, kd, kv, ka, e.g. from gain_grid
+            :return dict of the gains and, per gain set, the rms, max and final tracking error (meters) and the
+                fraction of the time the output was saturated
+        '''
+        gains = np.atleast_2d(np.asarray(gains, dtype=float))
+        kp, kd, kv, ka = gains.T
+        model = self.model
+        seg = self.trajectory
+        count = len(gains)
+
+        position = seg.displacement
+        velocity = seg.velocity
+        acceleration = seg.acceleration
+        dt = seg.dt
+        # The model's exact first order step for each dt
+        response = 1.0 - np.exp(-dt / model.time_constant) if model.time_constant > 0 else np.ones(len(seg))
+        noise = (np.random.RandomState(model.seed).normal(0.0, model.noise, len(seg)) if model.noise > 0
+                 else np.zeros(len(seg)))
+
+        x = np.zeros(count)
+        v = np.zeros(count)
+        last_error = np.zeros(count)
+        squared_error = np.zeros(count)
+        max_error = np.zeros(count)
+        saturated = np.zeros(count)
+
+        for i in range(len(seg)):
+            tracking_error = position[i] - x
+            squared_error += tracking_error * tracking_error
+            np.maximum(max_error, np.abs(tracking_error), out=max_error)
+
+            # The follower's control law, from the measured distance
+            error = tracking_error - noise[i]
+            output = kp * error + kd * ((error - last_error) / dt[i]) + (kv * velocity[i] + ka * acceleration[i])
+            last_error = error
+
+            saturated += np.abs(output) > model.max_output
+            np.clip(output, -model.max_output, model.max_output, out=output)
+
+            new_v = v + response[i] * (output * model.max_velocity - v)
+            x += (v + new_v) / 2.0 * dt[i]
+            v = new_v
+
+        steps = max(len(seg), 1)
+        final_error = position[-1] - x if len(seg) > 0 else np.zeros(count)
+        results = {name: gains[:, i].copy() for i, name in enumerate(GAINS)}
+        results['rms_error'] = np.sqrt(squared_error / steps)
+        results['max_error'] = max_error
+        results['final_error'] = np.abs(final_error)
+        results['saturation'] = saturated / steps
+        return results
+
+    def sweep(self, gains, workers=None, chunk_size=4096):
+        '''
+            simulate, spread over a process pool in chunks of chunk_size gain sets when there are more than that.
+            :param workers Number of processes (defaults to the number of CPUs)
+        '''
+        gains = np.atleast_2d(np.asarray(gains, dtype=float))
+        if len(gains) <= chunk_size or workers == 1:
+            return self.simulate(gains)
+
+        chunks = [gains[start:start + chunk_size] for start in range(0, len(gains), chunk_size)]
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            parts = list(executor.map(self.simulate, chunks))
+        return {name: np.concatenate([part[name] for part in parts]) for name in parts[0]}
+
+
+def load_trajectory(filepath):
+    '''
+        Read a trajectory written by Pathfinder, csv or binary.
+    '''
+    if os.path.splitext(filepath)[1] == trajectory_file.EXTENSION:
+        return trajectory_file.load(filepath)
+
+    with open(filepath) as csv_file:
+        names = csv_file.readline().strip().split(',')
+        rows = np.loadtxt(csv_file, delimiter=',', ndmin=2)
+    return SegmentArray(data=np.ascontiguousarray([rows[:, names.index(name)] for name in SegmentArray.fieldnames]))
+
+
+def parse_values(text):
+    '''
+        "start:stop:count" for count evenly spaced values, or a comma separated list
+    '''
+    if ':' in text:
+        start, stop, count = text.split(':')
+        return np.linspace(float(start), float(stop), int(count))
+    return np.array([float(value) for value in text.split(',')])
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("trajectory", help="Trajectory file (csv or binary) to follow, e.g. a tank_left_trajectory")
+    ap.add_argument("--max-velocity", type=float, required=True, help="Speed of the drivetrain at full output (m/s)")
+    ap.add_argument("--time-constant", type=float, default=0.1, help="Time to reach 63%% of a new speed (s)")
+    ap.add_argument("--noise", type=float, default=0.0, help="Standard deviation of distance measurements (m)")
+    for gain in GAINS:
+        ap.add_argument("--" + gain, type=parse_values, default=np.zeros(1),
+                        help="Values of %s to try, start:stop:count or a comma separated list" % gain)
+    ap.add_argument("--sort", default='rms_error', choices=['rms_error', 'max_error', 'final_error', 'saturation'])
+    ap.add_argument("--top", type=int, default=10, help="How many of the best gain sets to print")
+    ap.add_argument("-j", "--workers", type=int, required=False,
+                    help="Number of processes to use (defaults to the number of CPUs)")
+    args = vars(ap.parse_args())
+
+    model = DrivetrainModel(args['max_velocity'], args['time_constant'], noise=args['noise'])
+    simulator = FollowerSimulator(load_trajectory(args['trajectory']), model)
+    gains = gain_grid(*[args[gain] for gain in GAINS])
+    results = simulator.sweep(gains, args['workers'])
+
+    print("%8s %8s %8s %8s %10s %10s %10s %10s" % (GAINS + ('rms', 'max', 'final', 'saturated')))
+    for i in np.argsort(results[args['sort']], kind='stable')[:args['top']]:
+        print("%8.4f %8.4f %8.4f %8.4f %10.5f %10.5f %10.5f %9.1f%%" % (
+            tuple(results[gain][i] for gain in GAINS) + (results['rms_error'][i], results['max_error'][i],
+                                                         results['final_error'][i], 100 * results['saturation'][i])))
+    print("%d gain sets" % len(gains))
@@ -1,4 +1,5 @@
 import math
+import numpy as np
 
 
 # Bound an angle (in degrees) to -180 to 180 degrees.
@@ -17,3 +18,9 @@ def bound_radians(angle):
     if (new_angle < 0):
         new_angle = TAU + new_angle
     return new_angle
+
+
+def bound_radians_array(angles):
+    TAU = 2 * 3.14159265358979323846
+    new_angles = np.fmod(angles, TAU)
+    return np.where(new_angles < 0, TAU + new_angles, new_angles)
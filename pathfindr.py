@@ -4,13 +4,30 @@ import argparse
 import json
 import csv
 import sys
+import glob
+import time
 from enum import Enum
+from concurrent.futures import ProcessPoolExecutor
 
-from structs.trajectoryConfig import TrajectoryConfig
+import numpy as np
+
+from structs.trajectory_config import TrajectoryConfig, ProfileType
 from structs.waypoint import Waypoint
 from trajectory_generator import TrajectoryGenerator
+from spline_generator import FitType
 from swerve_modifier import SwerveModifier
 from tank_modifier import TankModifier
+from trajectory_cache import TrajectoryCache
+import trajectory_file
+from profiler import Profiler, NULL_PROFILER
+from structs.segment_array import SegmentArray
+
+
+# Part of the batch subcommand's .inputs stamp. Bump it when batch writes different files for the same trajectories
+# (e.g. new file names), so that paths generated before are rewritten. A change to the trajectories themselves needs
+# trajectory_cache.CACHE_VERSION bumped instead: it is part of the stamp too, and also keeps the cache from handing
+# the old trajectories back when the path is rewritten
+BATCH_OUTPUT_VERSION = 1
 
 
 class DrivebaseType(Enum):
@@ -18,7 +35,50 @@ class DrivebaseType(Enum):
     SWERVE = 1
 
 
+def toEnum(enumType, value):
+    '''
+        Config files give enums either by value (0) or by name ("CUBIC").
+    '''
+    if isinstance(value, str):
+        return enumType[value.upper()]
+    return enumType(value)
+
+
 class Pathfinder:
+    # Names of the files written by writeTankTrajectory and writeSwerveTrajectory
+    tankNames = ("left_tank_trajectory", "right_tank_trajectory")
+    swerveNames = ("swerve_front_left_trajectory", "swerve_front_right_trajectory", "swerve_back_left_trajectory",
+                   "swerve_back_right_trajectory")
+
+    def __init__(self, cache=None):
+        self.cache = cache
+        self.generator = None
+        self.generatorSettings = None
+        self.fileFormat = 'csv'
+        self.binaryDtype = np.float64
+        self.profiler = NULL_PROFILER
+        self.workers = 1
+
+    def setProfiler(self, profiler):
+        '''
+            Record stage timings in a profiler.Profiler. Pass NULL_PROFILER to stop.
+        '''
+        self.profiler = profiler
+
+    def setWorkers(self, workers):
+        '''
+            Sample long trajectories across this many processes (None for the number of CPUs, 1 to stay in this
+            process). The trajectories are the same either way.
+        '''
+        self.workers = workers
+
+    def setCache(self, cache):
+        '''
+            Use a TrajectoryCache to skip regenerating trajectories whose waypoints and config haven't changed.
+            Pass None to always regenerate.
+        '''
+        self.cache = cache
+
     def setFolder(self, folder):
         self.folder = folder
 
@@ -35,17 +95,27 @@ class Pathfinder:
 
         json_file = open(filepath)
         file_text = json_file.read()
-        config = json.loads(file_text)
+        self.applyConfig(json.loads(file_text))
+
+    def applyConfig(self, config):
+        '''
+            Set up the trajectory config and robot dimensions from a parsed robot config. The dict isn't modified.
+        '''
         self.trajectoryConfig = TrajectoryConfig()
         self.trajectoryConfig.max_v = config['max_velocity']
         self.trajectoryConfig.max_a = config['max_acceleration']
         self.trajectoryConfig.max_j = config['max_jerk']
         self.trajectoryConfig.dt = config['time_step']
         self.trajectoryConfig.sample_count = config['sample_count']
+        self.trajectoryConfig.arc_length_tolerance = config.get('arc_length_tolerance', 0.0)
+        self.trajectoryConfig.profile_type = toEnum(ProfileType, config.get('profileType', ProfileType.FILTER.value))
         self.wheelbaseWidth = config['wheelbase_width']
         self.wheelbaseLength = config['wheelbase_length']
-        self.splineType = config['splineType']
-        self.drivebaseType = config['drivebaseType']
+        self.splineType = toEnum(FitType, config['splineType'])
+        self.drivebaseType = toEnum(DrivebaseType, config['drivebaseType'])
+        self.trajectoryConfig.max_lateral_a = config.get('max_lateral_acceleration', 0.0)
+        if config.get('limit_wheel_speed', False) and self.drivebaseType == DrivebaseType.TANK:
+            self.trajectoryConfig.wheelbase_width = self.wheelbaseWidth
 
     def loadWaypoints(self, filepath, copy=True):
         if copy:
@@ -55,16 +125,17 @@ class Pathfinder:
         with open(filepath) as csv_file:
             reader = csv.DictReader(csv_file)
             for row in reader:
-                self.waypoints.append(Waypoint(x=row['x'], y=row['y'], theta=row['theta']))
+                self.waypoints.append(Waypoint(x=float(row['x']), y=float(row['y']), theta=float(row['theta'])))
 
     def saveWaypoints(self):
         with open("%s/waypoints.csv" % self.folder, 'w') as csv_file:
             fieldnames = ['x', 'y', 'theta']
             writer = csv.DictWriter(csv_file, fieldnames=fieldnames)
+            writer.writeheader()
             for waypoint in self.waypoints:
-                writer.write({'x': waypoint.x, 'y': waypoint.y, 'theta': waypoint.theta})
+                writer.writerow({'x': waypoint.x, 'y': waypoint.y, 'theta': waypoint.angle})
 
-    def generateTrajectory(self):
+    def checkLoaded(self):
         if not hasattr(self, 'trajectoryConfig'):
             print("Config file has not been loaded")
             sys.exit()
@@ -73,73 +144,247 @@ class Pathfinder:
             print("Waypoints file has not been loaded")
             sys.exit()
 
-        generator = TrajectoryGenerator(self.waypoints, self.trajectoryConfig, self.splineType)
-        self.segments = generator.generate()
+    def generateTrajectory(self):
+        self.checkLoaded()
 
-    def writeTrajectory(self):
+        def generate():
+            return {'trajectory': self.getGenerator().generate(self.workers)}
+
+        with self.profiler.stage('generateTrajectory') as stage:
+            self.segments = self.cached('trajectory', generate)['trajectory']
+            stage.count(segments=len(self.segments))
+
+    def getGenerator(self):
+        '''
+            Reuse the last TrajectoryGenerator if the config and number of waypoints haven't changed, so that moving
+            a waypoint only refits the splines next to it.
+        '''
+        settings = (self.splineType, TrajectoryCache.config_fields(self.trajectoryConfig))
+        if (self.generator is None or self.generatorSettings != settings or
+                len(self.generator.path) != len(self.waypoints)):
+            self.generator = TrajectoryGenerator(self.waypoints, self.trajectoryConfig, self.splineType, self.profiler)
+            self.generatorSettings = settings
+            return self.generator
+
+        self.generator.profiler = self.profiler
+
+        changes = {}
+        for i, (old, new) in enumerate(zip(self.generator.path, self.waypoints)):
+            if (old.x, old.y, old.angle) != (new.x, new.y, new.angle):
+                changes[i] = new
+        if changes:
+            self.generator.update_waypoints(changes)
+        return self.generator
+
+    def cached(self, kind, generate, *params):
+        if self.cache is None:
+            return generate()
+
+        key = TrajectoryCache.make_key(kind, self.waypoints, self.trajectoryConfig, self.splineType, *params)
+        return self.cache.get_or_generate(key, generate)
+
+    def setFileFormat(self, fileFormat, dtype=np.float64):
+        '''
+            :param fileFormat 'csv', or 'binary' for the memory-mappable format in trajectory_file
+            :param dtype      The value type of binary files, np.float64 or np.float32
+        '''
+        self.fileFormat = fileFormat
+        self.binaryDtype = dtype
+
+    def getSegmentsPath(self, name):
+        extension = trajectory_file.EXTENSION if self.fileFormat == 'binary' else ".csv"
+        return "%s/%s%s" % (self.folder, name, extension)
+
+    def getOutputPaths(self, tank=False, swerve=False):
+        '''
+            :return the paths of the files writeTrajectory, and writeTankTrajectory and writeSwerveTrajectory if
+                asked for, write
+        '''
+        names = ["trajectory"]
+        if tank:
+            names.extend(self.tankNames)
+        if swerve:
+            names.extend(self.swerveNames)
+        return [self.getSegmentsPath(name) for name in names]
+
+    def writeSegments(self, name, segments):
+        with self.profiler.stage('file writing', segments=len(segments)):
+            if self.fileFormat == 'binary':
+                trajectory_file.write(self.getSegmentsPath(name), segments, self.binaryDtype)
+                return
+
+            with open(self.getSegmentsPath(name), 'w', newline='') as csv_file:
+                writer = csv.writer(csv_file)
+                writer.writerow(segments.fieldnames)
+                writer.writerows(segments.rows())
 
+    def writeTrajectory(self):
         self.generateTrajectory()
+        self.writeSegments("trajectory", self.segments)
+
+    def streamTrajectory(self, chunkSize=1000):
+        '''
+            Generate and write the trajectory chunkSize segments at a time, without holding the whole path in memory.
+            Unlike writeTrajectory this doesn't set self.segments or use the cache.
+        '''
+        self.checkLoaded()
+        generator = self.getGenerator()
+        chunks = generator.generate_chunks(chunkSize)
 
-        fieldnames = ['dt', 'x', 'y', 'displacement', 'velocity', 'acceleration', 'jerk', 'heading']
-        writer = csv.DictWriter("%s/trajectory.csv" % self.folder, fieldnames=fieldnames)
-        writer.writeheader()
-        for segment in self.segments:
-            writer.writerow(segment.__dict__)
+        if self.fileFormat == 'binary':
+            filepath = "%s/trajectory%s" % (self.folder, trajectory_file.EXTENSION)
+            with trajectory_file.StreamWriter(filepath, generator.trajectory.length, self.trajectoryConfig.dt,
+                                              self.binaryDtype) as writer:
+                for segments in chunks:
+                    writer.write(segments)
+            return
+
+        with open("%s/trajectory.csv" % self.folder, 'w', newline='') as csv_file:
+            writer = csv.writer(csv_file)
+            writer.writerow(SegmentArray.fieldnames)
+            for segments in chunks:
+                writer.writerows(segments.rows())
 
     def generateTankTrajectory(self):
         if not hasattr(self, 'segments'):
             self.generateTrajectory()
 
-        tankModifier = TankModifier(self.segments, self.wheelbase_width)
-        self.tank_left_segments = tankModifier.get_left_trajectory()
-        self.tank_right_segments = tankModifier.get_right_trajectory()
+        def generate():
+            tankModifier = TankModifier(self.segments, self.wheelbaseWidth, self.profiler)
+            return {'left': tankModifier.get_left_trajectory(), 'right': tankModifier.get_right_trajectory()}
+
+        tank = self.cached('tank', generate, self.wheelbaseWidth)
+        self.tank_left_segments = tank['left']
+        self.tank_right_segments = tank['right']
 
     def writeTankTrajectory(self):
         self.generateTankTrajectory()
-        fieldnames = ['dt', 'x', 'y', 'displacement', 'velocity', 'acceleration', 'jerk', 'heading']
-        writer = csv.DictWriter("%s/left_tank_trajectory.csv" % self.folder, fieldnames=fieldnames)
-        writer.writeheader()
-        for segment in self.tank_left_segments:
-            writer.writerow(segment.__dict__)
-
-        writer = csv.DictWriter("%s/right_tank_trajectory.csv" % self.folder, fieldnames=fieldnames)
-        writer.writeheader()
-        for segment in self.tank_right_segments:
-            writer.writerow(segment.__dict__)
+        for name, segments in zip(self.tankNames, (self.tank_left_segments, self.tank_right_segments)):
+            self.writeSegments(name, segments)
 
     def generateSwerveTrajectory(self):
         if not hasattr(self, 'segments'):
             self.generateTrajectory()
 
-        swerveModifier = SwerveModifier(self.segments, self.wheelbase_width, self.wheelbase_length)
-        self.swerve_front_left_segments = swerveModifier.get_front_left_trajectory()
-        self.swerve_front_right_segments = swerveModifier.get_front_right_trajectory()
-        self.swerve_back_left_segments = swerveModifier.get_back_left_trajectory()
-        self.swerve_back_right_segments = swerveModifier.get_back_right_trajectory()
+        def generate():
+            swerveModifier = SwerveModifier(self.segments, self.wheelbaseWidth, self.wheelbaseLength, self.profiler)
+            return dict(zip(('front_left', 'front_right', 'back_left', 'back_right'),
+                            swerveModifier.get_module_trajectories()))
+
+        swerve = self.cached('swerve', generate, self.wheelbaseWidth, self.wheelbaseLength)
+        self.swerve_front_left_segments = swerve['front_left']
+        self.swerve_front_right_segments = swerve['front_right']
+        self.swerve_back_left_segments = swerve['back_left']
+        self.swerve_back_right_segments = swerve['back_right']
 
     def writeSwerveTrajectory(self):
         self.generateSwerveTrajectory()
-        fieldnames = ['dt', 'x', 'y', 'displacement', 'velocity', 'acceleration', 'jerk', 'heading']
-        writer = csv.DictWriter("%s/swerve_front_left_trajectory.csv" % self.folder, fieldnames=fieldnames)
-        writer.writeheader()
-        for segment in self.swerve_front_left_segments:
-            writer.writerow(segment.__dict__)
-
-        writer = csv.DictWriter("%s/swerve_front_right_trajectory.csv" % self.folder, fieldnames=fieldnames)
-        writer.writeheader()
-        for segment in self.swerve_front_right_segments:
-            writer.writerow(segment.__dict__)
-        writer = csv.DictWriter("%s/swerve_back_left_trajectory.csv" % self.folder, fieldnames=fieldnames)
-        writer.writeheader()
-        for segment in self.swerve_back_left_segments:
-            writer.writerow(segment.__dict__)
-        writer = csv.DictWriter("%s/swerve_back_right_trajectory.csv" % self.folder, fieldnames=fieldnames)
-        writer.writeheader()
-        for segment in self.swerve_back_right_segments:
-            writer.writerow(segment.__dict__)
+        for name, segments in zip(self.swerveNames, (self.swerve_front_left_segments, self.swerve_front_right_segments,
+                                                     self.swerve_back_left_segments, self.swerve_back_right_segments)):
+            self.writeSegments(name, segments)
+
+
+def batchGeneratePath(folder, configPath, options):
+    '''
+        Generate one path for batch(). Runs in a worker process.
+        :return (folder, whether it was generated or skipped as unchanged, seconds taken)
+    '''
+    start = time.perf_counter()
+
+    p = Pathfinder()
+    if options['cache'] is not None:
+        p.setCache(TrajectoryCache(options['cache']))
+    if options['binary']:
+        p.setFileFormat('binary', np.float32 if options['float32'] else np.float64)
+    p.setFolder(folder)
+    p.loadConfig(configPath, False)
+    p.loadWaypoints("%s/waypoints.csv" % folder, False)
+
+    tank = options['tank'] or p.drivebaseType == DrivebaseType.TANK
+    swerve = options['swerve'] or p.drivebaseType == DrivebaseType.SWERVE
+
+    # Everything the output depends on (make_key includes the cache version); if it matches what was last written,
+    # and the files written then are all still there, the path is skipped
+    stampPath = "%s/.inputs" % folder
+    stamp = TrajectoryCache.make_key('batch', p.waypoints, p.trajectoryConfig, p.splineType, p.wheelbaseWidth,
+                                     p.wheelbaseLength, tank, swerve, p.fileFormat, np.dtype(p.binaryDtype).name,
+                                     BATCH_OUTPUT_VERSION, trajectory_file.VERSION)
+    outputsExist = all(os.path.exists(path) for path in p.getOutputPaths(tank, swerve))
+    if not options['force'] and outputsExist and os.path.exists(stampPath):
+        with open(stampPath) as stampFile:
+            if stampFile.read() == stamp:
+                return folder, False, time.perf_counter() - start
+
+    p.writeTrajectory()
+    if tank:
+        p.writeTankTrajectory()
+    if swerve:
+        p.writeSwerveTrajectory()
+
+    with open(stampPath, 'w') as stampFile:
+        stampFile.write(stamp)
+    return folder, True, time.perf_counter() - start
+
+
+def batch(argv):
+    '''
+        The batch subcommand: generate every <root>/*/waypoints.csv across a process pool, skipping paths whose
+        waypoints and config haven't changed since they were last generated.
+    '''
+    ap = argparse.ArgumentParser(prog="pathfindr.py batch")
+    ap.add_argument("root", help="Folder containing one folder (with a waypoints.csv) per path")
+    ap.add_argument("-c", "--config", required=False,
+                    help="File containing the robot configuration/dynamics (defaults to <root>/robotConfig.json)")
+    ap.add_argument("-t", "--tank", action="store_true",
+                    help="Write tank trajectories whatever the config's drivebase type is")
+    ap.add_argument("-s", "--swerve", action="store_true",
+                    help="Write swerve trajectories whatever the config's drivebase type is")
+    ap.add_argument("-j", "--workers", type=int, required=False,
+                    help="Number of processes to use (defaults to the number of CPUs)")
+    ap.add_argument("--force", action="store_true", help="Regenerate paths even if they haven't changed")
+    ap.add_argument("--no-cache", action="store_true", help="Don't use the trajectory cache in <root>/.cache")
+    ap.add_argument("-b", "--binary", action="store_true",
+                    help="Write trajectories in the binary format (.bin) instead of csv")
+    ap.add_argument("--float32", action="store_true", help="Use 32 bit values in binary trajectories")
+    args = vars(ap.parse_args(argv))
+
+    configPath = args['config'] or os.path.join(args['root'], "robotConfig.json")
+    options = {
+        'cache': None if args['no_cache'] else os.path.join(args['root'], ".cache"),
+        'tank': args['tank'],
+        'swerve': args['swerve'],
+        'force': args['force'],
+        'binary': args['binary'],
+        'float32': args['float32'],
+    }
+
+    folders = sorted(os.path.dirname(path) for path in glob.glob(os.path.join(args['root'], "*", "waypoints.csv")))
+    if not folders:
+        print("No waypoints.csv found in %s/*/" % args['root'])
+        return
+
+    start = time.perf_counter()
+    results = []
+    with ProcessPoolExecutor(max_workers=args['workers']) as executor:
+        futures = [executor.submit(batchGeneratePath, folder, configPath, options) for folder in folders]
+        for folder, future in zip(folders, futures):
+            try:
+                results.append(future.result())
+            except Exception as e:
+                print("%s: failed: %r" % (folder, e))
+
+    for folder, generated, seconds in results:
+        print("%-40s %-10s %8.3f s" % (os.path.basename(folder), "generated" if generated else "unchanged", seconds))
+    print("%d generated, %d unchanged, %d failed in %.3f s" % (
+        sum(1 for result in results if result[1]), sum(1 for result in results if not result[1]),
+        len(folders) - len(results), time.perf_counter() - start))
 
 
 if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "batch":
+        batch(sys.argv[2:])
+        sys.exit(0)
+
     # Collect command line arguments
     ap = argparse.ArgumentParser()
     ap.add_argument("-f", "--folder", required=True, help="Folder where the trajectory will be writen")
@@ -147,15 +392,44 @@ if __name__ == "__main__":
     ap.add_argument("-w", "--waypoints", required=True, help="File containing the waypoint")
     ap.add_argument("-t", "--tank", required=False, help="Tank trajectory will be written")
     ap.add_argument("-s", "--swerve", required=False, help="Swerve trajectory will be written")
+    ap.add_argument("--cache", required=False,
+                    help="Folder for the trajectory cache (defaults to .cache next to the trajectory folder)")
+    ap.add_argument("--no-cache", action="store_true", help="Always regenerate, without reading or writing the cache")
+    ap.add_argument("-b", "--binary", action="store_true",
+                    help="Write trajectories in the binary format (.bin) instead of csv")
+    ap.add_argument("--float32", action="store_true", help="Use 32 bit values in binary trajectories")
+    ap.add_argument("--stream", type=int, metavar="CHUNK_SIZE", required=False,
+                    help="Write the trajectory CHUNK_SIZE segments at a time instead of generating it all in memory")
+    ap.add_argument("--stats", action="store_true", help="Print how long each stage of generation took")
+    ap.add_argument("-j", "--workers", type=int, default=1,
+                    help="Number of processes to sample a long trajectory with (0 for the number of CPUs)")
     args = vars(ap.parse_args())
+    if args['stream'] and (args['tank'] or args['swerve']):
+        # The tank and swerve modifiers work on the whole trajectory, which streaming never holds in memory
+        ap.error("--stream can't be used with -t/--tank or -s/--swerve")
 
     p = Pathfinder()
+    p.setWorkers(args['workers'] or None)
+    if args['stats']:
+        p.setProfiler(Profiler())
+    if not args['no_cache']:
+        cacheFolder = args['cache'] or os.path.join(os.path.dirname(os.path.abspath(args['folder'])), ".cache")
+        p.setCache(TrajectoryCache(cacheFolder))
+    if args['binary']:
+        p.setFileFormat('binary', np.float32 if args['float32'] else np.float64)
     p.setFolder(args['folder'])
     p.setupFolder()
     p.loadConfig(args['config'])
     p.loadWaypoints(args['waypoints'])
-    p.writeTrajectory()
+    if args['stream']:
+        p.streamTrajectory(args['stream'])
+    else:
+        p.writeTrajectory()
     if(args['tank']):
         p.writeTankTrajectory()
     if(args['swerve']):
         p.writeSwerveTrajectory()
+    if args['stats']:
+        print(p.profiler.report())
+        if p.cache is not None:
+            print("cache: %s" % p.cache.stats())
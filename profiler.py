@@ -0,0 +1,120 @@
+import time
+
+
+class Profiler:
+    '''
+        Records how long each stage of trajectory generation takes.
+
+        Stages are timed with
+            with profiler.stage('spline fitting') as stage:
+                ...
+                stage.count(splines=n)
+        and stats() gives, per stage, the number of calls, the total/mean/max wall time in seconds and the totals of
+        anything counted (segments, splines, ...).
+
+        Classes that take a profiler default to NULL_PROFILER, which records nothing and costs next to nothing.
+    '''
+    enabled = True
+
+    def __init__(self):
+        self.stages = {}
+
+    def stage(self, name, **counts):
+        return ProfilerStage(self, name, counts)
+
+    def add(self, name, seconds, calls=1, **counts):
+        stage = self.stages.get(name)
+        if stage is None:
+            stage = self.stages[name] = {'calls': 0, 'total': 0.0, 'max': 0.0}
+        stage['calls'] += calls
+        stage['total'] += seconds
+        stage['max'] = max(stage['max'], seconds)
+        for key, value in counts.items():
+            stage[key] = stage.get(key, 0) + value
+
+    def merge(self, stats):
+        '''
+            Add the stats() of another profiler (e.g. one that ran in a worker process) to this one.
+        '''
+        for name, stage in stats.items():
+            counts = {key: value for key, value in stage.items() if key not in ('calls', 'total', 'mean', 'max')}
+            self.add(name, stage['total'], stage['calls'], **counts)
+            self.stages[name]['max'] = max(self.stages[name]['max'], stage['max'])
+
+    def reset(self):
+        self.stages = {}
+
+    def stats(self):
+        stats = {}
+        for name, stage in self.stages.items():
+            stats[name] = dict(stage)
+            stats[name]['mean'] = stage['total'] / stage['calls'] if stage['calls'] else 0.0
+        return stats
+
+    def report(self):
+        lines = ["%-32s %6s %10s %10s %10s  %s" % ("stage", "calls", "total (s)", "mean (s)", "max (s)", "counts")]
+        for name, stage in self.stats().items():
+            counts = ", ".join("%s=%d" % (key, value) for key, value in stage.items()
+                               if key not in ('calls', 'total', 'mean', 'max'))
+            lines.append("%-32s %6d %10.6f %10.6f %10.6f  %s" % (
+                name, stage['calls'], stage['total'], stage['mean'], stage['max'], counts))
+        return "\n".join(lines)
+
+
+class ProfilerStage:
+    __slots__ = ('profiler', 'name', 'counts', 'start')
+
+    def __init__(self, profiler, name, counts):
+        self.profiler = profiler
+        self.name = name
+        self.counts = counts
+
+    def count(self, **counts):
+        for key, value in counts.items():
+            self.counts[key] = self.counts.get(key, 0) + value
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.profiler.add(self.name, time.perf_counter() - self.start, **self.counts)
+
+
+class NullProfiler:
+    enabled = False
+
+    def stage(self, name, **counts):
+        return NULL_STAGE
+
+    def add(self, name, seconds, calls=1, **counts):
+        pass
+
+    def merge(self, stats):
+        pass
+
+    def reset(self):
+        pass
+
+    def stats(self):
+        return {}
+
+    def report(self):
+        return ""
+
+
+class NullProfilerStage:
+    __slots__ = ()
+
+    def count(self, **counts):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+NULL_STAGE = NullProfilerStage()
+NULL_PROFILER = NullProfiler()
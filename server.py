@@ -4,12 +4,21 @@ import random
 import signal
 import time
 import json
+import argparse
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
 
+import numpy as np
 import tornado.ioloop
 import tornado.websocket
 import tornado.httpserver
 
-from pathfinder import Pathfinder, DrivebaseType
+from pathfindr import Pathfinder, DrivebaseType
+from trajectory_cache import TrajectoryCache
+import trajectory_file
+from structs.waypoint import Waypoint
+from trajectory_generator import TrajectoryGenerator
+from profiler import Profiler, NULL_PROFILER
 
 clients = set()
 clientId = 0
@@ -18,17 +27,195 @@ port = 9001
 pin = random.randint(0, 99999)
 pathsFolder = "/Robot/Trajectories"
 configFilepath = "{0:s}/robotConfig.json".format(pathsFolder)
-p = Pathfinder
+cacheFolder = "{0:s}/.cache".format(pathsFolder)
+cache = TrajectoryCache(cacheFolder)
+
+# Trajectory generation runs in this pool so that it doesn't block the IOLoop. Created in __main__.
+executor = None
+# Stage timings of everything generated, for GetStats. Replaced by a Profiler in __main__ with --profile.
+profiler = NULL_PROFILER
+# How long each command takes to handle, from receiving it to its last reply
+commandTimes = Profiler()
+# The Pathfinder used by generateTrajectories inside each pool process
+workerPathfinder = None
+# permessage-deflate settings offered to clients that support it, None to never compress. Set in __main__.
+compressionOptions = {}
+
+# Clients asking for this websocket subprotocol (or sending SetProtocol {"binary": true}) get trajectories as binary
+# messages (trajectory_file.encode_message) instead of json text
+BINARY_SUBPROTOCOL = "pathfinder-binary"
+PRECISIONS = {32: np.float32, 64: np.float64}
 
 
 def log(wsId, message):
     print("{0:s}\tClient {1:2d}\t{2:s}".format(time.strftime("%H:%M:%S", time.localtime()), wsId, message))
 
 
+class ConfigCache:
+    '''
+        The parsed robot config, shared read-only by every connection. It is read again when the file changes.
+    '''
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.config = None
+        self.mtime = None
+
+    def get(self):
+        '''
+            :return the parsed config dict (don't modify it), or None if there is no config file
+        '''
+        if not os.path.exists(self.filepath):
+            return None
+
+        mtime = os.path.getmtime(self.filepath)
+        if self.config is None or mtime != self.mtime:
+            with open(self.filepath, 'r') as jsonFile:
+                self.config = json.load(jsonFile)
+            self.mtime = mtime
+        return self.config
+
+    def invalidate(self):
+        self.config = None
+
+
+configCache = ConfigCache(configFilepath)
+
+
+def parseWaypoints(waypoints):
+    return [Waypoint(float(w['x']), float(w['y']), float(w.get('r', w.get('theta', w.get('angle', 0.0)))))
+            for w in waypoints]
+
+
+def generateTrajectories(waypoints, trajectoryConfig, splineType, drivebaseType, wheelbaseWidth, wheelbaseLength,
+                         folder=None, profile=False):
+    '''
+        Generate the trajectories for a path. This runs in the process pool, so everything it needs is passed in.
+        :param folder  If given, the waypoints and trajectories are also written to this folder
+        :param profile Whether to time the stages of generation
+        :return        dict of response name to SegmentArray, and the profiler stats (empty unless profiling)
+    '''
+    global workerPathfinder
+    if workerPathfinder is None:
+        workerPathfinder = Pathfinder(TrajectoryCache(cacheFolder))
+
+    wp = workerPathfinder
+    wp.setProfiler(Profiler() if profile else NULL_PROFILER)
+    wp.waypoints = waypoints
+    wp.trajectoryConfig = trajectoryConfig
+    wp.splineType = splineType
+    wp.drivebaseType = drivebaseType
+    wp.wheelbaseWidth = wheelbaseWidth
+    wp.wheelbaseLength = wheelbaseLength
+
+    if folder is not None:
+        os.makedirs(folder, exist_ok=True)
+        wp.setFolder(folder)
+        wp.saveWaypoints()
+        wp.writeTrajectory()
+    else:
+        wp.generateTrajectory()
+
+    response = dict()
+    response['trajectory'] = wp.segments
+    if drivebaseType == DrivebaseType.TANK:
+        if folder is not None:
+            wp.writeTankTrajectory()
+        else:
+            wp.generateTankTrajectory()
+        response['tank_left_trajectory'] = wp.tank_left_segments
+        response['tank_right_trajectory'] = wp.tank_right_segments
+    elif drivebaseType == DrivebaseType.SWERVE:
+        if folder is not None:
+            wp.writeSwerveTrajectory()
+        else:
+            wp.generateSwerveTrajectory()
+        response['swerve_front_left_trajectory'] = wp.swerve_front_left_segments
+        response['swerve_front_right_trajectory'] = wp.swerve_front_right_segments
+        response['swerve_back_left_trajectory'] = wp.swerve_back_left_segments
+        response['swerve_back_right_trajectory'] = wp.swerve_back_right_segments
+    else:
+        print("Unknown Drivebase Type")
+
+    return response, wp.profiler.stats()
+
+
+class Trajectories:
+    '''
+        A reply payload of trajectories (dict of name to SegmentArray), sent as json or as a binary message depending
+        on the client's protocol.
+    '''
+    def __init__(self, trajectories, **fields):
+        self.trajectories = trajectories
+        self.fields = fields
+
+
+class Request:
+    '''
+        A command from a client. Commands are json envelopes, {"cmd": ..., "id": ..., "payload": ...}, and every
+        reply carries the id of the request it answers, so a client can have several requests outstanding.
+        Requests translated from the old prefixed text messages are legacy and are replied to in the old format.
+    '''
+    def __init__(self, cmd, requestId=None, payload=None, legacy=False):
+        self.cmd = cmd
+        self.id = requestId
+        self.payload = payload
+        self.legacy = legacy
+
+
+# Command name to Server method, filled in by @command
+commands = {}
+
+
+def command(name):
+    '''
+        Register a Server method as the handler of a command. It is called with the Request, can be a coroutine,
+        and replies with Server.reply (as many times as it needs).
+    '''
+    def register(handler):
+        commands[name] = handler
+        return handler
+    return register
+
+
+def parseLegacyTrajectoryRequest(text):
+    data = json.loads(text)
+    # Either a list of waypoints or {"id": ..., "waypoints": [...], "stream": chunk size (optional)}
+    return {'waypoints': data} if isinstance(data, list) else data
+
+
+# The old text messages: prefix, command and how to turn the rest of the message into the payload
+LEGACY_COMMANDS = [
+    ("GetConfig", "GetConfig", lambda text: None),
+    ("PostConfig", "PostConfig", json.loads),
+    ("GetWaypoints", "GetWaypoints", lambda text: {'name': text}),
+    ("PostWaypoints", "PostWaypoints", json.loads),
+    ("GetTrajectories", "GetTrajectories", parseLegacyTrajectoryRequest),
+    ("SetProtocol", "SetProtocol", json.loads),
+    ("GetStats", "GetStats", lambda text: None),
+    ("SavePath", "SavePath", json.loads),
+]
+
+# How replies are written in the old format, when it isn't the reply name followed by the json payload
+LEGACY_REPLIES = {
+    'RobotConfig': lambda payload: "RobotConfig" + json.dumps(payload) if payload is not None else "{}",
+    'Trajectories': lambda payload: "Trajectories:" + json.dumps(payload),
+    'TrajectoryChunk': lambda payload: "TrajectoryChunk:" + json.dumps(payload),
+    'TrajectoryDone': lambda payload: "TrajectoryDone:" + json.dumps(payload),
+    'TrajectoryError': lambda payload: "TrajectoryError" + payload,
+    'Error': lambda payload: "Error" + payload,
+}
+
+
 class Server(tornado.websocket.WebSocketHandler):
     def check_origin(self, origin):
         return True
 
+    def select_subprotocol(self, subprotocols):
+        return BINARY_SUBPROTOCOL if BINARY_SUBPROTOCOL in subprotocols else None
+
+    def get_compression_options(self):
+        return compressionOptions
+
     def open(self):
         global clients, clientId
 
@@ -37,112 +224,311 @@ class Server(tornado.websocket.WebSocketHandler):
         clients.add(self)
 
         self.verified = False
+        # Each connection has its own config and waypoints so that clients don't see each other's edits
+        self.session = Pathfinder(cache)
+        # Outstanding requests by id, and the latest legacy trajectory request, which a newer one cancels
+        self.requests = {}
+        self.pendingTrajectories = None
+        # Text clients get json, binary ones packed columns of binaryDtype
+        self.binary = self.selected_subprotocol == BINARY_SUBPROTOCOL
+        self.binaryDtype = np.float32
 
         log(self.id, "connected with ip: " + self.request.remote_ip)
 
     def on_message(self, message):
+        try:
+            request = self.parseRequest(message)
+        except ValueError as e:
+            self.reply(Request("Error", legacy=message[:1] != "{"), "Error", "Malformed message: " + str(e))
+            log(self.id, "sent a malformed message: " + str(message)[:40])
+            return
+        if request is None:
+            log(self.id, "sent an unknown message: " + str(message)[:40])
+            return
+
+        if not self.verified and request.cmd != "Verify":
+            self.reply(request, "Unverified")
+            return
+
+        handler = commands.get(request.cmd)
+        if handler is None:
+            self.reply(request, "Error", "Unknown command " + str(request.cmd))
+            return
+
+        # Plain handlers run right away, so messages are handled in the order they arrive (a Verify before the
+        # commands that follow it). Only coroutines, which wait on generation, become tasks that can be cancelled.
+        if not asyncio.iscoroutinefunction(handler):
+            self.handleNow(handler, request)
+            return
+        task = asyncio.ensure_future(self.handle(handler, request))
+        if request.id is not None:
+            self.requests[request.id] = task
+
+    def parseRequest(self, message):
+        '''
+            :return the Request for a message: a json envelope, or one of the old prefixed text messages. None if it
+                is neither, and ValueError if it is malformed
+        '''
+        if isinstance(message, bytes):
+            return None
+        if message[:1] == "{":
+            data = json.loads(message)
+            if not isinstance(data, dict) or 'cmd' not in data:
+                raise ValueError("no cmd")
+            return Request(data['cmd'], data.get('id'), data.get('payload'))
+
         if not self.verified:
-            try:
-                clientPin = int(message)
-            except ValueError:
-                self.write_message("Invalid Pin")
-                log(self.id, "entered an invalid pin: " + message)
+            return Request("Verify", payload={'pin': message}, legacy=True)
+        for prefix, cmd, parse in LEGACY_COMMANDS:
+            if message[:len(prefix)] == prefix:
+                return Request(cmd, payload=parse(message[len(prefix):]), legacy=True)
+        return None
+
+    def handleNow(self, handler, request):
+        start = time.perf_counter()
+        try:
+            handler(self, request)
+        except Exception as e:
+            self.failed(request, e)
+        finally:
+            commandTimes.add(request.cmd, time.perf_counter() - start)
+
+    async def handle(self, handler, request):
+        start = time.perf_counter()
+        try:
+            await handler(self, request)
+        except asyncio.CancelledError:
+            log(self.id, "cancelled a request for " + request.cmd)
+        except Exception as e:
+            self.failed(request, e)
+        finally:
+            commandTimes.add(request.cmd, time.perf_counter() - start)
+            if request.id is not None and self.requests.get(request.id) is asyncio.current_task():
+                del self.requests[request.id]
+
+    def failed(self, request, error):
+        self.reply(request, "Error", str(error))
+        log(self.id, "failed to handle {}: {!r}".format(request.cmd, error))
+
+    def reply(self, request, name, payload=None):
+        '''
+            Send a reply to a request: an envelope with the request's id, a binary message for Trajectories when the
+            client asked for those, or the old text format for legacy requests.
+        '''
+        if self.ws_connection is None:
+            return
+
+        if isinstance(payload, Trajectories):
+            if self.binary:
+                fields = dict(payload.fields)
+                if request.id is not None:
+                    fields['id'] = request.id
+                self.write_message(trajectory_file.encode_message(name, payload.trajectories, self.binaryDtype,
+                                                                  **fields), binary=True)
                 return
-
-            if clientPin == pin:
-                self.verified = True
-                self.write_message("Verified")
-                log(self.id, "entered correct pin")
+            payload = dict(payload.fields, **{key: segments.to_dict()
+                                              for key, segments in payload.trajectories.items()})
+
+        if request.legacy:
+            if isinstance(payload, dict) and request.id is not None:
+                payload = dict(payload, id=request.id)
+            formatReply = LEGACY_REPLIES.get(name)
+            if formatReply is not None:
+                self.write_message(formatReply(payload))
             else:
-                self.write_message("WrongPin")
-                log(self.id, "entered wrong pin")
-
+                self.write_message(name + (json.dumps(payload) if payload is not None else ""))
         else:
-            cmd = "GetConfig"
-            if message[:len(cmd)] == cmd:
-                if not os.path.exists(configFilepath):
-                    self.write_message("{}")
-                    log(self.id, "no file, sending an empty object")
-                else:
-                    with open(configFilepath, 'r') as jsonFile:
-                        jsonData = jsonFile.read().replace('\n', '')
-                        self.write_message("RobotConfig" + jsonData)
-                        log(self.id, "requested robot config")
-                return
-
-            cmd = "PostConfig"
-            if message[:len(cmd)] == cmd:
-                with open(configFilepath, 'w') as jsonFile:
-                    jsonFile.write(message[len(cmd):])
-                    p.loadConfig(configFilepath, False)
-                    self.write_message("PostedRobotConfig")
-                    log(self.id, "posted robot config")
-                return
-
-            cmd = "GetWaypoints"
-            if message[:len(cmd)] == cmd:
-                pathName = message[len(cmd):]
-                p.loadWaypoints("{}/{}/waypoints.csv".format(pathsFolder, pathName), False)
-                waypointsJson = json.dumps([w.__dict__ for w in p.waypoints]).replace('\n', '')
-                self.write_message("Waypoints" + waypointsJson)
-                log(self.id, "requested waypoints for " + pathName)
-                return
+            self.write_message(json.dumps({'cmd': name, 'id': request.id, 'payload': payload}))
+
+    @command("Verify")
+    def verify(self, request):
+        try:
+            clientPin = int(request.payload['pin'])
+        except (ValueError, TypeError, KeyError):
+            self.reply(request, "Invalid Pin")
+            log(self.id, "entered an invalid pin: " + str(request.payload))
+            return
+
+        if clientPin == pin:
+            self.verified = True
+            self.reply(request, "Verified")
+            log(self.id, "entered correct pin")
+        else:
+            self.reply(request, "WrongPin")
+            log(self.id, "entered wrong pin")
+
+    @command("GetConfig")
+    def getConfig(self, request):
+        config = configCache.get()
+        self.reply(request, "RobotConfig", config)
+        log(self.id, "requested robot config" if config is not None else "no file, sending an empty object")
+
+    @command("PostConfig")
+    def postConfig(self, request):
+        with open(configFilepath, 'w') as jsonFile:
+            json.dump(request.payload, jsonFile)
+        configCache.invalidate()
+        self.loadSessionConfig(request)
+        self.reply(request, "PostedRobotConfig")
+        log(self.id, "posted robot config")
+
+    @command("GetWaypoints")
+    def getWaypoints(self, request):
+        pathName = request.payload['name']
+        self.session.loadWaypoints("{}/{}/waypoints.csv".format(pathsFolder, pathName), False)
+        waypoints = [{'x': w.x, 'y': w.y, 'angle': w.angle} for w in self.session.waypoints]
+        self.reply(request, "Waypoints", waypoints)
+        log(self.id, "requested waypoints for " + pathName)
+
+    @command("PostWaypoints")
+    def postWaypoints(self, request):
+        pathName = request.payload["name"]
+        waypoints = request.payload["waypoints"]
+
+        filename = "{}/{}/waypoints.csv".format(pathsFolder, pathName)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with open(filename, "w") as f:
+            f.write("x,y,theta\n")
+            for w in waypoints:
+                f.write("{},{},{}\n".format(w['x'], w['y'], w['r']))
+        if not request.legacy:
+            self.reply(request, "PostedWaypoints")
+        log(self.id, "posted waypoints for " + pathName)
+
+    @command("GetTrajectories")
+    async def getTrajectories(self, request):
+        '''
+            payload: {"waypoints": [...], "stream": chunk size (optional), "latest": true (optional)}
+            With latest (always, for legacy requests) any older trajectory request from this client is cancelled, so
+            only the newest is answered.
+        '''
+        data = request.payload
+        if data.get('id') is not None and request.id is None:
+            request.id = data['id']
+        if request.legacy or data.get('latest'):
+            self.cancelPendingTrajectories()
+            self.pendingTrajectories = asyncio.current_task()
+
+        waypoints = parseWaypoints(data['waypoints'])
+        if data.get('stream'):
+            await self.streamTrajectory(request, waypoints, int(data['stream']))
+            return
+
+        if not self.loadSessionConfig(request):
+            return
+        try:
+            with profiler.stage('GetTrajectories'):
+                trajectories = await self.runGeneration(waypoints)
+        except Exception as e:
+            self.reply(request, "TrajectoryError", str(e))
+            log(self.id, "failed to generate trajectories: " + repr(e))
+            return
+
+        self.reply(request, "Trajectories", Trajectories(trajectories))
+        log(self.id, "request for trajectories")
+
+    @command("Cancel")
+    def cancel(self, request):
+        task = self.requests.get(request.payload['id'])
+        if task is not None:
+            task.cancel()
+        self.reply(request, "Cancelled", {'id': request.payload['id'], 'found': task is not None})
+
+    @command("SetProtocol")
+    def setProtocol(self, request):
+        # {"binary": true or false, "precision": 32 or 64 (optional)}
+        data = request.payload
+        self.binary = bool(data.get('binary', self.binary))
+        self.binaryDtype = PRECISIONS.get(int(data.get('precision', 32)), np.float32)
+        protocol = {'binary': self.binary, 'precision': np.dtype(self.binaryDtype).itemsize * 8}
+        self.reply(request, "Protocol", protocol)
+        log(self.id, "set protocol to " + ("binary" if self.binary else "text"))
+
+    @command("GetStats")
+    def getStats(self, request):
+        stats = {'enabled': profiler.enabled, 'stages': profiler.stats(), 'commands': commandTimes.stats()}
+        self.reply(request, "Stats", stats)
+        log(self.id, "requested stats")
+
+    @command("SavePath")
+    async def savePath(self, request):
+        pathName = request.payload['pathName']
+        if not self.loadSessionConfig(request):
+            return
+
+        try:
+            await self.runGeneration(parseWaypoints(request.payload['waypoints']),
+                                     "{}/{}".format(pathsFolder, pathName))
+        except Exception as e:
+            self.reply(request, "TrajectoryError", str(e))
+            log(self.id, "failed to save path {}: {!r}".format(pathName, e))
+            return
+        if not request.legacy:
+            self.reply(request, "SavedPath", {'pathName': pathName})
+        log(self.id, "saved path " + pathName)
+
+    def loadSessionConfig(self, request):
+        '''
+            Refresh this session's config from the shared config cache, in case the config file has changed.
+            :return whether there is a config
+        '''
+        config = configCache.get()
+        if config is None:
+            self.reply(request, "NoRobotConfig")
+            log(self.id, "no robot config to generate with")
+            return False
+        self.session.applyConfig(config)
+        return True
 
-            cmd = "PostWaypoints"
-            if message[:len(cmd)] == cmd:
-                data = json.loads(message[len(cmd):])
-                pathName = data["name"]
-                waypoints = data["waypoints"]
-
-                filename = "{}/{}/waypoints.csv".format(pathsFolder, pathName)
-                os.makedirs(os.path.dirname(filename), exist_ok=True)
-                with open(filename, "w") as f:
-                    f.write("x,y,theta\n")
-                    for w in waypoints:
-                        f.write("{},{},{}\n".format(w['x'], w['y'], w['r']))
-                log(self.id, "posted waypoints for " + pathName)
-
-            cmd = "GetTrajectories"
-            if message[:len(cmd)] == cmd:
-                waypointsJson = message[len(cmd):]
-                p.waypoints = json.loads(waypointsJson)
-                response = dict()
-                p.generateTrajectory()
-                response['trajectory'] = p.segments
-                if p.drivebaseType == DrivebaseType.TANK:
-                    p.generateTankTrajectory()
-                    response['tank_left_trajectory'] = p.tank_left_segments
-                    response['tank_right_trajectory'] = p.tank_right_segments
-                elif p.drivebaseType == DrivebaseType.SWERVE:
-                    p.generateSwerveTrajectory()
-                    response['swerve_front_left_trajectory'] = p.swerve_front_left_segments
-                    response['swerve_front_right_trajectory'] = p.swerve_front_right_segments
-                    response['swerve_back_left_trajectory'] = p.swerve_back_left_segments
-                    response['swerve_back_right_trajectory'] = p.swerve_back_right_segments
-                else:
-                    print("Unknown Database Type")
-
-                self.write_message("Trajectories:" + json.dumps(response).replace('\n', ''))
-                log(self.id, "request for trajectories")
+    async def runGeneration(self, waypoints, folder=None):
+        '''
+            Generate from this connection's session in the process pool.
+        '''
+        s = self.session
+        s.waypoints = waypoints
+        trajectories, stats = await asyncio.get_running_loop().run_in_executor(
+            executor, generateTrajectories, waypoints, s.trajectoryConfig, s.splineType, s.drivebaseType,
+            s.wheelbaseWidth, s.wheelbaseLength, folder, profiler.enabled)
+        profiler.merge(stats)
+        return trajectories
+
+    def cancelPendingTrajectories(self):
+        # Only the newest request from a client is answered
+        if self.pendingTrajectories is not None and not self.pendingTrajectories.done():
+            self.pendingTrajectories.cancel()
+            log(self.id, "cancelled an older request for trajectories")
+
+    async def streamTrajectory(self, request, waypoints, chunkSize):
+        '''
+            Send the center trajectory while it is generated, as TrajectoryChunk replies followed by TrajectoryDone.
+            Each chunk is computed on a worker thread, so the IOLoop is free in between.
+        '''
+        if not self.loadSessionConfig(request):
+            return
+
+        s = self.session
+        loop = asyncio.get_running_loop()
+        # A generator of its own, since a cancelled stream's thread may still be using the last one
+        generator = await loop.run_in_executor(None, TrajectoryGenerator, waypoints, s.trajectoryConfig,
+                                               s.splineType)
+        chunks = generator.generate_chunks(chunkSize)
+
+        index = 0
+        while True:
+            segments = await loop.run_in_executor(None, next, chunks, None)
+            if segments is None:
+                break
+            if self.ws_connection is None:
                 return
+            self.reply(request, "TrajectoryChunk", Trajectories({'trajectory': segments}, index=index))
+            index += 1
 
-            cmd = "SavePath"
-            if message[:len(cmd)] == cmd:
-                messageJson = json.loads(message[len(cmd):])
-                p.waypoints = messageJson['waypoints']
-                p.setFolder("{}/{}".format(pathsFolder, messageJson['pathName']))
-                p.saveWaypoints()
-                p.writeTrajectory()
-                if p.drivebaseType == DrivebaseType.TANK:
-                    p.writeTankTrajectory()
-                elif p.drivebaseType == DrivebaseType.SWERVE:
-                    p.writeSwerveTrajectory()
-                else:
-                    print("Unknown Drivebase Type")
-
-                return
+        self.reply(request, "TrajectoryDone", {'chunks': index})
+        log(self.id, "streamed trajectory in {:d} chunks".format(index))
 
     def on_close(self):
+        for task in list(self.requests.values()):
+            task.cancel()
         clients.remove(self)
         log(self.id, "disconnected")
 
@@ -175,6 +561,18 @@ def sigInt_handler(signum, frame):
     sys.exit(0)
 
 if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--workers", type=int, default=None,
+                    help="Number of processes used to generate trajectories (defaults to the number of CPUs)")
+    ap.add_argument("--profile", action="store_true", help="Time each stage of generation, reported by GetStats")
+    ap.add_argument("--compression-level", type=int, default=6,
+                    help="zlib level for permessage-deflate, 0 to turn compression off")
+    args = ap.parse_args()
+    compressionOptions = {'compression_level': args.compression_level} if args.compression_level > 0 else None
+    executor = ProcessPoolExecutor(max_workers=args.workers)
+    if args.profile:
+        profiler = Profiler()
+
     app = make_app()
     app.listen(port)
     signal.signal(signal.SIGINT, sigInt_handler)
@@ -1,7 +1,9 @@
 import math
-from mathutil import bound_radians
+import numpy as np
+from mathutil import bound_radians, bound_radians_array
 from enum import Enum
 from structs.spline import Spline
+from structs.spline_array import SplineArray
 
 
 class FitType(Enum):
@@ -30,6 +32,7 @@ class SplineGenerator:
         s.c = (a0_delta + a1_delta) / (s.knot_distance * s.knot_distance)
         s.d = -(2 * a0_delta + a1_delta) / s.knot_distance
         s.e = a0_delta
+        s.precompute()
 
         return s
 
@@ -46,6 +49,7 @@ class SplineGenerator:
         s.c = -(6 * a0_delta + 4 * a1_delta) / (d * d)
         s.d = 0
         s.e = a0_delta
+        s.precompute()
 
         return s
 
@@ -58,3 +62,30 @@ class SplineGenerator:
         s.knot_distance = delta
         s.angle_offset = math.atan2(b.y - a.y, b.x - a.x)
         return s
+
+    def fit_arrays(self, x0, y0, angle0, x1, y1, angle1):
+        '''
+            Fit many splines at once, spline i going from (x0[i], y0[i]) at angle0[i] to (x1[i], y1[i]) at angle1[i].
+            :return a SplineArray of the fits
+        '''
+        s = SplineArray(len(x0))
+        s.x_offset = x0
+        s.y_offset = y0
+        s.knot_distance = np.sqrt((x1 - x0) * (x1 - x0) + (y1 - y0) * (y1 - y0))
+        s.angle_offset = np.arctan2(y1 - y0, x1 - x0)
+
+        a0_delta = np.tan(bound_radians_array(angle0 - s.angle_offset))
+        a1_delta = np.tan(bound_radians_array(angle1 - s.angle_offset))
+        d = s.knot_distance
+
+        if self.fit_type == FitType.CUBIC:
+            s.c = (a0_delta + a1_delta) / (d * d)
+            s.d = -(2 * a0_delta + a1_delta) / d
+        elif self.fit_type == FitType.QUINTIC:
+            s.a = -(3 * (a0_delta + a1_delta)) / (d * d * d * d)
+            s.b = (8 * a0_delta + 7 * a1_delta) / (d * d * d)
+            s.c = -(6 * a0_delta + 4 * a1_delta) / (d * d)
+        s.e = a0_delta
+        s.precompute()
+
+        return s
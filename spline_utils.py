@@ -1,6 +1,15 @@
 import math
+import numpy as np
 from structs.coord import Coord
-from mathutil import bound_radians
+from mathutil import bound_radians, bound_radians_array
+
+# Nodes and weights of the Gauss-Legendre rule used for adaptive arc length integration, on [-1, 1]
+GAUSS_NODES, GAUSS_WEIGHTS = np.polynomial.legendre.leggauss(5)
+# Limits on the interval halvings of the adaptive integration and the Newton steps of its distance inversion
+MAX_SUBDIVISIONS = 30
+MAX_NEWTON_ITERATIONS = 16
+# Number of samples get_arc_length_many works on at a time
+MANY_BLOCK_SIZE = 1 << 14
 
 
 class SplineUtils:
@@ -9,15 +18,12 @@ class SplineUtils:
         x = percentage * s.knot_distance
         y = (s.a * x + s.b) * (x * x * x * x) + (s.c * x + s.d) * (x * x) + s.e * x
 
-        cos_theta = math.cos(s.angle_offset)
-        sin_theta = math.sin(s.angle_offset)
-
-        c = Coord(x * cos_theta - y * sin_theta + s.x_offset, x * sin_theta + y * cos_theta + s.y_offset)
+        c = Coord(x * s.cos_angle - y * s.sin_angle + s.x_offset, x * s.sin_angle + y * s.cos_angle + s.y_offset)
         return c
 
     def get_deriv(self, s, percentage):
         x = percentage * s.knot_distance
-        return (5 * s.a * x + 4 * s.b) * (x * x * x) + (3 * s.c * x + 2 * s.d) * x + s.e
+        return (s.da * x + s.db) * (x * x * x) + (s.dc * x + s.dd) * x + s.e
 
     def get_deriv_2(self, a, b, c, d, e, k, p):
         x = p * k
@@ -26,68 +32,225 @@ class SplineUtils:
     def get_angle(self, s, percentage):
         return bound_radians(math.atan(self.get_deriv(s, percentage)) + s.angle_offset)
 
+    # Batched versions of the functions above. They take an array of percentages and evaluate every element in one
+    # numpy pass.
+
+    def get_coords_array(self, s, percentages):
+        x = np.clip(percentages, 0, 1) * s.knot_distance
+        y = (s.a * x + s.b) * (x * x * x * x) + (s.c * x + s.d) * (x * x) + s.e * x
+
+        return x * s.cos_angle - y * s.sin_angle + s.x_offset, x * s.sin_angle + y * s.cos_angle + s.y_offset
+
+    def get_deriv_array(self, s, percentages):
+        x = np.asarray(percentages, dtype=float) * s.knot_distance
+        return (s.da * x + s.db) * (x * x * x) + (s.dc * x + s.dd) * x + s.e
+
+    def get_angle_array(self, s, percentages):
+        return bound_radians_array(np.arctan(self.get_deriv_array(s, percentages)) + s.angle_offset)
+
+    def get_curvature_array(self, s, percentages):
+        '''
+            :return the signed curvature (1 / turning radius, positive turning left) of the spline at each percentage
+        '''
+        x = np.asarray(percentages, dtype=float) * s.knot_distance
+        dydx = (s.da * x + s.db) * (x * x * x) + (s.dc * x + s.dd) * x + s.e
+        d2ydx2 = ((4 * s.da * x + 3 * s.db) * x + 2 * s.dc) * x + s.dd
+        return d2ydx2 / (1 + dydx * dydx) ** 1.5
+
+    def get_arc_length_integrand_array(self, s, percentages):
+        dydt = self.get_deriv_array(s, percentages)
+        return np.sqrt(1 + dydt * dydt)
+
     def get_arc_length(self, s, sample_count):
         sample_count_d = float(sample_count)
-        a = s.a
-        b = s.b
-        c = s.c
-        d = s.d
-        e = s.e
-        knot = s.knot_distance
-
-        arc_length = 0.0
-        t = 0.0
-        dydt = 0.0
-
-        deriv0 = self.get_deriv_2(a, b, c, d, e, knot, 0)
-
-        integrand = 0.0
-        last_integrand = math.sqrt(1 + deriv0 * deriv0) / sample_count_d
-
-        for i in range(sample_count + 1):
-            t = i / sample_count_d
-            dydt = self.get_deriv_2(a, b, c, d, e, knot, t)
-            integrand = math.sqrt(1 + dydt * dydt) / sample_count_d
-            arc_length = arc_length + (integrand + last_integrand) / 2
-            last_integrand = integrand
-        al = knot * arc_length
+
+        t = np.arange(sample_count + 1) / sample_count_d
+        integrand = self.get_arc_length_integrand_array(s, t) / sample_count_d
+        last_integrand = np.concatenate((integrand[:1], integrand[:-1]))
+
+        # Keep every partial sum so that distance lookups don't have to integrate again
+        table = np.cumsum((integrand + last_integrand) / 2)
+
+        al = s.knot_distance * float(table[-1])
         s.arc_length = al
+        s.arc_length_table = table
         return al
 
     def get_progress_for_distance(self, s, distance, sample_count):
+        '''
+            Find the percentage along the spline at which the given arc length distance is reached.
+
+            Uses the cumulative arc length table built by get_arc_length (which is built here if missing or if it
+            was built with a different sample count). The table holds the exact partial sums the trapezoid
+            integration produces, so the result is identical to integrating from t=0 for every lookup.
+        '''
+        return float(self.get_progress_for_distance_array(s, distance, sample_count))
+
+    def get_progress_for_distance_array(self, s, distances, sample_count):
+        table = s.arc_length_table
+        if table is None or len(table) != sample_count + 1:
+            self.get_arc_length(s, sample_count)
+            table = s.arc_length_table
+
+        distances = np.asarray(distances, dtype=float) / s.knot_distance
+
+        # First sample whose partial sum passes the distance
+        i = np.searchsorted(table, distances, side='right')
+        return self.interpolate_progress(table.__getitem__, i, distances, sample_count)
+
+    def interpolate_progress(self, lookup, i, distances, sample_count):
+        '''
+            Interpolate the percentage at which each distance (divided by the knot distance) is reached, given the
+            index i of the first sample of its arc length table that passes it. lookup(indices) reads the table.
+        '''
         sample_count_d = float(sample_count)
+        past_end = i > sample_count
+        i = np.minimum(i, sample_count)
+
+        t = i / sample_count_d
+        arc_length = lookup(i)
+        last_arc_length = np.where(i > 0, lookup(np.maximum(i - 1, 0)), 0.0)
 
-        a = s.a
-        b = s.b
-        c = s.c
-        d = s.d
-        e = s.e
-        knot = s.knot_distance
+        step = arc_length - last_arc_length
+        interpolated = np.where(step != 0,
+                                t + ((distances - last_arc_length) / np.where(step != 0, step, 1.0) - 1) /
+                                sample_count_d,
+                                t)
+        return np.where(past_end, 1.0, interpolated)
 
-        arc_length = 0.0
-        t = 0.0
-        dydt = 0.0
-        last_arc_length = 0.0
+    # Versions of get_arc_length and get_progress_for_distance for a SplineArray, which keep one arc length table
+    # per spline as the rows of a 2D array.
+
+    def get_arc_length_many(self, splines, sample_count):
+        '''
+            Integrate the arc length of every spline in a SplineArray, the same way get_arc_length does.
+            :return the arc length tables, one row per spline
+        '''
+        sample_count_d = float(sample_count)
 
-        deriv0 = self.get_deriv_2(a, b, c, d, e, knot, 0)
+        t = np.arange(sample_count + 1) / sample_count_d
+        tables = np.empty((len(splines), sample_count + 1))
+        # A few splines at a time, so the temporaries stay small enough to be cache friendly
+        block = max(1, MANY_BLOCK_SIZE // (sample_count + 1))
+        for start in range(0, len(splines), block):
+            rows = slice(start, start + block)
+            integrand = self.get_arc_length_integrand_array(splines.take(rows).broadcast(), t) / sample_count_d
+            last_integrand = np.concatenate((integrand[:, :1], integrand[:, :-1]), axis=1)
+            np.cumsum((integrand + last_integrand) / 2, axis=1, out=tables[rows])
 
-        integrand = 0
-        last_integrand = math.sqrt(1 + deriv0 * deriv0) / sample_count_d
+        splines.arc_length = splines.knot_distance * tables[:, -1]
+        return tables
 
-        distance = distance / knot
+    def get_progress_for_distance_many(self, splines, tables, spline_i, distances, sample_count):
+        '''
+            get_progress_for_distance_array for distances along many splines: distance j is along spline spline_i[j]
+            of splines, whose arc length tables (from get_arc_length_many) are the rows of tables.
+        '''
+        distances = np.asarray(distances, dtype=float) / splines.knot_distance[spline_i]
 
-        for i in range(sample_count + 1):
-            t = i / sample_count_d
-            dydt = self.get_deriv_2(a, b, c, d, e, knot, t)
-            integrand = math.sqrt(1 + dydt * dydt) / sample_count_d
-            arc_length = arc_length + (integrand + last_integrand) / 2
-            if arc_length > distance:
+        # Binary search every row at once for the first sample whose partial sum passes the distance
+        low = np.zeros(len(distances), dtype=np.intp)
+        high = np.full(len(distances), sample_count + 1, dtype=np.intp)
+        while True:
+            searching = low < high
+            if not searching.any():
                 break
-            last_integrand = integrand
-            last_arc_length = arc_length
-
-        interpolated = t
-        if arc_length != last_arc_length:
-            interpolated = interpolated + ((distance - last_arc_length) /
-                                           (arc_length - last_arc_length) - 1) / sample_count_d
-        return interpolated
+            middle = (low + high) // 2
+            passed = tables[spline_i, np.minimum(middle, sample_count)] > distances
+            high = np.where(searching & passed, middle, high)
+            low = np.where(searching & ~passed, middle + 1, low)
+
+        return self.interpolate_progress(lambda i: tables[spline_i, i], low, distances, sample_count)
+
+    # Adaptive versions of get_arc_length and get_progress_for_distance. Instead of a fixed number of trapezoid
+    # samples they are driven by a tolerance on the arc length, in the same units as the path.
+
+    def get_arc_length_between(self, s, t0, t1):
+        '''
+            Gauss-Legendre estimate of the arc length from percentage t0 to t1 (arrays, element by element).
+        '''
+        t0 = np.asarray(t0, dtype=float)
+        t1 = np.asarray(t1, dtype=float)
+        half = (t1 - t0) / 2
+        t = (t0 + half)[..., np.newaxis] + half[..., np.newaxis] * GAUSS_NODES
+        return s.knot_distance * half * (self.get_arc_length_integrand_array(s, t) @ GAUSS_WEIGHTS)
+
+    def get_arc_length_adaptive(self, s, tolerance):
+        '''
+            Integrate the arc length by adaptive Gauss-Legendre quadrature. An interval is halved until the rule on
+            its two halves agrees with the rule on the whole to within its share of the tolerance, so gentle splines
+            need a handful of evaluations and only tight bends get subdivided.
+
+            The accepted intervals are kept in s.arc_length_intervals (start and end percentages and the arc length
+            up to the start of each) for get_progress_for_distance_adaptive.
+        '''
+        starts = np.zeros(1)
+        ends = np.ones(1)
+        lengths = self.get_arc_length_between(s, starts, ends)
+        accepted_starts, accepted_ends, accepted_lengths = [], [], []
+
+        for depth in range(MAX_SUBDIVISIONS + 1):
+            middles = (starts + ends) / 2
+            left = self.get_arc_length_between(s, starts, middles)
+            right = self.get_arc_length_between(s, middles, ends)
+            done = (np.abs(left + right - lengths) <= tolerance * (ends - starts)) | (depth == MAX_SUBDIVISIONS)
+
+            accepted_starts.extend((starts[done], middles[done]))
+            accepted_ends.extend((middles[done], ends[done]))
+            accepted_lengths.extend((left[done], right[done]))
+
+            if done.all():
+                break
+            starts = np.concatenate((starts[~done], middles[~done]))
+            ends = np.concatenate((middles[~done], ends[~done]))
+            lengths = np.concatenate((left[~done], right[~done]))
+
+        starts = np.concatenate(accepted_starts)
+        order = np.argsort(starts)
+        starts = starts[order]
+        ends = np.concatenate(accepted_ends)[order]
+        lengths = np.concatenate(accepted_lengths)[order]
+        cumulative = np.concatenate(([0.0], np.cumsum(lengths)))
+
+        al = float(cumulative[-1])
+        s.arc_length = al
+        s.arc_length_intervals = (starts, ends, cumulative[:-1])
+        return al
+
+    def get_progress_for_distance_adaptive(self, s, distance, tolerance):
+        return float(self.get_progress_for_distance_adaptive_array(s, distance, tolerance))
+
+    def get_progress_for_distance_adaptive_array(self, s, distances, tolerance):
+        '''
+            Find the percentage along the spline at which each arc length distance is reached, by Newton's method
+            on the arc length (whose derivative is the integrand, which never drops below knot_distance). The
+            interval found in the adaptive integration table gives the starting guess and bounds the steps.
+        '''
+        if s.arc_length_intervals is None:
+            self.get_arc_length_adaptive(s, tolerance)
+        starts, ends, cumulative = s.arc_length_intervals
+
+        distances = np.asarray(distances, dtype=float)
+        shape = distances.shape
+        distances = distances.ravel()
+        past_end = distances >= s.arc_length
+        distances = np.clip(distances, 0.0, s.arc_length)
+
+        i = np.maximum(np.searchsorted(cumulative, distances, side='right') - 1, 0)
+        t0, t1, base = starts[i], ends[i], cumulative[i]
+        interval_length = np.append(cumulative[1:], s.arc_length)[i] - base
+        t = t0 + (t1 - t0) * (distances - base) / np.where(interval_length > 0, interval_length, 1.0)
+
+        # Each distance stops at its own first estimate within tolerance, so its result doesn't depend on which
+        # other distances it is solved together with
+        pending = np.arange(len(t))
+        for _ in range(MAX_NEWTON_ITERATIONS):
+            error = base[pending] + self.get_arc_length_between(s, t0[pending], t[pending]) - distances[pending]
+            unconverged = np.abs(error) > tolerance
+            pending, error = pending[unconverged], error[unconverged]
+            if len(pending) == 0:
+                break
+            step = error / (s.knot_distance * self.get_arc_length_integrand_array(s, t[pending]))
+            t[pending] = np.clip(t[pending] - step, t0[pending], t1[pending])
+
+        return np.where(past_end, 1.0, t).reshape(shape)
@@ -1,4 +1,6 @@
 class Segment:
+    __slots__ = ('dt', 'x', 'y', 'displacement', 'velocity', 'acceleration', 'jerk', 'heading')
+
     def __init__(self, dt, x, y, displacement, velocity, acceleration, jerk, heading):
         self.dt = dt
         self.x = x
@@ -8,3 +10,7 @@ class Segment:
         self.acceleration = acceleration
         self.jerk = jerk
         self.heading = heading
+
+    @property
+    def position(self):
+        return self.displacement
@@ -0,0 +1,211 @@
+import math
+import numpy as np
+from structs.segment import Segment
+from mathutil import bound_radians, bound_radians_array
+
+
+def _column(index):
+    def get(self):
+        return self.data[index]
+
+    def set(self, value):
+        self.data[index] = value
+
+    return property(get, set)
+
+
+def _field(index):
+    def get(self):
+        return float(self.array.data[index, self.index])
+
+    def set(self, value):
+        self.array.data[index, self.index] = value
+
+    return property(get, set)
+
+
+class SegmentView:
+    '''
+        A single row of a SegmentArray. Reads and writes go straight to the array's columns, so views are cheap to
+        create and behave like a Segment.
+    '''
+    __slots__ = ('array', 'index')
+
+    def __init__(self, array, index):
+        self.array = array
+        self.index = index
+
+    dt = _field(0)
+    x = _field(1)
+    y = _field(2)
+    displacement = _field(3)
+    velocity = _field(4)
+    acceleration = _field(5)
+    jerk = _field(6)
+    heading = _field(7)
+    position = displacement
+
+    def to_segment(self):
+        return Segment(*self.array.data[:, self.index].tolist())
+
+
+class SegmentArray:
+    '''
+        A trajectory stored as contiguous float64 columns (one per Segment field) instead of a list of Segments.
+
+        Whole columns are read and written as numpy arrays (e.g. segments.x), while indexing gives a SegmentView of
+        one row, so code written against lists of Segments (like the followers) keeps working.
+    '''
+    fieldnames = ['dt', 'x', 'y', 'displacement', 'velocity', 'acceleration', 'jerk', 'heading']
+
+    def __init__(self, length=0, dt=0.0, data=None):
+        if data is None:
+            data = np.zeros((len(self.fieldnames), length))
+            data[0] = dt
+        self.data = data
+
+    dt = _column(0)
+    x = _column(1)
+    y = _column(2)
+    displacement = _column(3)
+    velocity = _column(4)
+    acceleration = _column(5)
+    jerk = _column(6)
+    heading = _column(7)
+    position = displacement
+
+    @classmethod
+    def from_segments(cls, segments):
+        data = np.array([[seg.dt, seg.x, seg.y, seg.displacement, seg.velocity, seg.acceleration, seg.jerk,
+                          seg.heading] for seg in segments], dtype=float).reshape(-1, len(cls.fieldnames))
+        return cls(data=np.ascontiguousarray(data.T))
+
+    @classmethod
+    def concatenate(cls, arrays, dt=0.0):
+        '''
+            Join SegmentArrays end to end. dt is only used for the (empty) result when there are none to join.
+        '''
+        if len(arrays) == 0:
+            return cls(0, dt)
+        return cls(data=np.concatenate([array.data for array in arrays], axis=1))
+
+    def __len__(self):
+        return self.data.shape[1]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return SegmentArray(data=self.data[:, index])
+
+        length = len(self)
+        if index < 0:
+            index += length
+        if index < 0 or index >= length:
+            raise IndexError("segment index out of range")
+        return SegmentView(self, index)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield SegmentView(self, i)
+
+    def copy(self):
+        return SegmentArray(data=self.data.copy())
+
+    def rows(self):
+        '''
+            :return the segments as lists of floats in fieldnames order, e.g. for csv.writer
+        '''
+        return self.data.T.tolist()
+
+    def to_segments(self):
+        return [Segment(*row) for row in self.rows()]
+
+    def to_dict(self):
+        '''
+            :return a dict of column name to list of floats, suitable for json
+        '''
+        return {name: column.tolist() for name, column in zip(self.fieldnames, self.data)}
+
+
+class TimeIndex:
+    '''
+        Looks segments of a trajectory up by the time since its start (segment i is at the sum of the dt of the
+        segments before it, so the first is at 0), interpolating between neighbouring segments.
+
+        With the same dt throughout, which is how trajectories are planned, a lookup is a division; otherwise it is a
+        binary search of the segment times, which are worked out once here.
+    '''
+    def __init__(self, segments):
+        if not isinstance(segments, SegmentArray):
+            segments = SegmentArray.from_segments(segments)
+        self.segments = segments
+
+        dt = segments.dt
+        if len(segments) > 0 and dt[0] > 0 and np.all(dt == dt[0]):
+            self.step = float(dt[0])
+            self.times = None
+            self.end = self.step * (len(segments) - 1)
+        else:
+            self.step = None
+            self.times = np.concatenate(([0.0], np.cumsum(dt[:-1])))
+            self.end = float(self.times[-1]) if len(segments) > 0 else 0.0
+
+    def __len__(self):
+        return len(self.segments)
+
+    def locate(self, times):
+        '''
+            :return for each time, the index of the last segment at or before it and how far (0 to 1) the time is
+                towards the next segment. Times outside the trajectory are clamped to its first or last segment
+        '''
+        times = np.clip(np.asarray(times, dtype=float), 0.0, self.end)
+        if self.step is not None:
+            position = times / self.step
+            index = np.minimum(position.astype(np.intp), len(self) - 1)
+            return index, np.where(index < len(self) - 1, position - index, 0.0)
+
+        index = np.maximum(np.searchsorted(self.times, times, side='right') - 1, 0)
+        following = np.minimum(index + 1, len(self) - 1)
+        span = self.times[following] - self.times[index]
+        return index, np.where(span > 0, (times - self.times[index]) / np.where(span > 0, span, 1.0), 0.0)
+
+    def interpolate(self, times):
+        '''
+            :return a SegmentArray of the trajectory at each of the given times (dt is that of the segment before)
+        '''
+        index, fraction = self.locate(times)
+        data = self.segments.data
+        current = data[:, index]
+        following = data[:, np.minimum(index + 1, len(self) - 1)]
+
+        result = current + (following - current) * fraction
+        result[0] = current[0]
+        # Headings go the short way round
+        turn = np.fmod(following[7] - current[7] + 3 * math.pi, 2 * math.pi) - math.pi
+        result[7] = bound_radians_array(current[7] + turn * fraction)
+        return SegmentArray(data=result)
+
+    def lookup(self, time):
+        '''
+            interpolate for a single time, in plain floats so it's quick enough to call every control loop.
+            :return the index locate gives and the Segment at the time
+        '''
+        time = min(max(float(time), 0.0), self.end)
+        if self.step is not None:
+            position = time / self.step
+            index = min(int(position), len(self) - 1)
+            fraction = position - index
+        else:
+            index = max(int(np.searchsorted(self.times, time, side='right')) - 1, 0)
+            span = float(self.times[index + 1] - self.times[index]) if index < len(self) - 1 else 0.0
+            fraction = (time - float(self.times[index])) / span if span > 0 else 0.0
+
+        current = self.segments.data[:, index].tolist()
+        if index == len(self) - 1:
+            return index, Segment(*current)
+        following = self.segments.data[:, index + 1].tolist()
+
+        row = [c + (f - c) * fraction for c, f in zip(current, following)]
+        row[0] = current[0]
+        turn = math.fmod(following[7] - current[7] + 3 * math.pi, 2 * math.pi) - math.pi
+        row[7] = bound_radians(current[7] + turn * fraction)
+        return index, Segment(*row)
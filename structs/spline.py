@@ -1,4 +1,10 @@
+import math
+
+
 class Spline:
+    __slots__ = ('a', 'b', 'c', 'd', 'e', 'x_offset', 'y_offset', 'angle_offset', 'knot_distance', 'arc_length',
+                 'arc_length_table', 'arc_length_intervals', 'cos_angle', 'sin_angle', 'da', 'db', 'dc', 'dd')
+
     def __init__(self):
         self.a = 0.0
         self.b = 0.0
@@ -10,3 +16,19 @@ class Spline:
         self.angle_offset = 0.0
         self.knot_distance = 0.0
         self.arc_length = 0.0
+        self.arc_length_table = None
+        self.arc_length_intervals = None
+        self.precompute()
+
+    def precompute(self):
+        '''
+            Work out the values every evaluation of the spline needs: the rotation by angle_offset and the
+            coefficients of the derivative polynomial, (da * x + db) * x^3 + (dc * x + dd) * x + e.
+            Call again after changing the coefficients or angle_offset.
+        '''
+        self.cos_angle = math.cos(self.angle_offset)
+        self.sin_angle = math.sin(self.angle_offset)
+        self.da = 5 * self.a
+        self.db = 4 * self.b
+        self.dc = 3 * self.c
+        self.dd = 2 * self.d
@@ -0,0 +1,84 @@
+import numpy as np
+from structs.spline import Spline
+
+
+def _column(index):
+    def get(self):
+        return self.data[index]
+
+    def set(self, value):
+        self.data[index] = value
+
+    return property(get, set)
+
+
+class SplineArray:
+    '''
+        Many splines stored as float64 columns (one per Spline field), so they can be fitted and evaluated together.
+
+        Every field reads as an array with one element per spline, so the SplineUtils array functions accept a
+        SplineArray in place of a Spline. broadcast() gives a view whose fields are (count, 1) columns, for
+        evaluating every spline at the same percentages at once.
+    '''
+    fieldnames = ['a', 'b', 'c', 'd', 'e', 'x_offset', 'y_offset', 'angle_offset', 'knot_distance', 'arc_length',
+                  'cos_angle', 'sin_angle', 'da', 'db', 'dc', 'dd']
+
+    def __init__(self, length=0, data=None):
+        if data is None:
+            data = np.zeros((len(self.fieldnames), length))
+        self.data = data
+
+    a = _column(0)
+    b = _column(1)
+    c = _column(2)
+    d = _column(3)
+    e = _column(4)
+    x_offset = _column(5)
+    y_offset = _column(6)
+    angle_offset = _column(7)
+    knot_distance = _column(8)
+    arc_length = _column(9)
+    cos_angle = _column(10)
+    sin_angle = _column(11)
+    da = _column(12)
+    db = _column(13)
+    dc = _column(14)
+    dd = _column(15)
+
+    @classmethod
+    def from_splines(cls, splines):
+        data = np.array([[getattr(s, name) for name in cls.fieldnames] for s in splines],
+                        dtype=float).reshape(-1, len(cls.fieldnames))
+        return cls(data=np.ascontiguousarray(data.T))
+
+    def __len__(self):
+        return self.data.shape[1]
+
+    def precompute(self):
+        '''
+            Same as Spline.precompute, for every spline.
+        '''
+        self.cos_angle = np.cos(self.angle_offset)
+        self.sin_angle = np.sin(self.angle_offset)
+        self.da = 5 * self.a
+        self.db = 4 * self.b
+        self.dc = 3 * self.c
+        self.dd = 2 * self.d
+
+    def take(self, indices):
+        '''
+            :return a SplineArray of the splines at the given indices (repeats allowed), e.g. one per sample
+        '''
+        return SplineArray(data=self.data[:, indices])
+
+    def broadcast(self):
+        return SplineArray(data=self.data[:, :, np.newaxis])
+
+    def to_splines(self):
+        splines = []
+        for row in self.data.T.tolist():
+            s = Spline()
+            for name, value in zip(self.fieldnames, row):
+                setattr(s, name, value)
+            splines.append(s)
+        return splines
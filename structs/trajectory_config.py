@@ -1,3 +1,14 @@
+from enum import Enum
+
+
+class ProfileType(Enum):
+    # TrajectoryPlanner's second order filter. Always starts and ends at rest
+    FILTER = 0
+    # Closed form profiles, from src_v to dest_v: constant acceleration phases, or jerk limited ones
+    TRAPEZOIDAL = 1
+    S_CURVE = 2
+
+
 class TrajectoryConfig:
     def __init__(self):
         self.dt = 0.0
@@ -10,3 +21,11 @@ class TrajectoryConfig:
         self.dest_v = 0.0
         self.dest_theta = 0.0
         self.sample_count = 0
+        # When above zero, arc lengths are integrated adaptively to this tolerance and sample_count is unused
+        self.arc_length_tolerance = 0.0
+        # When above zero, the velocity is lowered on curves to keep the sideways acceleration within max_lateral_a
+        self.max_lateral_a = 0.0
+        # When above zero, the velocity is lowered on curves so the outer wheel of a tank drive this wide stays
+        # within max_v
+        self.wheelbase_width = 0.0
+        self.profile_type = ProfileType.FILTER
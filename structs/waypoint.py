@@ -1,4 +1,6 @@
 class Waypoint:
+    __slots__ = ('x', 'y', 'angle')
+
     def __init__(self, x, y, theta):
         self.x = x
         self.y = y
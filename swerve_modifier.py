@@ -1,44 +1,76 @@
-import copy
+import numpy as np
+from mathutil import bound_radians_array
+from structs.segment_array import SegmentArray
+from profiler import NULL_PROFILER
 
 
 class SwerveModifier:
-    def __init__(self, original, wheelbase_width, wheelbase_depth):
+    '''
+        Turns the trajectory of the robot's center into one trajectory per swerve module.
+
+        The chassis is taken to face along the path (its heading is the segment heading). Each module sits at
+        +/- wheelbase_depth / 2 forward and +/- wheelbase_width / 2 to the left of the center, and its velocity is
+        the chassis velocity plus the heading rate crossed with its offset. The module trajectories have the
+        module's own position, distance travelled, speed, acceleration and jerk, and its heading is the steering
+        angle the module has to point at (field relative, like the path heading).
+    '''
+    def __init__(self, original, wheelbase_width, wheelbase_depth, profiler=NULL_PROFILER):
         self.original = original
         self.wheelbase_width = wheelbase_width
         self.wheelbase_depth = wheelbase_depth
-        self.modify()
+        with profiler.stage('swerve modifier', segments=len(original)):
+            self.modify()
 
     def modify(self):
-        self.front_left = []
-        self.front_right = []
-        self.back_left = []
-        self.back_right = []
-
-        for i in range(len(self.original)):
-            seg = self.original[i]
-            fl = copy.deepcopy(seg)
-            fr = copy.deepcopy(seg)
-            bl = copy.deepcopy(seg)
-            br = copy.deepcopy(seg)
-
-            fl.x = seg.x - self.wheelbase_width / 2
-            fl.y = seg.y + self.wheelbase_depth / 2
-            fr.x = seg.x + self.wheelbase_width / 2
-            fr.y = seg.y + self.wheelbase_depth / 2
-
-            bl.x = seg.x - self.wheelbase_width / 2
-            bl.y = seg.y - self.wheelbase_depth / 2
-            br.x = seg.x + self.wheelbase_width / 2
-            br.y = seg.y - self.wheelbase_depth / 2
-
-            self.front_left.append(fl)
-            self.front_right.append(fr)
-            self.back_left.append(bl)
-            self.back_right.append(br)
+        '''
+            Compute all four modules together. They are stacked in one (4, fields, length) array in front left,
+            front right, back left, back right order, and the trajectories returned are views into it.
+        '''
+        seg = self.original
+        dt = seg.dt
+
+        heading = np.unwrap(seg.heading)
+        cos_heading = np.cos(heading)
+        sin_heading = np.sin(heading)
+        heading_rate = np.gradient(heading) / dt if len(seg) > 1 else np.zeros(len(seg))
+
+        # Module offsets from the center in the robot frame, (forward, left)
+        forward = np.array([[1.0], [1.0], [-1.0], [-1.0]]) * self.wheelbase_depth / 2
+        left = np.array([[1.0], [-1.0], [1.0], [-1.0]]) * self.wheelbase_width / 2
+
+        offset_x = forward * cos_heading - left * sin_heading
+        offset_y = forward * sin_heading + left * cos_heading
+
+        velocity_x = seg.velocity * cos_heading - heading_rate * offset_y
+        velocity_y = seg.velocity * sin_heading + heading_rate * offset_x
+        speed = np.hypot(velocity_x, velocity_y)
+
+        modules = np.empty((4,) + seg.data.shape)
+        modules[:, 0] = dt
+        modules[:, 1] = seg.x + offset_x
+        modules[:, 2] = seg.y + offset_y
+        modules[:, 3] = np.cumsum((np.concatenate((np.zeros((4, 1)), speed[:, :-1]), axis=1) + speed) / 2.0 * dt,
+                                  axis=1)
+        modules[:, 4] = speed
+        modules[:, 5] = np.diff(speed, prepend=0.0) / dt
+        modules[:, 6] = np.diff(modules[:, 5], prepend=0.0) / dt
+        # A module that isn't moving keeps pointing the way the chassis faces
+        modules[:, 7] = bound_radians_array(np.where(speed > 1e-9, np.arctan2(velocity_y, velocity_x), heading))
+
+        self.front_left = SegmentArray(data=modules[0])
+        self.front_right = SegmentArray(data=modules[1])
+        self.back_left = SegmentArray(data=modules[2])
+        self.back_right = SegmentArray(data=modules[3])
 
     def get_original_trajectory(self):
         return self.original
 
+    def get_module_trajectories(self):
+        '''
+            :return the front left, front right, back left and back right trajectories
+        '''
+        return self.front_left, self.front_right, self.back_left, self.back_right
+
     def get_front_left_trajectory(self):
         return self.front_left
 
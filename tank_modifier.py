@@ -1,52 +1,41 @@
-import math
-import copy
+import numpy as np
+from structs.segment_array import SegmentArray
+from profiler import NULL_PROFILER
 
 
 class TankModifier:
-    def __init__(self, original, wheelbase_width):
+    def __init__(self, original, wheelbase_width, profiler=NULL_PROFILER):
         self.original = original
         self.wheelbase_width = wheelbase_width
-        self.modify()
+        with profiler.stage('tank modifier', segments=len(original)):
+            self.modify()
 
     def modify(self):
+        '''
+            Compute the left and right wheel tracks together. Both are stacked in one (2, fields, length) array,
+            left first, and the trajectories returned are views into it.
+        '''
         w = self.wheelbase_width / 2
+        seg = self.original
 
-        self.left_traj = []
-        self.right_traj = []
+        tracks = np.stack((seg.data, seg.data))
+        x, y, dt = tracks[:, 1], tracks[:, 2], tracks[:, 0]
+        displacement, velocity, acceleration, jerk = tracks[:, 3], tracks[:, 4], tracks[:, 5], tracks[:, 6]
 
-        for i in range(len(self.original)):
-            seg = self.original[i]
-            left = copy.deepcopy(seg)
-            right = copy.deepcopy(seg)
+        # +w to the left of the path, -w to the right
+        offset = np.array([[w], [-w]])
+        x -= offset * np.sin(seg.heading)
+        y += offset * np.cos(seg.heading)
 
-            cos_angle = math.cos(seg.heading)
-            sin_angle = math.sin(seg.heading)
+        distance = np.hypot(np.diff(x), np.diff(y))
 
-            left.x = seg.x - (w * sin_angle)
-            left.y = seg.y + (w * cos_angle)
+        displacement[:, 1:] += distance
+        velocity[:, 1:] = distance / dt[:, 1:]
+        acceleration[:, 1:] = np.diff(velocity) / dt[:, 1:]
+        jerk[:, 1:] = np.diff(acceleration) / dt[:, 1:]
 
-            if(i > 0):
-                last = self.left_traj[i - 1]
-                distance = math.sqrt((left.x - last.x) * (left.x - last.x) + (left.y - last.y) * (left.y - last.y))
-
-                left.displacement += distance
-                left.velocity = distance / seg.dt
-                left.acceleration = (left.velocity - last.velocity) / seg.dt
-                left.jerk = (left.acceleration - last.acceleration) / seg.dt
-
-            right.x = seg.x + (w * sin_angle)
-            right.y = seg.y - (w * cos_angle)
-            if (i > 0):
-                last = self.right_traj[i - 1]
-                distance = math.sqrt((right.x - last.x) * (right.x - last.x) + (right.y - last.y) * (right.y - last.y))
-
-                right.displacement += distance
-                right.velocity = distance / seg.dt
-                right.acceleration = (right.velocity - last.velocity) / seg.dt
-                right.jerk = (right.acceleration - last.acceleration) / seg.dt
-
-            self.left_traj.append(left)
-            self.right_traj.append(right)
+        self.left_traj = SegmentArray(data=tracks[0])
+        self.right_traj = SegmentArray(data=tracks[1])
 
     def get_original_trajectory(self):
         return self.original
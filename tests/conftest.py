@@ -0,0 +1,66 @@
+'''
+    The path, configs and trajectory the tests share.
+'''
+import pytest
+
+from spline_generator import FitType
+from structs.trajectory_config import TrajectoryConfig
+from structs.waypoint import Waypoint
+from trajectory_generator import TrajectoryGenerator
+
+
+@pytest.fixture
+def waypoints():
+    return [Waypoint(0.0, 0.0, 0.0), Waypoint(2.0, 1.0, 0.8), Waypoint(3.0, 3.0, 1.4), Waypoint(1.0, 5.0, 3.0)]
+
+
+@pytest.fixture
+def make_config():
+    '''
+        Factory for TrajectoryConfigs, e.g. make_config(max_v=2.0) for the usual one with a different max_v.
+    '''
+    def make(**fields):
+        config = TrajectoryConfig()
+        config.dt = 0.01
+        config.max_v = 3.0
+        config.max_a = 4.0
+        config.max_j = 60.0
+        config.sample_count = 1000
+        for name, value in fields.items():
+            setattr(config, name, value)
+        return config
+    return make
+
+
+@pytest.fixture
+def make_trajectory(waypoints, make_config):
+    '''
+        Factory for generated trajectories: make_trajectory(path=None, fit_type=FitType.CUBIC, **config fields),
+        along waypoints unless another path is given.
+    '''
+    def make(path=None, fit_type=FitType.CUBIC, **fields):
+        return TrajectoryGenerator(waypoints if path is None else path, make_config(**fields), fit_type).generate()
+    return make
+
+
+@pytest.fixture
+def trajectory(make_trajectory):
+    return make_trajectory()
+
+
+@pytest.fixture
+def robot_config():
+    '''
+        The make_config settings as a robotConfig.json for Pathfinder.
+    '''
+    return {
+        'max_velocity': 3.0,
+        'max_acceleration': 4.0,
+        'max_jerk': 60.0,
+        'time_step': 0.01,
+        'sample_count': 1000,
+        'wheelbase_width': 0.7,
+        'wheelbase_length': 0.6,
+        'splineType': 'CUBIC',
+        'drivebaseType': 'TANK',
+    }
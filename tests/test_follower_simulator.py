@@ -0,0 +1,97 @@
+import numpy as np
+import pytest
+
+from distance_follower import DistanceFollower
+from follower_simulator import GAINS, DrivetrainModel, FollowerSimulator, gain_grid, load_trajectory
+
+MAX_VELOCITY = 3.5
+METRICS = ('rms_error', 'max_error', 'final_error', 'saturation')
+
+
+@pytest.fixture
+def gains():
+    return gain_grid(kp=[0.0, 1.0, 5.0, 50.0], kd=[0.0, 0.05], kv=[0.0, 1.0 / MAX_VELOCITY], ka=[0.0, 0.1])
+
+
+def follow(trajectory, model, kp, kd, kv, ka):
+    '''
+        One gain set followed by a DistanceFollower, a segment at a time, against the model.
+    '''
+    follower = DistanceFollower(trajectory)
+    follower.configurePIDVA(kp, 0.0, kd, kv, ka)
+    noise = np.random.RandomState(model.seed).normal(0.0, model.noise, len(trajectory)) if model.noise > 0 else None
+    x = v = 0.0
+    errors = []
+    saturated = 0
+    for i, seg in enumerate(trajectory):
+        errors.append(seg.position - x)
+        output = follower.calculate(x + (noise[i] if noise is not None else 0.0))
+        saturated += abs(output) > model.max_output
+        output = min(max(output, -model.max_output), model.max_output)
+        response = 1.0 - np.exp(-seg.dt / model.time_constant) if model.time_constant > 0 else 1.0
+        new_v = v + response * (output * model.max_velocity - v)
+        x += (v + new_v) / 2.0 * seg.dt
+        v = new_v
+
+    errors = np.abs(errors)
+    return {'rms_error': np.sqrt(np.mean(errors * errors)), 'max_error': errors.max(),
+            'final_error': abs(trajectory[-1].position - x), 'saturation': saturated / len(trajectory)}
+
+
+@pytest.mark.parametrize("model", [DrivetrainModel(MAX_VELOCITY), DrivetrainModel(MAX_VELOCITY, time_constant=0.0),
+                                   DrivetrainModel(MAX_VELOCITY, noise=0.01, seed=3)])
+def test_simulate_matches_follower(trajectory, gains, model):
+    results = FollowerSimulator(trajectory, model).simulate(gains)
+
+    for i, gain_set in enumerate(gains):
+        expected = follow(trajectory, model, *gain_set)
+        for name in METRICS:
+            assert results[name][i] == pytest.approx(expected[name], rel=1e-9, abs=1e-12), (gain_set, name)
+    for i, name in enumerate(GAINS):
+        assert np.array_equal(results[name], gains[:, i])
+
+
+def test_simulate_each_gain_set_alone(trajectory, gains):
+    simulator = FollowerSimulator(trajectory, DrivetrainModel(MAX_VELOCITY, noise=0.01))
+    results = simulator.simulate(gains)
+
+    for i, gain_set in enumerate(gains):
+        alone = simulator.simulate(gain_set)
+        for name in alone:
+            assert np.array_equal(alone[name], results[name][i:i + 1])
+
+
+@pytest.mark.parametrize("workers, chunk_size", [(2, 7), (3, 64), (1, 7), (None, 4096)])
+def test_sweep_matches_simulate(trajectory, gains, workers, chunk_size):
+    simulator = FollowerSimulator(trajectory, DrivetrainModel(MAX_VELOCITY, noise=0.01))
+    expected = simulator.simulate(gains)
+    results = simulator.sweep(gains, workers, chunk_size)
+
+    assert sorted(results) == sorted(expected)
+    for name in expected:
+        assert np.array_equal(results[name], expected[name])
+
+
+def test_metrics(trajectory):
+    model = DrivetrainModel(MAX_VELOCITY, time_constant=0.0)
+    gains = [[0.0, 0.0, 0.0, 0.0], [0.0, 0.0, 1.0 / MAX_VELOCITY, 0.0], [1.0, 0.0, 1.0 / MAX_VELOCITY, 0.0],
+             [0.0, 0.0, 1.0, 0.0]]
+    results = FollowerSimulator(trajectory, model).simulate(gains)
+    length = trajectory.position[-1]
+
+    # Standing still
+    assert results['max_error'][0] == results['final_error'][0] == pytest.approx(length)
+    # Perfect feedforward only lags a segment behind, and feedback closes some of that
+    assert results['final_error'][1] == pytest.approx(0.0, abs=1e-9)
+    assert results['max_error'][1] < 0.05
+    assert results['rms_error'][2] < results['rms_error'][1]
+    # Too much feedforward saturates while the trajectory is faster than 1 m/s
+    assert 0.0 < results['saturation'][3] < 1.0
+    assert not results['saturation'][:3].any()
+
+
+def test_load_trajectory(tmp_path, trajectory):
+    csv_path = tmp_path / "trajectory.csv"
+    np.savetxt(str(csv_path), trajectory.data[::-1].T, delimiter=',', comments='',
+               header=','.join(trajectory.fieldnames[::-1]))
+    assert np.allclose(load_trajectory(str(csv_path)).data, trajectory.data)
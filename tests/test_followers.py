@@ -0,0 +1,51 @@
+import numpy as np
+import pytest
+
+from distance_follower import DistanceFollower
+from encoder_follower import EncoderFollower
+
+TICKS_PER_REVOLUTION = 1024
+WHEEL_CIRCUMFERENCE = 0.3
+INITIAL_POSITION = 100
+
+
+def make_follower(follower_type, trajectory):
+    follower = follower_type(trajectory)
+    follower.configurePIDVA(0.8, 0.0, 0.1, 1 / 3.0, 0.05)
+    if follower_type is EncoderFollower:
+        follower.configureEncoder(INITIAL_POSITION, TICKS_PER_REVOLUTION, WHEEL_CIRCUMFERENCE)
+    return follower
+
+
+def measurements(follower_type, distances):
+    if follower_type is EncoderFollower:
+        return distances / WHEEL_CIRCUMFERENCE * TICKS_PER_REVOLUTION + INITIAL_POSITION
+    return distances
+
+
+@pytest.mark.parametrize("follower_type", [EncoderFollower, DistanceFollower])
+def test_calculate_many_matches_calculate_at(trajectory, follower_type):
+    rng = np.random.RandomState(0)
+    times = np.cumsum(rng.uniform(0.005, 0.02, 300))
+    readings = measurements(follower_type, rng.uniform(0, 3, len(times)))
+
+    one_at_a_time = make_follower(follower_type, trajectory)
+    expected = [one_at_a_time.calculate_at(time, reading) for time, reading in zip(times, readings)]
+    many = make_follower(follower_type, trajectory)
+
+    assert times[-1] > trajectory.dt.sum()
+    np.testing.assert_allclose(many.calculate_many(times, readings), expected, rtol=1e-12, atol=1e-12)
+    assert (many.segment, many.heading, many.last_time) == (one_at_a_time.segment, one_at_a_time.heading,
+                                                            one_at_a_time.last_time)
+    assert many.isFinished()
+
+
+def test_encoder_matches_distance(trajectory):
+    times = np.arange(1, len(trajectory)) * 0.01
+    distances = trajectory.displacement[1:] + 0.01
+
+    encoder = make_follower(EncoderFollower, trajectory)
+    distance = make_follower(DistanceFollower, trajectory)
+    np.testing.assert_allclose(encoder.calculate_many(times, measurements(EncoderFollower, distances)),
+                               distance.calculate_many(times, distances), rtol=1e-9, atol=1e-9)
+    assert encoder.calculate_at(0.005, INITIAL_POSITION) == pytest.approx(distance.calculate_at(0.005, 0.0))
@@ -0,0 +1,65 @@
+import copy
+import math
+
+import numpy as np
+import pytest
+
+from structs.segment_array import SegmentArray
+from structs.waypoint import Waypoint
+from swerve_modifier import SwerveModifier
+from tank_modifier import TankModifier
+
+
+def reference_tank(original, wheelbase_width):
+    '''
+        TankModifier.modify as a loop over every segment, as it was before it was vectorized.
+    '''
+    w = wheelbase_width / 2
+    left_traj = []
+    right_traj = []
+    for i, seg in enumerate(original.to_segments()):
+        for traj, side in ((left_traj, 1), (right_traj, -1)):
+            wheel = copy.copy(seg)
+            wheel.x = seg.x - side * w * math.sin(seg.heading)
+            wheel.y = seg.y + side * w * math.cos(seg.heading)
+            if i > 0:
+                last = traj[i - 1]
+                distance = math.sqrt((wheel.x - last.x) * (wheel.x - last.x) + (wheel.y - last.y) * (wheel.y - last.y))
+                wheel.displacement += distance
+                wheel.velocity = distance / seg.dt
+                wheel.acceleration = (wheel.velocity - last.velocity) / seg.dt
+                wheel.jerk = (wheel.acceleration - last.acceleration) / seg.dt
+            traj.append(wheel)
+    return SegmentArray.from_segments(left_traj), SegmentArray.from_segments(right_traj)
+
+
+@pytest.mark.parametrize("wheelbase_width", [0.0, 0.6, 1.3])
+def test_tank_matches_loop(trajectory, wheelbase_width):
+    modifier = TankModifier(trajectory, wheelbase_width)
+    left, right = reference_tank(trajectory, wheelbase_width)
+
+    np.testing.assert_allclose(modifier.get_left_trajectory().data, left.data, rtol=1e-12, atol=1e-9)
+    np.testing.assert_allclose(modifier.get_right_trajectory().data, right.data, rtol=1e-12, atol=1e-9)
+    assert modifier.get_original_trajectory() is trajectory
+
+
+def test_tank_leaves_original_alone(trajectory):
+    data = trajectory.data.copy()
+    TankModifier(trajectory, 0.6)
+    assert np.array_equal(trajectory.data, data)
+
+
+def test_swerve_straight_matches_translation(make_trajectory):
+    # Driving straight along +y the chassis doesn't turn, so the modules are the center moved by a fixed offset, as
+    # the original SwerveModifier placed them, and move exactly as the center does
+    original = make_trajectory([Waypoint(0.0, 0.0, math.pi / 2), Waypoint(0.0, 4.0, math.pi / 2)])
+    modifier = SwerveModifier(original, 0.6, 0.8)
+    offsets = ((-0.3, 0.4), (0.3, 0.4), (-0.3, -0.4), (0.3, -0.4))
+
+    for module, (dx, dy) in zip(modifier.get_module_trajectories(), offsets):
+        np.testing.assert_allclose(module.x, original.x + dx, atol=1e-9)
+        np.testing.assert_allclose(module.y, original.y + dy, atol=1e-9)
+        for name in ('dt', 'displacement', 'velocity', 'acceleration', 'jerk'):
+            np.testing.assert_allclose(getattr(module, name), getattr(original, name), rtol=1e-9, atol=1e-9)
+        moving = original.velocity > 1e-9
+        np.testing.assert_allclose(module.heading[moving], math.pi / 2, atol=1e-9)
@@ -0,0 +1,155 @@
+import json
+import os
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+
+import pathfindr
+from pathfindr import Pathfinder
+import trajectory_cache
+import trajectory_file
+from trajectory_generator import TrajectoryGenerator
+
+PATHFINDR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "pathfindr.py")
+
+
+@pytest.fixture
+def make_pathfinder(tmp_path, robot_config, waypoints):
+    '''
+        Factory for Pathfinders writing to tmp_path, e.g. make_pathfinder(max_lateral_acceleration=1.0) for one with
+        that added to the robot config.
+    '''
+    def make(**config):
+        p = Pathfinder()
+        p.setFolder(str(tmp_path))
+        p.applyConfig(dict(robot_config, **config))
+        p.waypoints = list(waypoints)
+        return p
+    return make
+
+
+@pytest.mark.parametrize("config", [{}, {'max_lateral_acceleration': 1.0}, {'limit_wheel_speed': True},
+                                    {'profileType': 'S_CURVE'}])
+@pytest.mark.parametrize("chunk_size", [37, 1000])
+def test_streamed_binary_matches_generated(tmp_path, make_pathfinder, config, chunk_size):
+    p = make_pathfinder(**config)
+    p.setFileFormat('binary')
+    p.streamTrajectory(chunk_size)
+    streamed = trajectory_file.load(str(tmp_path / "trajectory.bin"))
+
+    expected = make_pathfinder(**config)
+    expected.generateTrajectory()
+    assert streamed.data.shape == expected.segments.data.shape
+    # Unlimited profiles are planned chunk by chunk, which sums displacement on from each chunk rather than in one go
+    np.testing.assert_allclose(streamed.data, expected.segments.data, rtol=1e-9, atol=1e-9)
+    if config and 'profileType' not in config:
+        assert np.array_equal(streamed.data, expected.segments.data)
+
+
+def test_curvature_limit_lengthens_trajectory(make_pathfinder):
+    plain = make_pathfinder()
+    plain.generateTrajectory()
+    limited = make_pathfinder(max_lateral_acceleration=1.0)
+    limited.generateTrajectory()
+
+    assert len(limited.segments) > len(plain.segments)
+    assert limited.getGenerator().trajectory.length == len(limited.segments)
+
+
+@pytest.fixture
+def batch_path(tmp_path, robot_config, waypoints):
+    '''
+        A folder with a waypoints.csv, as batch generates, and the robot config file for it.
+    '''
+    folder = tmp_path / "path"
+    folder.mkdir()
+    with open(str(folder / "waypoints.csv"), 'w') as csv_file:
+        csv_file.write("x,y,theta\n" + "".join("%r,%r,%r\n" % (w.x, w.y, w.angle) for w in waypoints))
+    configPath = tmp_path / "robotConfig.json"
+    configPath.write_text(json.dumps(robot_config))
+    return str(folder), str(configPath)
+
+
+BATCH_OPTIONS = {'cache': None, 'tank': True, 'swerve': False, 'force': False, 'binary': True, 'float32': False}
+
+
+def test_batch_skips_unchanged_paths(batch_path):
+    folder, configPath = batch_path
+
+    assert pathfindr.batchGeneratePath(folder, configPath, BATCH_OPTIONS)[1]
+    outputs = sorted(os.listdir(folder))
+    assert outputs == ['.inputs', 'left_tank_trajectory.bin', 'right_tank_trajectory.bin', 'trajectory.bin',
+                       'waypoints.csv']
+    assert not pathfindr.batchGeneratePath(folder, configPath, BATCH_OPTIONS)[1]
+    assert pathfindr.batchGeneratePath(folder, configPath, dict(BATCH_OPTIONS, force=True))[1]
+    # Writing csv instead is a different output
+    assert pathfindr.batchGeneratePath(folder, configPath, dict(BATCH_OPTIONS, binary=False))[1]
+    assert not pathfindr.batchGeneratePath(folder, configPath, dict(BATCH_OPTIONS, binary=False))[1]
+
+
+def test_batch_regenerates_deleted_outputs(batch_path):
+    folder, configPath = batch_path
+    pathfindr.batchGeneratePath(folder, configPath, BATCH_OPTIONS)
+
+    os.remove(os.path.join(folder, "right_tank_trajectory.bin"))
+    assert pathfindr.batchGeneratePath(folder, configPath, BATCH_OPTIONS)[1]
+    assert os.path.exists(os.path.join(folder, "right_tank_trajectory.bin"))
+    assert not pathfindr.batchGeneratePath(folder, configPath, BATCH_OPTIONS)[1]
+
+
+def test_batch_regenerates_after_version_change(batch_path, monkeypatch):
+    folder, configPath = batch_path
+    pathfindr.batchGeneratePath(folder, configPath, BATCH_OPTIONS)
+
+    monkeypatch.setattr(pathfindr, 'BATCH_OUTPUT_VERSION', pathfindr.BATCH_OUTPUT_VERSION + 1)
+    assert pathfindr.batchGeneratePath(folder, configPath, BATCH_OPTIONS)[1]
+
+
+def test_batch_with_cache_regenerates_after_cache_version_change(tmp_path, batch_path, monkeypatch):
+    folder, configPath = batch_path
+    options = dict(BATCH_OPTIONS, cache=str(tmp_path / ".cache"))
+    trajectoryPath = os.path.join(folder, "trajectory.bin")
+    assert pathfindr.batchGeneratePath(folder, configPath, options)[1]
+    before = trajectory_file.load(trajectoryPath).data.copy()
+
+    # Bumping the batch version rewrites the files from the cache
+    monkeypatch.setattr(pathfindr, 'BATCH_OUTPUT_VERSION', pathfindr.BATCH_OUTPUT_VERSION + 1)
+    assert pathfindr.batchGeneratePath(folder, configPath, options)[1]
+    assert np.array_equal(trajectory_file.load(trajectoryPath).data, before)
+
+    # A fix to the generator, with the cache version bumped for it
+    generate = TrajectoryGenerator.generate
+
+    def fixed(self, *args, **kwargs):
+        segments = generate(self, *args, **kwargs)
+        segments.x += 1.0
+        return segments
+    monkeypatch.setattr(TrajectoryGenerator, 'generate', fixed)
+    assert not pathfindr.batchGeneratePath(folder, configPath, options)[1]
+    monkeypatch.setattr(trajectory_cache, 'CACHE_VERSION', trajectory_cache.CACHE_VERSION + 1)
+    assert pathfindr.batchGeneratePath(folder, configPath, options)[1]
+    np.testing.assert_array_equal(trajectory_file.load(trajectoryPath).x, before[1] + 1.0)
+
+
+def run_cli(tmp_path, batch_path, *args):
+    folder, configPath = batch_path
+    command = [sys.executable, PATHFINDR, "-f", str(tmp_path / "out"), "-c", configPath, "-w",
+               os.path.join(folder, "waypoints.csv"), "--no-cache"] + list(args)
+    return subprocess.run(command, capture_output=True, text=True)
+
+
+@pytest.mark.parametrize("modifier", ["-t", "-s"])
+def test_cli_rejects_streaming_modifiers(tmp_path, batch_path, modifier):
+    result = run_cli(tmp_path, batch_path, "--stream", "100", modifier, "1")
+    assert result.returncode == 2
+    assert "--stream can't be used with" in result.stderr
+    assert not os.path.exists(str(tmp_path / "out"))
+
+
+def test_cli_streams(tmp_path, batch_path):
+    result = run_cli(tmp_path, batch_path, "--stream", "100", "-b")
+    assert result.returncode == 0, result.stderr
+    assert os.listdir(str(tmp_path / "out")) != []
+    assert len(trajectory_file.load(str(tmp_path / "out" / "trajectory.bin"))) > 100
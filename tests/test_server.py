@@ -0,0 +1,141 @@
+import json
+import shutil
+import tempfile
+
+import tornado.testing
+import tornado.web
+import tornado.websocket
+
+import server
+
+CONFIG = {
+    'max_velocity': 3.0,
+    'max_acceleration': 4.0,
+    'max_jerk': 60.0,
+    'time_step': 0.02,
+    'sample_count': 1000,
+    'wheelbase_width': 0.6,
+    'wheelbase_length': 0.6,
+    'splineType': 'CUBIC',
+    'drivebaseType': 0,
+}
+
+WAYPOINTS = [{'x': 0.0, 'y': 0.0, 'r': 0.0}, {'x': 2.0, 'y': 1.0, 'r': 0.5}, {'x': 4.0, 'y': 1.0, 'r': 0.0}]
+
+# Module globals pointed at a temporary folder for each test, and generation run on the IOLoop's default executor
+PATCHED = ('pathsFolder', 'configFilepath', 'cacheFolder', 'configCache', 'cache', 'executor', 'workerPathfinder')
+
+
+class ServerTest(tornado.testing.AsyncHTTPTestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.saved = {name: getattr(server, name) for name in PATCHED}
+        server.pathsFolder = self.folder
+        server.configFilepath = self.folder + "/robotConfig.json"
+        server.cacheFolder = self.folder + "/.cache"
+        server.configCache = server.ConfigCache(server.configFilepath)
+        server.cache = server.TrajectoryCache(server.cacheFolder)
+        server.executor = None
+        server.workerPathfinder = None
+        with open(server.configFilepath, 'w') as configFile:
+            json.dump(CONFIG, configFile)
+        super().setUp()
+
+    def tearDown(self):
+        super().tearDown()
+        for name, value in self.saved.items():
+            setattr(server, name, value)
+        shutil.rmtree(self.folder)
+
+    def get_app(self):
+        return tornado.web.Application([(r"/", server.Server)])
+
+    async def connect(self):
+        return await tornado.websocket.websocket_connect("ws://127.0.0.1:{:d}/".format(self.get_http_port()))
+
+    async def request(self, ws, cmd, payload=None, requestId=None):
+        await ws.write_message(json.dumps({'cmd': cmd, 'id': requestId, 'payload': payload}))
+        return json.loads(await ws.read_message())
+
+    @tornado.testing.gen_test(timeout=60)
+    async def test_verify_config_and_trajectories(self):
+        ws = await self.connect()
+
+        reply = await self.request(ws, "GetConfig", requestId=1)
+        self.assertEqual(reply['cmd'], "Unverified")
+
+        reply = await self.request(ws, "Verify", {'pin': server.pin + 1 if server.pin < 99999 else 0}, 2)
+        self.assertEqual(reply['cmd'], "WrongPin")
+        reply = await self.request(ws, "Verify", {'pin': server.pin}, 3)
+        self.assertEqual((reply['cmd'], reply['id']), ("Verified", 3))
+
+        reply = await self.request(ws, "GetConfig", requestId=4)
+        self.assertEqual((reply['cmd'], reply['id'], reply['payload']), ("RobotConfig", 4, CONFIG))
+
+        reply = await self.request(ws, "GetTrajectories", {'waypoints': WAYPOINTS}, 5)
+        self.assertEqual((reply['cmd'], reply['id']), ("Trajectories", 5))
+        trajectories = reply['payload']
+        self.assertEqual(set(trajectories), {'trajectory', 'tank_left_trajectory', 'tank_right_trajectory'})
+        center = trajectories['trajectory']
+        self.assertGreater(len(center['dt']), 10)
+        self.assertAlmostEqual(center['x'][-1], 4.0, places=2)
+        self.assertAlmostEqual(center['y'][-1], 1.0, places=2)
+        ws.close()
+
+    @tornado.testing.gen_test(timeout=60)
+    async def test_legacy_messages(self):
+        ws = await self.connect()
+
+        await ws.write_message("{:05d}".format(server.pin))
+        self.assertEqual(await ws.read_message(), "Verified")
+
+        await ws.write_message("GetConfig")
+        reply = await ws.read_message()
+        self.assertTrue(reply.startswith("RobotConfig"))
+        self.assertEqual(json.loads(reply[len("RobotConfig"):]), CONFIG)
+
+        await ws.write_message("GetTrajectories" + json.dumps(WAYPOINTS))
+        reply = await ws.read_message()
+        self.assertTrue(reply.startswith("Trajectories:"))
+        self.assertIn('tank_left_trajectory', json.loads(reply[len("Trajectories:"):]))
+        ws.close()
+
+    @tornado.testing.gen_test(timeout=60)
+    async def test_pipelined_verify(self):
+        ws = await self.connect()
+
+        # Sent back to back, without waiting for the Verified reply
+        await ws.write_message(json.dumps({'cmd': "Verify", 'id': 1, 'payload': {'pin': server.pin}}))
+        await ws.write_message(json.dumps({'cmd': "GetConfig", 'id': 2}))
+        replies = [json.loads(await ws.read_message()) for _ in range(2)]
+        self.assertEqual([(reply['cmd'], reply['id']) for reply in replies], [("Verified", 1), ("RobotConfig", 2)])
+
+        ws.close()
+        ws = await self.connect()
+        await ws.write_message("{:05d}".format(server.pin))
+        await ws.write_message("GetConfig")
+        self.assertEqual(await ws.read_message(), "Verified")
+        self.assertTrue((await ws.read_message()).startswith("RobotConfig"))
+        ws.close()
+
+    @tornado.testing.gen_test
+    async def test_messages_handled_in_order(self):
+        # Two messages handled back to back, as when they arrive in the same read, with no IOLoop turn in between
+        connection = RecordingServer()
+        connection.on_message(json.dumps({'cmd': "Verify", 'id': 1, 'payload': {'pin': server.pin}}))
+        connection.on_message(json.dumps({'cmd': "GetConfig", 'id': 2}))
+        self.assertEqual(connection.replies, [("Verified", 1), ("RobotConfig", 2)])
+
+
+class RecordingServer(server.Server):
+    '''
+        A Server without a websocket, which records the replies it would send.
+    '''
+    def __init__(self):
+        self.id = 0
+        self.verified = False
+        self.requests = {}
+        self.replies = []
+
+    def reply(self, request, name, payload=None):
+        self.replies.append((name, request.id))
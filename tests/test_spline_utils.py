@@ -0,0 +1,132 @@
+import math
+
+import numpy as np
+import pytest
+
+from spline_generator import SplineGenerator, FitType
+from spline_utils import SplineUtils
+from structs.spline_array import SplineArray
+from structs.waypoint import Waypoint
+
+SAMPLE_COUNT = 500
+
+
+def make_splines(waypoints, fit_type):
+    generator = SplineGenerator(fit_type)
+    return [generator.fit(a, b) for a, b in zip(waypoints[:-1], waypoints[1:])]
+
+
+def reference_progress(s, distance, sample_count):
+    '''
+        get_progress_for_distance as it was before the arc length table: the trapezoid integration run from t=0 up to
+        the distance, for every lookup.
+    '''
+    def deriv(t):
+        x = t * s.knot_distance
+        return (5 * s.a * x + 4 * s.b) * (x * x * x) + (3 * s.c * x + 2 * s.d) * x + s.e
+
+    sample_count_d = float(sample_count)
+    arc_length = 0.0
+    last_arc_length = 0.0
+    t = 0.0
+    last_integrand = math.sqrt(1 + deriv(0) * deriv(0)) / sample_count_d
+    distance = distance / s.knot_distance
+
+    for i in range(sample_count + 1):
+        t = i / sample_count_d
+        dydt = deriv(t)
+        integrand = math.sqrt(1 + dydt * dydt) / sample_count_d
+        arc_length = arc_length + (integrand + last_integrand) / 2
+        if arc_length > distance:
+            break
+        last_integrand = integrand
+        last_arc_length = arc_length
+
+    interpolated = t
+    if arc_length != last_arc_length:
+        interpolated = interpolated + ((distance - last_arc_length) /
+                                       (arc_length - last_arc_length) - 1) / sample_count_d
+    return interpolated
+
+
+def distances_along(s, count=200):
+    # Every table sample, and either side of it, as well as before the start and past the end
+    table = s.knot_distance * s.arc_length_table
+    rng = np.random.RandomState(0)
+    return np.concatenate((rng.uniform(-0.1, s.arc_length * 1.1, count), table[::25], np.nextafter(table[::25], 0),
+                           np.nextafter(table[::25], np.inf), [0.0, s.arc_length]))
+
+
+@pytest.mark.parametrize("fit_type", list(FitType))
+def test_progress_matches_integration(waypoints, fit_type):
+    utils = SplineUtils()
+    for s in make_splines(waypoints, fit_type):
+        utils.get_arc_length(s, SAMPLE_COUNT)
+        distances = distances_along(s)
+        expected = [reference_progress(s, distance, SAMPLE_COUNT) for distance in distances]
+
+        assert [utils.get_progress_for_distance(s, distance, SAMPLE_COUNT) for distance in distances] == expected
+        assert utils.get_progress_for_distance_array(s, distances, SAMPLE_COUNT).tolist() == expected
+
+
+@pytest.mark.parametrize("fit_type", list(FitType))
+def test_progress_many_matches_single(waypoints, fit_type):
+    utils = SplineUtils()
+    splines = make_splines(waypoints, fit_type)
+    for s in splines:
+        utils.get_arc_length(s, SAMPLE_COUNT)
+    array = SplineArray.from_splines(splines)
+    tables = utils.get_arc_length_many(array, SAMPLE_COUNT)
+
+    spline_i = np.concatenate([np.full(len(distances_along(s)), i) for i, s in enumerate(splines)])
+    distances = np.concatenate([distances_along(s) for s in splines])
+    expected = np.concatenate([utils.get_progress_for_distance_array(s, distances_along(s), SAMPLE_COUNT)
+                               for s in splines])
+
+    assert np.array_equal(tables, np.stack([s.arc_length_table for s in splines]))
+    assert np.array_equal(utils.get_progress_for_distance_many(array, tables, spline_i, distances, SAMPLE_COUNT),
+                          expected)
+
+
+def reference_arc_length(s, t1, intervals=20000):
+    '''
+        Arc length from percentage 0 to t1 by a composite Simpson's rule fine enough to be exact for these tests.
+    '''
+    t = np.linspace(0, t1, 2 * intervals + 1)
+    integrand = SplineUtils().get_arc_length_integrand_array(s, t)
+    weights = np.ones(len(t))
+    weights[1:-1:2] = 4
+    weights[2:-1:2] = 2
+    return s.knot_distance * t1 / (6 * intervals) * (integrand @ weights)
+
+
+def tight_splines(waypoints, fit_type):
+    # As well as the usual path, a spline that turns back on itself, where the integrand changes fastest
+    return make_splines(waypoints, fit_type) + make_splines([Waypoint(0.0, 0.0, 0.0), Waypoint(0.5, 0.4, 2.8)],
+                                                            fit_type)
+
+
+@pytest.mark.parametrize("fit_type", list(FitType))
+@pytest.mark.parametrize("tolerance", [1e-3, 1e-6, 1e-9])
+def test_adaptive_arc_length_within_tolerance(waypoints, fit_type, tolerance):
+    utils = SplineUtils()
+    for s in tight_splines(waypoints, fit_type):
+        assert abs(utils.get_arc_length_adaptive(s, tolerance) - reference_arc_length(s, 1.0)) <= tolerance
+
+
+@pytest.mark.parametrize("fit_type", list(FitType))
+@pytest.mark.parametrize("tolerance", [1e-3, 1e-6, 1e-9])
+def test_adaptive_progress_within_tolerance(waypoints, fit_type, tolerance):
+    utils = SplineUtils()
+    for s in tight_splines(waypoints, fit_type):
+        utils.get_arc_length_adaptive(s, tolerance)
+        distances = np.linspace(0, s.arc_length, 41)
+        progress = utils.get_progress_for_distance_adaptive_array(s, distances, tolerance)
+
+        assert np.all(np.diff(progress) >= 0)
+        for distance, t in zip(distances[:-1], progress[:-1]):
+            # The interval table and the Newton steps each add at most the tolerance
+            assert abs(reference_arc_length(s, t) - distance) <= 2 * tolerance
+        assert progress[-1] == 1.0
+        assert (utils.get_progress_for_distance_adaptive(s, distances[7], tolerance) ==
+                utils.get_progress_for_distance_adaptive_array(s, distances[7:8], tolerance)[0])
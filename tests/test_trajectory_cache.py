@@ -0,0 +1,178 @@
+import os
+import pickle
+import subprocess
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pytest
+
+import trajectory_cache
+from spline_generator import FitType
+from structs.segment_array import SegmentArray
+from structs.waypoint import Waypoint
+from trajectory_cache import TrajectoryCache
+
+# The key of a trajectory, by a script run in another process with the pickled inputs on stdin
+KEY_SCRIPT = """
+import pickle, sys
+from trajectory_cache import TrajectoryCache
+print(TrajectoryCache.make_key(*pickle.load(sys.stdin.buffer)))
+"""
+
+
+@pytest.fixture
+def make_key(waypoints, make_config):
+    '''
+        Factory for the key of a trajectory: make_key(kind='trajectory', path=None, fit_type=FitType.CUBIC, params=(),
+        **config fields), along waypoints unless another path is given.
+    '''
+    def make(kind='trajectory', path=None, fit_type=FitType.CUBIC, params=(), **fields):
+        return TrajectoryCache.make_key(kind, waypoints if path is None else path, make_config(**fields), fit_type,
+                                        *params)
+    return make
+
+
+def test_key_is_stable(waypoints, make_config, make_key):
+    key = make_key()
+    assert make_key(path=[Waypoint(w.x, w.y, w.angle) for w in waypoints]) == key
+    # The fields the generator fills in itself don't matter
+    assert make_key(dest_pos=5.0, src_theta=1.0) == key
+
+    # The same in another process, with a different hash seed
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    inputs = pickle.dumps(('trajectory', waypoints, make_config(), FitType.CUBIC))
+    output = subprocess.run([sys.executable, "-c", KEY_SCRIPT], input=inputs, stdout=subprocess.PIPE, check=True,
+                            env={'PYTHONHASHSEED': '123', 'PYTHONPATH': root}).stdout
+    assert output.decode().strip() == key
+
+
+@pytest.mark.parametrize("change", [
+    {'path': [Waypoint(0.0, 0.0, 0.0), Waypoint(2.0, 1.0, 0.9)]},
+    {'max_v': 3.1},
+    {'sample_count': 1001},
+    {'fit_type': FitType.QUINTIC},
+    {'params': (0.6,)},
+    {'kind': 'tank'},
+])
+def test_key_changes_with_inputs(make_key, change):
+    assert make_key(**change) != make_key()
+
+
+def test_key_changes_with_version(make_key, monkeypatch):
+    key = make_key()
+    monkeypatch.setattr(trajectory_cache, 'CACHE_VERSION', trajectory_cache.CACHE_VERSION + 1)
+    assert make_key() != key
+
+
+def make_entry(length, value=1.0):
+    return {'trajectory': SegmentArray(data=np.full((len(SegmentArray.fieldnames), length), value))}
+
+
+def test_memory_hits_and_misses():
+    cache = TrajectoryCache()
+    assert cache.get('a') is None
+    entry = make_entry(10)
+    assert cache.get_or_generate('a', lambda: entry) is entry
+    assert cache.get_or_generate('a', lambda: make_entry(10, 2.0)) is entry
+    assert cache.stats() == {'memory_hits': 1, 'disk_hits': 0, 'misses': 2, 'memory_entries': 1,
+                             'memory_bytes': entry['trajectory'].data.nbytes}
+
+
+def test_memory_evicts_least_recently_used_by_count():
+    cache = TrajectoryCache(max_entries=2)
+    for key in 'abc':
+        cache.put(key, make_entry(10))
+        cache.get('a')
+    assert list(cache.memory) == ['c', 'a']
+
+
+def test_memory_evicts_by_size():
+    entry_bytes = TrajectoryCache.entry_bytes(make_entry(100))
+    cache = TrajectoryCache(max_memory_bytes=3 * entry_bytes)
+    for key in 'abcd':
+        cache.put(key, make_entry(100))
+    assert list(cache.memory) == ['b', 'c', 'd']
+    assert cache.memory_bytes == 3 * entry_bytes
+
+    # Replacing an entry doesn't count it twice, and one bigger than the whole budget isn't kept
+    cache.put('d', make_entry(100))
+    assert cache.memory_bytes == 3 * entry_bytes
+    cache.put('e', make_entry(400))
+    assert list(cache.memory) == [] and cache.memory_bytes == 0
+
+
+def test_disk_tier(tmp_path):
+    entry = make_entry(10, 3.0)
+    TrajectoryCache(str(tmp_path)).put('a', entry)
+
+    cache = TrajectoryCache(str(tmp_path))
+    loaded = cache.get('a')
+    assert np.array_equal(loaded['trajectory'].data, entry['trajectory'].data)
+    assert cache.get('a') is loaded
+    assert (cache.disk_hits, cache.memory_hits, cache.misses) == (1, 1, 0)
+
+    cache.clear()
+    assert cache.get('a') is None
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_disk_evicts_least_recently_used(tmp_path):
+    cache = TrajectoryCache(str(tmp_path))
+    for key, mtime in (('a', 1), ('b', 2)):
+        cache.put(key, make_entry(1000))
+        os.utime(cache.path(key), (mtime, mtime))
+
+    cache.max_disk_bytes = int(2.5 * os.path.getsize(cache.path('a')))
+    cache.put('c', make_entry(1000))
+    assert sorted(os.listdir(str(tmp_path))) == ['b.npz', 'c.npz']
+
+
+def test_disk_files_removed_by_another_process(tmp_path, monkeypatch):
+    cache = TrajectoryCache(str(tmp_path))
+    cache.put('a', make_entry(1000))
+    cache.put('b', make_entry(1000))
+
+    # Listed, then gone before it is looked at
+    listdir = os.listdir
+    monkeypatch.setattr(os, 'listdir', lambda folder: listdir(folder) + ['gone.npz'])
+    cache.evict()
+    monkeypatch.setattr(os, 'listdir', listdir)
+
+    # Removed by another process just before this one removes it
+    remove = os.remove
+
+    def remove_twice(path):
+        remove(path)
+        remove(path)
+    monkeypatch.setattr(os, 'remove', remove_twice)
+    cache.max_disk_bytes = 0
+    cache.evict()
+    cache.clear()
+    monkeypatch.setattr(os, 'remove', remove)
+
+    # Loaded, then evicted before it is marked as used
+    cache.max_disk_bytes = 1 << 20
+    cache.put('c', make_entry(10))
+    cache.memory.clear()
+
+    def utime(path):
+        raise FileNotFoundError(path)
+    monkeypatch.setattr(os, 'utime', utime)
+    assert cache.get('c') is not None
+
+
+def share_disk_tier(folder, worker):
+    cache = TrajectoryCache(folder, max_disk_bytes=4 * 70000)
+    for i in range(100):
+        key = str(i % 10)
+        entry = cache.get_or_generate(key, lambda: make_entry(1000, float(key)))
+        assert np.all(entry['trajectory'].data == float(key))
+        cache.memory.clear()
+    return worker
+
+
+def test_disk_tier_shared_by_processes(tmp_path):
+    with ProcessPoolExecutor(max_workers=4) as executor:
+        assert sorted(executor.map(share_disk_tier, [str(tmp_path)] * 8, range(8))) == list(range(8))
+    assert not [filename for filename in os.listdir(str(tmp_path)) if filename.endswith(".tmp")]
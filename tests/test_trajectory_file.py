@@ -0,0 +1,79 @@
+import numpy as np
+import pytest
+
+from structs.segment_array import SegmentArray
+import trajectory_file
+
+
+def make_segments(length, dt=0.02):
+    rng = np.random.RandomState(length)
+    segments = SegmentArray(data=rng.standard_normal((len(SegmentArray.fieldnames), length)))
+    segments.dt = dt
+    return segments
+
+
+@pytest.mark.parametrize("length", [0, 1, 257])
+@pytest.mark.parametrize("dtype", [np.float64, np.float32])
+def test_file_round_trip(tmp_path, length, dtype):
+    segments = make_segments(length)
+    filepath = str(tmp_path / ("trajectory" + trajectory_file.EXTENSION))
+    trajectory_file.write(filepath, segments, dtype)
+    loaded = trajectory_file.load(filepath)
+
+    assert loaded.data.shape == segments.data.shape
+    assert np.array_equal(loaded.data, segments.data.astype(dtype))
+    assert not loaded.data.flags.writeable
+
+
+@pytest.mark.parametrize("dtype", [np.float64, np.float32])
+def test_encode_decode(dtype):
+    segments = make_segments(100)
+    encoded = trajectory_file.encode(segments, dtype)
+
+    assert np.array_equal(trajectory_file.decode(encoded).data, segments.data.astype(dtype))
+    with pytest.raises(ValueError):
+        trajectory_file.decode(b'XXXX' + encoded[4:])
+
+
+def test_decode_reorders_columns():
+    segments = make_segments(10)
+    reordered = list(reversed(SegmentArray.fieldnames))
+    header = bytearray(trajectory_file.encode_header(segments))
+    for i, name in enumerate(reordered):
+        offset = trajectory_file.HEADER.size + trajectory_file.NAME_SIZE * i
+        header[offset:offset + trajectory_file.NAME_SIZE] = name.encode('ascii').ljust(trajectory_file.NAME_SIZE, b'\0')
+    columns = np.stack([segments.data[SegmentArray.fieldnames.index(name)] for name in reordered])
+
+    assert np.array_equal(trajectory_file.decode(bytes(header) + columns.tobytes()).data, segments.data)
+
+
+@pytest.mark.parametrize("chunk_size", [1, 33, 100])
+def test_stream_writer_matches_write(tmp_path, chunk_size):
+    segments = make_segments(100)
+    streamed = str(tmp_path / "streamed.bin")
+    written = str(tmp_path / "written.bin")
+    with trajectory_file.StreamWriter(streamed, len(segments), 0.02) as writer:
+        for start in range(0, len(segments), chunk_size):
+            writer.write(SegmentArray(data=segments.data[:, start:start + chunk_size]))
+    trajectory_file.write(written, segments)
+
+    with open(streamed, 'rb') as a, open(written, 'rb') as b:
+        assert a.read() == b.read()
+
+
+def test_stream_writer_rejects_extra_segments(tmp_path):
+    with trajectory_file.StreamWriter(str(tmp_path / "trajectory.bin"), 10, 0.02) as writer:
+        writer.write(make_segments(6))
+        with pytest.raises(ValueError):
+            writer.write(make_segments(6))
+
+
+def test_message_round_trip():
+    trajectories = {'left': make_segments(50), 'right': make_segments(51)}
+    message = trajectory_file.encode_message("Trajectories", trajectories, np.float64, id=7)
+    metadata, decoded = trajectory_file.decode_message(message)
+
+    assert (metadata['type'], metadata['id']) == ("Trajectories", 7)
+    assert set(decoded) == set(trajectories)
+    for name, segments in trajectories.items():
+        assert np.array_equal(decoded[name].data, segments.data)
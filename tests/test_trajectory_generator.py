@@ -0,0 +1,141 @@
+import copy
+
+import numpy as np
+import pytest
+
+from spline_generator import FitType
+from structs.trajectory_config import ProfileType
+from structs.waypoint import Waypoint
+from trajectory_generator import TrajectoryGenerator, BatchTrajectoryGenerator, find_spline_indices
+
+
+@pytest.mark.parametrize("fit_type", list(FitType))
+@pytest.mark.parametrize("fields", [{}, {'arc_length_tolerance': 1e-6}, {'max_lateral_a': 1.5},
+                                    {'wheelbase_width': 0.6}, {'profile_type': ProfileType.S_CURVE}])
+def test_parallel_matches_serial(waypoints, make_config, fit_type, fields):
+    serial = TrajectoryGenerator(waypoints, make_config(**fields), fit_type).generate()
+    parallel = TrajectoryGenerator(waypoints, make_config(**fields), fit_type).generate(workers=3, chunk_size=97)
+
+    assert len(serial) > 97
+    assert np.array_equal(parallel.data, serial.data)
+
+
+@pytest.mark.parametrize("length", [1, 2, 5])
+def test_parallel_more_workers_than_segments(waypoints, make_config, length):
+    generator = TrajectoryGenerator(waypoints, make_config())
+    displacement = np.arange(length) * 0.5
+
+    assert np.array_equal(np.array(generator.sample_parallel(displacement, workers=4)),
+                          np.array(generator.sample(displacement)))
+
+
+def reference_spline_indices(spline_lengths, displacement):
+    '''
+        find_spline_indices as it was first written: every displacement compared against every spline.
+    '''
+    spline_lengths = np.asarray(spline_lengths, dtype=float)
+    spline_starts = np.concatenate(([0.0], np.cumsum(spline_lengths[:-1])))
+    fits = (displacement[:, np.newaxis] - spline_starts) <= spline_lengths
+    past_end = ~fits.any(axis=1)
+    spline_i = np.where(past_end, len(spline_lengths) - 1, fits.argmax(axis=1))
+    spline_i = np.maximum.accumulate(spline_i)
+    return spline_i, displacement - spline_starts[spline_i], past_end
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_spline_indices_match_broadcast(seed):
+    rng = np.random.RandomState(seed)
+    for trial in range(100):
+        lengths = rng.uniform(0, 5, rng.randint(1, 40))
+        if trial % 3 == 0:
+            lengths[rng.rand(len(lengths)) < 0.2] = 0.0
+        ends = np.cumsum(lengths)
+        # Displacements on and either side of every spline's end, as well as before the start and past the end
+        displacement = np.sort(np.concatenate((rng.uniform(-0.1, ends[-1] + 0.5, 200), ends,
+                                               np.nextafter(ends, np.inf), np.nextafter(ends, -np.inf))))
+        if trial % 5 == 0:
+            displacement = rng.permutation(displacement)
+
+        for found, expected in zip(find_spline_indices(lengths, displacement),
+                                   reference_spline_indices(lengths, displacement)):
+            assert np.array_equal(found, expected)
+
+
+@pytest.mark.parametrize("fit_type", list(FitType))
+@pytest.mark.parametrize("fields", [{}, {'arc_length_tolerance': 1e-6}, {'max_lateral_a': 1.5}])
+@pytest.mark.parametrize("changes", [
+    {0: Waypoint(-0.5, 0.2, 0.3)},
+    {2: Waypoint(3.4, 2.6, 1.1)},
+    {3: Waypoint(1.2, 5.5, 2.8)},
+    {1: Waypoint(2.2, 0.8, 0.6), 2: Waypoint(3.1, 3.3, 1.5)},
+])
+def test_update_waypoints_matches_fresh_generator(waypoints, make_config, fit_type, fields, changes):
+    generator = TrajectoryGenerator(waypoints, make_config(**fields), fit_type)
+    generator.generate()
+    splines = list(generator.trajectory.spline_list)
+    generator.update_waypoints(changes)
+    updated = generator.generate()
+
+    path = [changes.get(i, waypoint) for i, waypoint in enumerate(waypoints)]
+    fresh = TrajectoryGenerator(path, make_config(**fields), fit_type)
+    assert np.array_equal(updated.data, fresh.generate().data)
+    assert generator.trajectory.length_list == fresh.trajectory.length_list
+    # Only the splines next to a moved waypoint are fitted again
+    moved = {i for index in changes for i in (index - 1, index)}
+    for i, spline in enumerate(generator.trajectory.spline_list):
+        assert (spline is splines[i]) == (i not in moved)
+
+
+def test_update_waypoints_repeatedly(waypoints, make_config):
+    generator = TrajectoryGenerator(waypoints, make_config())
+    path = list(waypoints)
+    for step in range(5):
+        path[2] = Waypoint(3.0 + 0.1 * step, 3.0 - 0.05 * step, 1.4)
+        generator.update_waypoints({2: path[2]})
+        assert np.array_equal(generator.generate().data, TrajectoryGenerator(path, make_config()).generate().data)
+
+
+@pytest.fixture
+def batch_paths(waypoints):
+    return [waypoints,
+            [Waypoint(0.0, 0.0, 0.0), Waypoint(3.0, 1.0, 0.5)],
+            [Waypoint(1.0, 1.0, 1.0), Waypoint(1.5, 3.0, 2.0), Waypoint(-1.0, 4.0, 3.5)],
+            waypoints[::-1]]
+
+
+def generate_each(paths, configs, fit_type):
+    return [TrajectoryGenerator(path, copy.copy(config), fit_type).generate() for path, config in zip(paths, configs)]
+
+
+@pytest.mark.parametrize("fit_type", list(FitType))
+def test_batch_matches_generator_per_path(batch_paths, make_config, fit_type):
+    config = make_config()
+    trajectories = BatchTrajectoryGenerator(batch_paths, config, fit_type).generate()
+
+    assert len(trajectories) == len(batch_paths)
+    for trajectory, expected in zip(trajectories, generate_each(batch_paths, [config] * len(batch_paths), fit_type)):
+        assert np.array_equal(trajectory.data, expected.data)
+    # Each path plans with its own copy of the shared config
+    assert config.dest_pos == 0.0
+
+
+@pytest.mark.parametrize("fit_type", list(FitType))
+def test_batch_matches_generator_per_path_with_mixed_configs(batch_paths, make_config, fit_type):
+    # Different sample counts are integrated in separate groups, and the adaptive and curvature limited configs are
+    # handed to a TrajectoryGenerator
+    configs = [make_config(sample_count=500), make_config(sample_count=2000, profile_type=ProfileType.S_CURVE),
+               make_config(sample_count=500, max_v=2.0), make_config(arc_length_tolerance=1e-6),
+               make_config(max_lateral_a=1.5), make_config(wheelbase_width=0.6)]
+    paths = batch_paths + batch_paths[:2]
+    trajectories = BatchTrajectoryGenerator(paths, configs, fit_type).generate()
+
+    for trajectory, expected in zip(trajectories, generate_each(paths, configs, fit_type)):
+        assert np.array_equal(trajectory.data, expected.data)
+
+
+def test_batch_skips_paths_too_short(batch_paths, make_config):
+    trajectories = BatchTrajectoryGenerator([batch_paths[0][:1]] + batch_paths, make_config()).generate()
+
+    assert len(trajectories[0]) == 0
+    for trajectory, expected in zip(trajectories[1:], generate_each(batch_paths, [make_config()] * 4, FitType.CUBIC)):
+        assert np.array_equal(trajectory.data, expected.data)
@@ -0,0 +1,188 @@
+import itertools
+import math
+
+import numpy as np
+import pytest
+
+from structs.trajectory_config import TrajectoryConfig, ProfileType
+from trajector_planner import TrajectoryPlanner, MotionProfile
+
+# The running sum second filter adds in a different order than the loop, so the profiles agree to rounding rather
+# than bit for bit. Differences are relative to each column's limit (max_v, max_a or max_j)
+TOLERANCE = 1e-9
+
+
+def make_config(dest_pos, dt, max_v, max_a, max_j):
+    config = TrajectoryConfig()
+    config.dest_pos = dest_pos
+    config.dt = dt
+    config.max_v = max_v
+    config.max_a = max_a
+    config.max_j = max_j
+    config.src_theta = 0.2
+    config.dest_theta = 0.2
+    return config
+
+
+def reference_plan(info):
+    '''
+        The second order filter as a loop over every segment, as TrajectoryPlanner computed it before the running sums.
+        :return velocity, acceleration, jerk and displacement of each segment
+    '''
+    f1_buffer = [(info.u / info.v) * info.filter1]
+    last_velocity, last_acceleration, last_displacement = info.u, 0.0, 0.0
+    columns = []
+
+    impulse = info.impulse
+    for i in range(info.length):
+        input_ = min(impulse, 1)
+        if input_ < 1:
+            input_ = input_ - 1
+            impulse = 0
+        else:
+            impulse = impulse - input_
+
+        f1_last = f1_buffer[i - 1] if i > 0 else f1_buffer[0]
+        output = max(0.0, min(info.filter1, f1_last + input_))
+        if i < len(f1_buffer):
+            f1_buffer[i] = output
+        else:
+            f1_buffer.append(output)
+
+        f2 = 0.0
+        for j in range(info.filter2):
+            if i - j < 0:
+                break
+            f2 = f2 + f1_buffer[i - j]
+        f2 = f2 / info.filter1
+
+        velocity = f2 / info.filter2 * info.v
+        displacement = (last_velocity + velocity) / 2.0 * info.dt + last_displacement
+        acceleration = (velocity - last_velocity) / info.dt
+        jerk = (acceleration - last_acceleration) / info.dt
+        columns.append((velocity, acceleration, jerk, displacement))
+        last_velocity, last_acceleration, last_displacement = velocity, acceleration, displacement
+
+    return np.array(columns).T
+
+
+def reference_first_filter(filter1, count, f1_last, impulse):
+    output = []
+    for _ in range(count):
+        input_ = min(impulse, 1)
+        if input_ < 1:
+            input_ = input_ - 1
+            impulse = 0
+        else:
+            impulse = impulse - input_
+        f1_last = max(0.0, min(filter1, f1_last + input_))
+        output.append(f1_last)
+    return output, f1_last, impulse
+
+
+@pytest.mark.parametrize("dest_pos, dt, max_v, max_a, max_j", list(itertools.product(
+    (0.5, 3.0, 12.7), (0.005, 0.01, 0.05), (1.0, 3.3), (2.0, 7.0), (5.0, 60.0, 500.0))))
+def test_matches_loop(dest_pos, dt, max_v, max_a, max_j):
+    planner = TrajectoryPlanner(make_config(dest_pos, dt, max_v, max_a, max_j))
+    planner.prepare()
+    segments = planner.create()
+    velocity, acceleration, jerk, displacement = reference_plan(planner.info)
+
+    assert len(segments) == planner.info.length
+    np.testing.assert_allclose(segments.velocity, velocity, rtol=0, atol=TOLERANCE * max_v)
+    np.testing.assert_allclose(segments.acceleration, acceleration, rtol=0, atol=TOLERANCE * max_a)
+    np.testing.assert_allclose(segments.jerk, jerk, rtol=0, atol=TOLERANCE * max_j)
+    np.testing.assert_allclose(segments.displacement, displacement, rtol=0, atol=TOLERANCE * dest_pos)
+    assert np.all(segments.heading == 0.2)
+
+
+def test_first_filter_matches_stepping():
+    rng = np.random.RandomState(4)
+    planner = TrajectoryPlanner(make_config(1.0, 0.01, 1.0, 1.0, 1.0))
+    planner.prepare()
+    for _ in range(2000):
+        planner.info.filter1 = int(rng.randint(1, 200))
+        count = int(rng.randint(0, 300))
+        f1_last = float(rng.choice([0.0, rng.randint(0, planner.info.filter1 + 1)]))
+        impulse = float(rng.choice([0.0, rng.uniform(0, 400), rng.randint(0, 400)]))
+
+        output, last, left = planner.first_filter(count, f1_last, impulse)
+        expected, expected_last, expected_left = reference_first_filter(planner.info.filter1, count, f1_last, impulse)
+        assert output.tolist() == expected
+        assert (last, left) == (expected_last, expected_left)
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 64, 1000])
+def test_chunks_match_create(chunk_size):
+    planner = TrajectoryPlanner(make_config(4.2, 0.01, 2.5, 5.0, 40.0))
+    planner.prepare()
+    segments = planner.create()
+    chunks = list(planner.plan_chunks(chunk_size))
+
+    assert all(len(chunk) == chunk_size for chunk in chunks[:-1])
+    data = np.concatenate([chunk.data for chunk in chunks], axis=1)
+    for name in ('velocity', 'acceleration', 'jerk'):
+        assert np.array_equal(data[segments.fieldnames.index(name)], getattr(segments, name))
+    # Each chunk's displacement is summed on from the last one's, rather than in one cumulative sum
+    np.testing.assert_allclose(data[segments.fieldnames.index('displacement')], segments.displacement, rtol=0,
+                               atol=TOLERANCE * 4.2)
+    assert math.isclose(segments.displacement[-1], 4.2, rel_tol=1e-9)
+
+
+def profile_cases():
+    rng = np.random.RandomState(1)
+    for _ in range(1000):
+        max_v = rng.uniform(0.5, 4)
+        yield (float(rng.choice([0.0, rng.uniform(0, 0.05), rng.uniform(0, 30)])),
+               float(rng.choice([0.0, rng.uniform(0, max_v), rng.uniform(max_v, 2 * max_v)])),
+               float(rng.choice([0.0, rng.uniform(0, max_v)])),
+               max_v, rng.uniform(0.5, 8), float(rng.choice([math.inf, rng.uniform(1, 100)])))
+
+
+@pytest.mark.parametrize("distance, src_v, dest_v, max_v, max_a, max_j", list(profile_cases()))
+def test_profile_limits(distance, src_v, dest_v, max_v, max_a, max_j):
+    profile = MotionProfile(distance, src_v, dest_v, max_v, max_a, max_j)
+    times = np.linspace(0, profile.duration, 2001)
+    position, velocity, acceleration, jerk = profile.sample(times)
+
+    assert velocity[0] == pytest.approx(src_v, abs=1e-12)
+    assert position[-1] == pytest.approx(distance, rel=1e-9, abs=1e-12)
+    assert np.trapezoid(velocity, times) == pytest.approx(distance, rel=1e-4, abs=1e-9)
+    assert np.all(np.abs(acceleration) <= max_a * (1 + 1e-9))
+    assert np.all(velocity >= -1e-9)
+    if not math.isinf(max_j):
+        assert np.all(np.abs(jerk) <= max_j * (1 + 1e-9))
+
+    # Above max_v only while slowing down from a src_v above it (the whole way, if there isn't room to get below)
+    over = velocity > max_v * (1 + 1e-9)
+    if over.any():
+        assert src_v > max_v
+        below = np.argmin(over) if not over.all() else len(over)
+        assert not over[below:].any()
+        assert np.all(np.diff(velocity[:below]) <= 1e-12)
+
+
+@pytest.mark.parametrize("profile_type", [ProfileType.TRAPEZOIDAL, ProfileType.S_CURVE])
+def test_profile_over_no_distance(profile_type):
+    config = make_config(0.0, 0.01, 3.0, 4.0, 60.0)
+    config.profile_type = profile_type
+    planner = TrajectoryPlanner(config)
+    planner.prepare()
+
+    assert len(planner.create()) == 0
+    assert list(planner.create_chunks(10)) == []
+
+
+@pytest.mark.parametrize("profile_type", [ProfileType.TRAPEZOIDAL, ProfileType.S_CURVE])
+def test_profile_chunks_match_create(profile_type):
+    config = make_config(7.5, 0.01, 3.0, 4.0, 60.0)
+    config.profile_type = profile_type
+    config.src_v = 1.0
+    config.dest_v = 0.5
+    planner = TrajectoryPlanner(config)
+    planner.prepare()
+    segments = planner.create()
+
+    assert segments.velocity[-1] == pytest.approx(0.5)
+    assert segments.displacement[-1] == pytest.approx(7.5)
+    assert np.array_equal(np.concatenate([chunk.data for chunk in planner.create_chunks(33)], axis=1), segments.data)
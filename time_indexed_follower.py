@@ -0,0 +1,75 @@
+import numpy as np
+from structs.segment_array import TimeIndex
+
+
+class TimeIndexedFollower:
+    '''
+        The time based calculate_at and calculate_many shared by EncoderFollower and DistanceFollower. A follower
+        using this provides getDistanceCovered, which turns its measurements (a number, or an array of them) into the
+        distance travelled along the trajectory, and the PID/VA gains, trajectory, time_index, last_error, last_time,
+        heading and segment attributes.
+    '''
+    def calculate_at(self, time, measurement):
+        '''
+            Like calculate, but the setpoint is the trajectory at the given time since following started, interpolated
+            between segments, instead of the next segment. A control loop that doesn't run exactly every dt then still
+            tracks the profile: a late iteration gets the setpoint it should be at rather than falling behind.
+            :param time         Seconds since the trajectory was started
+            :param measurement  What calculate takes, e.g. the encoder ticks or the distance travelled so far
+            :return             The desired output for your motor controller, 0.0 once the trajectory is over
+        '''
+        time_index = self.getTimeIndex()
+        if len(time_index) == 0 or time > time_index.end:
+            self.segment = len(time_index)
+            return 0.0
+
+        distance_covered = float(self.getDistanceCovered(measurement))
+        index, seg = time_index.lookup(time)
+
+        error = seg.position - distance_covered
+        dt = time - self.last_time if self.last_time is not None and time > self.last_time else seg.dt
+        calculated_value = (self.kp * error + self.kd * ((error - self.last_error) / dt) +
+                            (self.kv * seg.velocity + self.ka * seg.acceleration))
+        self.last_error = error
+        self.last_time = time
+        self.heading = seg.heading
+        self.segment = index + 1
+        return calculated_value
+
+    def calculate_many(self, times, measurements):
+        '''
+            calculate_at for many (increasing) times at once, e.g. to simulate following a trajectory. The follower
+            ends up as if calculate_at had been called for each in turn.
+            :param times         Seconds since the trajectory was started, as an array
+            :param measurements  The matching measurements, as an array
+            :return the outputs for your motor controller, as an array
+        '''
+        time_index = self.getTimeIndex()
+        times = np.asarray(times, dtype=float)
+        outputs = np.zeros(len(times))
+        following = times <= time_index.end if len(time_index) > 0 else np.zeros(len(times), dtype=bool)
+        if following.any():
+            distance_covered = self.getDistanceCovered(np.asarray(measurements, dtype=float))
+            times = times[following]
+            distance_covered = distance_covered[following]
+            setpoints = time_index.interpolate(times)
+
+            error = setpoints.position - distance_covered
+            last_error = np.concatenate(([self.last_error], error[:-1]))
+            last_time = np.concatenate(([np.inf if self.last_time is None else self.last_time], times[:-1]))
+            dt = np.where(times > last_time, times - last_time, setpoints.dt)
+            outputs[following] = (self.kp * error + self.kd * ((error - last_error) / dt) +
+                                  (self.kv * setpoints.velocity + self.ka * setpoints.acceleration))
+
+            self.last_error = float(error[-1])
+            self.last_time = float(times[-1])
+            self.heading = float(setpoints.heading[-1])
+            self.segment = int(time_index.locate(times[-1])[0]) + 1
+        if not following.all():
+            self.segment = len(time_index)
+        return outputs
+
+    def getTimeIndex(self):
+        if self.time_index is None:
+            self.time_index = TimeIndex(self.trajectory)
+        return self.time_index
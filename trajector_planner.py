@@ -1,14 +1,147 @@
 from structs.trajectory_info import TrajectoryInfo
-from structs.segment import Segment
+from structs.trajectory_config import ProfileType
+from structs.segment_array import SegmentArray
 import math
+import numpy as np
+
+# Bisection steps when solving for the peak velocity of an S-curve; plenty for float64
+PEAK_ITERATIONS = 100
+
+
+def ramp_phases(v_from, v_to, max_a, max_j):
+    '''
+        The phases of the quickest change of velocity from v_from to v_to, as (duration, start acceleration, jerk).
+        With max_j infinite the acceleration jumps straight to max_a. Otherwise it ramps up at max_j, holds max_a if
+        there's time to reach it, and ramps back down. Either way the ramp is symmetric, so the average velocity is
+        (v_from + v_to) / 2.
+    '''
+    dv = abs(v_to - v_from)
+    sign = 1.0 if v_to >= v_from else -1.0
+    if dv == 0:
+        return []
+    if math.isinf(max_j):
+        return [(dv / max_a, sign * max_a, 0.0)]
+    if dv >= max_a * max_a / max_j:
+        ramp_time = max_a / max_j
+        return [(ramp_time, 0.0, sign * max_j), (dv / max_a - ramp_time, sign * max_a, 0.0),
+                (ramp_time, sign * max_a, -sign * max_j)]
+    ramp_time = math.sqrt(dv / max_j)
+    return [(ramp_time, 0.0, sign * max_j), (ramp_time, sign * max_j * ramp_time, -sign * max_j)]
+
+
+def ramp_distance(v_from, v_to, max_a, max_j):
+    return (v_from + v_to) / 2 * sum(duration for duration, _, _ in ramp_phases(v_from, v_to, max_a, max_j))
+
+
+class MotionProfile:
+    '''
+        A closed form profile over distance: speed up from src_v to a peak velocity, cruise at it, and slow down to
+        dest_v, with constant jerk in each phase. The phases are worked out once, so the state at any time is a
+        lookup of its phase and a polynomial in the time since the phase started.
+
+        max_j is infinite for a trapezoidal profile. If dest_v can't be reached within the distance, the profile
+        ends at the closest velocity it can reach. A src_v above max_v is slowed down to max_v first.
+    '''
+    def __init__(self, distance, src_v, dest_v, max_v, max_a, max_j):
+        dest_v = min(dest_v, max_v)
+        # The lowest peak. A src_v above max_v is slowed down to max_v or, if there isn't room, as far as needed
+        floor = max(src_v, dest_v) if src_v <= max_v else dest_v
+        slow_down = ramp_distance(src_v, max_v, max_a, max_j) + ramp_distance(max_v, dest_v, max_a, max_j)
+
+        if ramp_distance(src_v, dest_v, max_a, max_j) > distance:
+            # Not enough room: the end velocity is as close to dest_v as the distance allows
+            low, high = sorted((src_v, dest_v))
+            for _ in range(PEAK_ITERATIONS):
+                middle = (low + high) / 2
+                if (ramp_distance(src_v, middle, max_a, max_j) > distance) == (dest_v > src_v):
+                    high = middle
+                else:
+                    low = middle
+            dest_v = low if dest_v > src_v else high
+            peak = max(src_v, dest_v)
+        elif slow_down <= distance:
+            peak = max_v
+        elif math.isinf(max_j) and src_v <= max_v:
+            # Both ramps take (peak^2 - v^2) / (2 * max_a)
+            peak = math.sqrt(max_a * distance + (src_v * src_v + dest_v * dest_v) / 2)
+        else:
+            # The highest peak whose ramps fit in the distance
+            low, high = floor, max_v
+            for _ in range(PEAK_ITERATIONS):
+                peak = (low + high) / 2
+                if ramp_distance(src_v, peak, max_a, max_j) + ramp_distance(peak, dest_v, max_a, max_j) > distance:
+                    high = peak
+                else:
+                    low = peak
+            peak = low
+
+        accelerate = ramp_phases(src_v, peak, max_a, max_j)
+        decelerate = ramp_phases(peak, dest_v, max_a, max_j)
+        cruise = distance - ramp_distance(src_v, peak, max_a, max_j) - ramp_distance(peak, dest_v, max_a, max_j)
+        phases = accelerate + ([(cruise / peak, 0.0, 0.0)] if cruise > 0 and peak > 0 else []) + decelerate
+
+        self.src_v = src_v
+        self.dest_v = dest_v
+        self.peak_v = peak
+        self.distance = distance
+
+        # Start time, position, velocity, acceleration and jerk of each phase
+        count = len(phases)
+        self.start = np.zeros(count)
+        self.position = np.zeros(count)
+        self.velocity = np.zeros(count)
+        self.acceleration = np.array([a for _, a, _ in phases], dtype=float)
+        self.jerk = np.array([j for _, _, j in phases], dtype=float)
+        t = p = 0.0
+        v = src_v
+        for i, (duration, a, j) in enumerate(phases):
+            self.start[i], self.position[i], self.velocity[i] = t, p, v
+            t += duration
+            p += ((j * duration / 6 + a / 2) * duration + v) * duration
+            v += (j * duration / 2 + a) * duration
+        self.duration = t
+
+    def sample(self, times):
+        '''
+            :return the position, velocity, acceleration and jerk at each of the given times. Times before the start
+                give the starting state, and times after the end the final one
+        '''
+        times = np.asarray(times, dtype=float)
+        if len(self.start) == 0:
+            return (np.full(times.shape, self.distance), np.full(times.shape, self.dest_v), np.zeros(times.shape),
+                    np.zeros(times.shape))
+
+        times = np.clip(times, 0.0, self.duration)
+        phase = np.maximum(np.searchsorted(self.start, times, side='right') - 1, 0)
+        tau = times - self.start[phase]
+        a, j = self.acceleration[phase], self.jerk[phase]
+
+        position = self.position[phase] + ((j * tau / 6 + a / 2) * tau + self.velocity[phase]) * tau
+        velocity = self.velocity[phase] + (j * tau / 2 + a) * tau
+        acceleration = a + j * tau
+        jerk = j.copy()
+
+        # The end is held at dest_v rather than extrapolating the last phase
+        done = times >= self.duration
+        position[done] = self.distance
+        velocity[done] = self.dest_v
+        acceleration[done] = 0.0
+        jerk[done] = 0.0
+        return position, velocity, acceleration, jerk
 
 
 class TrajectoryPlanner:
     def __init__(self, config):
         self.config = config
         self.info = None
+        self.profile = None
 
     def prepare(self):
+        if self.config.profile_type != ProfileType.FILTER:
+            self.prepare_profile()
+            return
+
+        self.profile = None
         max_a2 = self.config.max_a * self.config.max_a
         max_j2 = self.config.max_j * self.config.max_j
 
@@ -25,64 +158,145 @@ class TrajectoryPlanner:
 
         self.info = TrajectoryInfo(filter1, filter2, time, self.config.dt, 0, checked_max_v, impulse)
 
-    def create(self):
-        segments = self.plan_fromSecondOrderFilter()
+    def prepare_profile(self):
+        max_j = self.config.max_j if self.config.profile_type == ProfileType.S_CURVE else math.inf
+        self.profile = MotionProfile(self.config.dest_pos, self.config.src_v, self.config.dest_v, self.config.max_v,
+                                     self.config.max_a, max_j)
 
-        d_theta = self.config.dest_theta - self.config.src_theta
-        for i in range(self.info.length):
-            segments[i].heading = self.config.src_theta + d_theta *\
-                segments[i].displacement / (segments[-1].displacement)
+        length = int(math.ceil(self.profile.duration / self.config.dt))
+        self.info = TrajectoryInfo(0, 0, length, self.config.dt, self.config.src_v, self.profile.peak_v, 0)
+
+    def create(self):
+        if self.profile is not None:
+            # A closed form profile over no distance has no segments, the same as create_chunks gives
+            segments = self.plan_profile(0, self.info.length)
+        else:
+            segments = self.plan_fromSecondOrderFilter()
 
+        if len(segments):
+            self.interpolate_heading(segments, segments.displacement[-1])
         return segments
 
+    def create_chunks(self, chunk_size):
+        '''
+            Like create, but yields the segments chunk_size at a time as they are planned. The final displacement
+            isn't known until the end, so headings are interpolated over the planned distance (config.dest_pos)
+            instead.
+        '''
+        for segments in self.plan_chunks(chunk_size):
+            self.interpolate_heading(segments, self.config.dest_pos)
+            yield segments
+
+    def interpolate_heading(self, segments, distance):
+        '''
+            Turn the heading from src_theta to dest_theta in proportion to the displacement over the given distance.
+        '''
+        d_theta = self.config.dest_theta - self.config.src_theta
+        if distance == 0:
+            segments.heading = self.config.src_theta
+        else:
+            segments.heading = self.config.src_theta + d_theta * segments.displacement / distance
+
     def plan_fromSecondOrderFilter(self):
-        last_section = Segment(self.info.dt, 0.0, 0.0, 0.0, self.info.u, 0.0, 0.0, 0.0)
+        return SegmentArray.concatenate(list(self.plan_chunks(max(self.info.length, 1))), self.info.dt)
+
+    def plan_profile(self, start, stop):
+        '''
+            Segments start to stop (exclusive) of the closed form profile. Any range can be planned on its own.
+        '''
+        return self.sample(np.arange(start + 1, stop + 1) * self.info.dt)
 
-        f1_buffer = []
-        f1_buffer.append((self.info.u / self.info.v) * self.info.filter1)
+    def sample(self, times):
+        '''
+            The closed form profile at each of the given times since the start, as a SegmentArray (without headings).
+        '''
+        segments = SegmentArray(len(times), self.info.dt)
+        segments.displacement, segments.velocity, segments.acceleration, segments.jerk = self.profile.sample(times)
+        segments.x = segments.displacement
+        segments.y = 0.0
+        return segments
 
-        segments = []
+    def plan_chunks(self, chunk_size):
+        '''
+            Plan the profile, yielding SegmentArrays of up to chunk_size segments.
+        '''
+        if self.profile is not None:
+            for start in range(0, self.info.length, chunk_size):
+                yield self.plan_profile(start, min(start + chunk_size, self.info.length))
+            return
 
+        f1_last = (self.info.u / self.info.v) * self.info.filter1
         impulse = self.info.impulse
-        for i in range(self.info.length):
-            input_ = min(impulse, 1)
 
-            if input_ < 1:
-                input_ = input_ - 1
-                impulse = 0
-            else:
-                impulse = impulse - input_
+        # The end of the first filter's output that the second filter still needs
+        f1_tail = np.empty(0)
+        last = (self.info.u, 0.0, 0.0)
 
-            f1_last = 0.0
-            if i > 0:
-                f1_last = f1_buffer[i - 1]
-            else:
-                f1_last = f1_buffer[0]
+        for start in range(0, self.info.length, chunk_size):
+            f1_buffer, f1_last, impulse = self.first_filter(min(chunk_size, self.info.length - start), f1_last,
+                                                            impulse)
 
-            if i < len(f1_buffer):
-                f1_buffer[i] = max(0.0, min(self.info.filter1, f1_last + input_))
-            else:
-                f1_buffer.append(max(0.0, min(self.info.filter1, f1_last + input_)))
+            # The second filter is a moving sum over the last filter2 outputs of the first one, which is the
+            # difference of two running sums. This keeps planning linear in the trajectory length whatever filter2 is.
+            window = np.concatenate((f1_tail, f1_buffer))
+            running_sum = np.cumsum(window)
+            f2 = running_sum.copy()
+            f2[self.info.filter2:] -= running_sum[:-self.info.filter2]
+            f2 = f2[len(f1_tail):]
+            f1_tail = window[max(0, len(window) - (self.info.filter2 - 1)):] if self.info.filter2 > 1 else np.empty(0)
 
-            f2 = 0.0
+            f2 = f2 / self.info.filter1
 
-            for j in range(self.info.filter2):
-                if i - j < 0:
-                    break
-                f2 = f2 + f1_buffer[i - j]
+            velocity = f2 / self.info.filter2 * self.info.v
 
-            f2 = f2 / self.info.filter1
+            segments = self.integrate_velocity(velocity, *last)
+            last = (segments.velocity[-1], segments.acceleration[-1], segments.displacement[-1])
+            yield segments
+
+    def first_filter(self, count, f1_last, impulse):
+        '''
+            Run the first filter for count steps from the given state.
+
+            Its input is 1 while at least a whole unit of impulse is left, then the leftover fraction minus 1 once,
+            then -1, and its output is the running sum of that clamped to [0, filter1]. So the output climbs by 1
+            to filter1, then falls by 1 to 0, and each step can be written down directly rather than looped over.
+            The whole-number steps are exact in floating point, so this gives the same values as stepping.
+            :return the count outputs, and the last output and impulse left to carry on from
+        '''
+        filter1 = self.info.filter1
+        rising = min(int(impulse) if impulse >= 1 else 0, count)
+
+        output = np.empty(count)
+        output[:rising] = np.minimum(filter1, f1_last + np.arange(1.0, rising + 1))
+        if rising == count:
+            return output, float(output[-1]) if count else f1_last, impulse - rising
+
+        peak = output[rising - 1] if rising else f1_last
+        output[rising] = max(0.0, min(filter1, peak + ((impulse - rising) - 1)))
+        output[rising + 1:] = np.maximum(0.0, output[rising] - np.arange(1.0, count - rising))
+        return output, float(output[-1]), 0
+
+    def integrate_velocity(self, velocity, last_velocity=None, last_acceleration=0.0, last_displacement=0.0):
+        '''
+            Build the segments for a velocity profile sampled every dt. By default the profile starts at displacement
+            0 from the initial velocity; the last_* arguments continue it from an earlier segment instead.
+        '''
+        if last_velocity is None:
+            last_velocity = self.info.u
+
+        segments = SegmentArray(len(velocity), self.info.dt)
+        dt = self.info.dt
+
+        velocity = np.asarray(velocity, dtype=float)
+        last_velocity = np.concatenate(([last_velocity], velocity[:-1]))
 
-            seg = Segment(dt=self.info.dt, x=0.0, y=0.0, displacement=0.0,
-                          velocity=0.0, acceleration=0.0, jerk=0.0, heading=0.0)
-            seg.velocity = f2 / self.info.filter2 * self.info.v
-            seg.displacement = (last_section.velocity + seg.velocity) / 2.0 * seg.dt + last_section.displacement
-            seg.x = seg.displacement
-            seg.y = 0.0
-            seg.acceleration = (seg.velocity - last_section.velocity) / seg.dt
-            seg.jerk = (seg.acceleration - last_section.acceleration) / seg.dt
-
-            segments.append(seg)
-            last_section = seg
+        segments.velocity = velocity
+        segments.displacement = np.cumsum((last_velocity + velocity) / 2.0 * dt)
+        if last_displacement != 0.0:
+            segments.displacement += last_displacement
+        segments.x = segments.displacement
+        segments.y = 0.0
+        segments.acceleration = (velocity - last_velocity) / dt
+        segments.jerk = np.diff(segments.acceleration, prepend=last_acceleration) / dt
 
         return segments
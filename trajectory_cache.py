@@ -0,0 +1,185 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from structs.segment_array import SegmentArray
+
+# Part of every key. Bump it whenever the trajectories generated for the same inputs change (a fix to the generator,
+# planner or modifiers) or the layout of SegmentArray does, so entries made by older code are never handed out
+CACHE_VERSION = 1
+
+
+class TrajectoryCache:
+    '''
+        Cache of generated trajectories, keyed by a hash of everything that goes into generating them.
+
+        There is an in-memory LRU tier, holding at most max_entries entries and max_memory_bytes of trajectory data,
+        and, if a folder is given, an on-disk tier of .npz files in that folder which is trimmed (least recently used
+        first) to max_disk_bytes. Entries are dicts of name to SegmentArray, e.g.
+        {'trajectory': segments}. Trajectories handed out by the cache are shared, so treat them as read-only.
+    '''
+    # TrajectoryConfig fields that the generator fills in itself and so don't identify a trajectory
+    derived_config_fields = ('dest_pos', 'src_theta', 'dest_theta')
+
+    def __init__(self, folder=None, max_entries=32, max_memory_bytes=64 * 1024 * 1024,
+                 max_disk_bytes=64 * 1024 * 1024):
+        self.folder = folder
+        self.max_entries = max_entries
+        self.max_memory_bytes = max_memory_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self.memory = OrderedDict()
+        self.memory_bytes = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    @classmethod
+    def make_key(cls, kind, waypoints, config, fit_type, *params):
+        '''
+            Build a stable key for a trajectory.
+            :param kind      What is being cached, e.g. 'trajectory', 'tank' or 'swerve'
+            :param waypoints The waypoints of the path
+            :param config    The TrajectoryConfig used to generate it
+            :param fit_type  The spline fit type
+            :param params    Anything else the result depends on, e.g. the wheelbase size
+        '''
+        description = {
+            'version': CACHE_VERSION,
+            'kind': kind,
+            'waypoints': [[float(w.x), float(w.y), float(w.angle)] for w in waypoints],
+            'config': cls.config_fields(config),
+            'fit_type': getattr(fit_type, 'name', fit_type),
+            'params': [getattr(param, 'name', param) for param in params],
+        }
+        text = json.dumps(description, sort_keys=True, default=repr)
+        return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+    @classmethod
+    def config_fields(cls, config):
+        '''
+            :return the TrajectoryConfig fields that identify a trajectory, as a dict of plain values
+        '''
+        return {name: getattr(value, 'name', value) for name, value in sorted(vars(config).items())
+                if name not in cls.derived_config_fields}
+
+    def get(self, key):
+        '''
+            :return the cached entry for the key, or None if it isn't cached
+        '''
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            self.memory_hits += 1
+            return self.memory[key]
+
+        entry = self.load(key)
+        if entry is not None:
+            self.disk_hits += 1
+            self.remember(key, entry)
+            return entry
+
+        self.misses += 1
+        return None
+
+    def put(self, key, entry):
+        self.remember(key, entry)
+        self.save(key, entry)
+
+    def get_or_generate(self, key, generate):
+        '''
+            :return the cached entry for the key, calling generate() to create (and cache) it if it isn't cached
+        '''
+        entry = self.get(key)
+        if entry is None:
+            entry = generate()
+            self.put(key, entry)
+        return entry
+
+    @staticmethod
+    def entry_bytes(entry):
+        return sum(segments.data.nbytes for segments in entry.values())
+
+    def remember(self, key, entry):
+        if key in self.memory:
+            self.memory_bytes -= self.entry_bytes(self.memory.pop(key))
+        self.memory[key] = entry
+        self.memory_bytes += self.entry_bytes(entry)
+        while len(self.memory) > self.max_entries or (self.memory and self.memory_bytes > self.max_memory_bytes):
+            self.memory_bytes -= self.entry_bytes(self.memory.popitem(last=False)[1])
+
+    def path(self, key):
+        return os.path.join(self.folder, key + ".npz")
+
+    # The disk tier can be shared by processes running at the same time (batch and server workers), so any file in
+    # it can be evicted by another process between listing or checking for it and using it
+
+    def load(self, key):
+        if self.folder is None or not os.path.exists(self.path(key)):
+            return None
+
+        try:
+            with np.load(self.path(key)) as data:
+                entry = {name: SegmentArray(data=data[name]) for name in data.files}
+        except (OSError, ValueError):
+            return None
+        # Mark it as recently used for eviction
+        try:
+            os.utime(self.path(key))
+        except FileNotFoundError:
+            pass
+        return entry
+
+    def save(self, key, entry):
+        if self.folder is None:
+            return
+
+        os.makedirs(self.folder, exist_ok=True)
+        # Named for this process and thread, so writers of the same key don't write into each other's file
+        temp_path = "%s.%d.%d.tmp" % (self.path(key), os.getpid(), threading.get_ident())
+        with open(temp_path, 'wb') as f:
+            np.savez(f, **{name: segments.data for name, segments in entry.items()})
+        os.replace(temp_path, self.path(key))
+        self.evict()
+
+    def evict(self):
+        files = []
+        for filename in os.listdir(self.folder):
+            if filename.endswith(".npz"):
+                try:
+                    stat = os.stat(os.path.join(self.folder, filename))
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, filename))
+
+        total = sum(size for _, size, _ in files)
+        for _, size, filename in sorted(files):
+            if total <= self.max_disk_bytes:
+                break
+            self.remove(filename)
+            total -= size
+
+    def remove(self, filename):
+        try:
+            os.remove(os.path.join(self.folder, filename))
+        except FileNotFoundError:
+            pass
+
+    def clear(self):
+        self.memory.clear()
+        self.memory_bytes = 0
+        if self.folder is not None:
+            for filename in os.listdir(self.folder):
+                if filename.endswith(".npz"):
+                    self.remove(filename)
+
+    def stats(self):
+        return {
+            'memory_hits': self.memory_hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'memory_entries': len(self.memory),
+            'memory_bytes': self.memory_bytes,
+        }
@@ -0,0 +1,176 @@
+import json
+import struct
+
+import numpy as np
+
+from structs.segment_array import SegmentArray
+
+# Binary trajectory format (all little endian):
+#   header       magic b'PFTR', version (u16), bytes per value (u8, 4 or 8), column count (u8), header size (u32),
+#                segment count (u64), dt (f64)
+#   column names column count * 16 bytes, ascii, null padded
+#   padding      up to header size, which is a multiple of 64 so the columns are aligned
+#   columns      column count * segment count values (float32 or float64), one column after another
+MAGIC = b'PFTR'
+VERSION = 1
+HEADER = struct.Struct('<4sHBBIQd')
+NAME_SIZE = 16
+ALIGNMENT = 64
+EXTENSION = ".bin"
+
+# Messages carrying several trajectories, e.g. over the server's websocket (all little endian):
+#   header       magic b'PFTM', version (u16), 2 bytes padding, metadata size (u32)
+#   metadata     utf-8 json, {"type": ..., "trajectories": [{"name": ..., "offset": ..., "size": ...}, ...], ...},
+#                padded with spaces to a multiple of 8 bytes
+#   trajectories one after another in the binary format above. Offsets are from the end of the metadata and are
+#                multiples of 8, so every trajectory can be decoded in place
+MESSAGE_MAGIC = b'PFTM'
+MESSAGE_VERSION = 1
+MESSAGE_HEADER = struct.Struct('<4sHxxI')
+
+
+def encode_header(segments, dtype=np.float64):
+    dt = float(segments.dt[0]) if len(segments) > 0 else 0.0
+    return make_header(len(segments), dt, dtype)
+
+
+def make_header(segment_count, dt, dtype=np.float64):
+    dtype = np.dtype(dtype)
+    names = SegmentArray.fieldnames
+    header_size = HEADER.size + NAME_SIZE * len(names)
+    header_size += -header_size % ALIGNMENT
+
+    header = HEADER.pack(MAGIC, VERSION, dtype.itemsize, len(names), header_size, segment_count, dt)
+    header += b''.join(struct.pack('16s', name.encode('ascii')) for name in names)
+    return header.ljust(header_size, b'\0')
+
+
+def encode_columns(segments, dtype=np.float64):
+    return np.ascontiguousarray(segments.data, dtype=np.dtype(dtype).newbyteorder('<'))
+
+
+def encode(segments, dtype=np.float64):
+    '''
+        :return the trajectory in the binary format, as bytes
+        :param dtype np.float64, or np.float32 to halve the size
+    '''
+    return encode_header(segments, dtype) + encode_columns(segments, dtype).tobytes()
+
+
+def decode(buffer):
+    '''
+        Read a trajectory in the binary format. The columns of the SegmentArray returned are views of the buffer, not
+        copies, so it is read-only if the buffer is.
+    '''
+    magic, version, itemsize, column_count, header_size, segment_count, dt = HEADER.unpack_from(buffer, 0)
+    if magic != MAGIC:
+        raise ValueError("Not a binary trajectory")
+    if version != VERSION:
+        raise ValueError("Unsupported binary trajectory version %d" % version)
+
+    names = []
+    for i in range(column_count):
+        name = struct.unpack_from('16s', buffer, HEADER.size + NAME_SIZE * i)[0]
+        names.append(name.rstrip(b'\0').decode('ascii'))
+
+    dtype = np.dtype('<f%d' % itemsize)
+    data = np.frombuffer(buffer, dtype=dtype, count=column_count * segment_count, offset=header_size)
+    data = data.reshape(column_count, segment_count)
+
+    if names != SegmentArray.fieldnames:
+        # Different column order: rearrange (this copies)
+        data = np.stack([data[names.index(name)] for name in SegmentArray.fieldnames])
+    return SegmentArray(data=data)
+
+
+def write(filepath, segments, dtype=np.float64):
+    with open(filepath, 'wb') as f:
+        f.write(encode_header(segments, dtype))
+        encode_columns(segments, dtype).tofile(f)
+
+
+class StreamWriter:
+    '''
+        Writes a binary trajectory a chunk at a time. The columns are stored one after another, so the total number
+        of segments has to be known up front (TrajectoryPlanner.info.length); each chunk's columns are written
+        straight into their place in the file.
+    '''
+    def __init__(self, filepath, segment_count, dt, dtype=np.float64):
+        self.dtype = np.dtype(dtype)
+        self.segment_count = segment_count
+        self.written = 0
+        self.file = open(filepath, 'wb')
+        header = make_header(segment_count, dt, dtype)
+        self.header_size = len(header)
+        self.file.write(header)
+        self.file.truncate(self.header_size + len(SegmentArray.fieldnames) * segment_count * self.dtype.itemsize)
+
+    def write(self, segments):
+        if self.written + len(segments) > self.segment_count:
+            raise ValueError("More segments written than the trajectory was created with")
+
+        columns = encode_columns(segments, self.dtype)
+        for i, column in enumerate(columns):
+            self.file.seek(self.header_size + (i * self.segment_count + self.written) * self.dtype.itemsize)
+            column.tofile(self.file)
+        self.written += len(segments)
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def load(filepath):
+    '''
+        Memory-map a binary trajectory file. Nothing is parsed or copied beyond the header; segments are read from the
+        file as they are used. The SegmentArray returned is read-only and can be given straight to EncoderFollower or
+        DistanceFollower.
+    '''
+    return decode(np.memmap(filepath, dtype=np.uint8, mode='r'))
+
+
+def encode_message(message_type, trajectories, dtype=np.float32, **fields):
+    '''
+        :param message_type  Stored as "type" in the metadata, e.g. "Trajectories"
+        :param trajectories  dict of name to SegmentArray
+        :param fields        Anything else to put in the metadata (json serialisable), e.g. a request id
+        :return the message as bytes
+    '''
+    blobs = []
+    entries = []
+    offset = 0
+    for name, segments in trajectories.items():
+        blob = encode(segments, dtype)
+        blob += b'\0' * (-len(blob) % 8)
+        entries.append({'name': name, 'offset': offset, 'size': len(blob)})
+        blobs.append(blob)
+        offset += len(blob)
+
+    metadata = dict(fields, type=message_type, trajectories=entries)
+    metadata = json.dumps(metadata, separators=(',', ':')).encode('utf-8')
+    metadata += b' ' * (-(MESSAGE_HEADER.size + len(metadata)) % 8)
+    return b''.join([MESSAGE_HEADER.pack(MESSAGE_MAGIC, MESSAGE_VERSION, len(metadata)), metadata] + blobs)
+
+
+def decode_message(buffer):
+    '''
+        Read a message made by encode_message.
+        :return the metadata dict, and a dict of name to SegmentArray (views of the buffer, like decode)
+    '''
+    magic, version, metadata_size = MESSAGE_HEADER.unpack_from(buffer, 0)
+    if magic != MESSAGE_MAGIC:
+        raise ValueError("Not a trajectory message")
+    if version != MESSAGE_VERSION:
+        raise ValueError("Unsupported trajectory message version %d" % version)
+
+    start = MESSAGE_HEADER.size + metadata_size
+    metadata = json.loads(bytes(buffer[MESSAGE_HEADER.size:start]).decode('utf-8'))
+    view = memoryview(buffer)
+    trajectories = {entry['name']: decode(view[start + entry['offset']:start + entry['offset'] + entry['size']])
+                    for entry in metadata['trajectories']}
+    return metadata, trajectories
@@ -1,14 +1,78 @@
 from structs.trajectory import Trajectory
 from spline_generator import SplineGenerator
 from spline_generator import FitType
-from trajectory_planner import TrajectoryPlanner
+from trajector_planner import TrajectoryPlanner
 from spline_utils import SplineUtils
+from structs.segment_array import SegmentArray
+from profiler import NULL_PROFILER
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import copy
+import os
+import numpy as np
+
+# Paths of no more segments than this are sampled in one process by TrajectoryGenerator.generate
+PARALLEL_CHUNK_SIZE = 1 << 16
+
+
+def find_spline_indices(spline_lengths, displacement):
+    '''
+        TrajectoryGenerator.get_spline_indices for a path whose splines have the given arc lengths.
+    '''
+    spline_lengths = np.asarray(spline_lengths, dtype=float)
+    spline_starts = np.concatenate(([0.0], np.cumsum(spline_lengths[:-1])))
+    last = len(spline_lengths) - 1
+
+    # The first spline each displacement fits on. A displacement fits on spline i when it is at most
+    # spline_starts[i] + spline_lengths[i], but rounding can make that test come out differently either side of a
+    # spline's end (e.g. next to a zero length spline), so the end is only used to find a spline at or a little
+    # before the first one it fits on, which it then moves on from. Those past the end of the path end up on the
+    # last spline.
+    ends = np.maximum.accumulate(spline_starts + spline_lengths)
+    tolerance = 4 * np.finfo(float).eps * np.maximum(np.abs(displacement), abs(ends[-1]))
+    low = np.minimum(np.searchsorted(ends, displacement - tolerance), last)
+    fits = (displacement - spline_starts[low]) <= spline_lengths[low]
+    moving = np.flatnonzero(~fits & (low < last))
+    while len(moving) > 0:
+        low[moving] += 1
+        fits = (displacement[moving] - spline_starts[low[moving]]) <= spline_lengths[low[moving]]
+        moving = moving[~fits & (low[moving] < last)]
+    past_end = ~((displacement - spline_starts[last]) <= spline_lengths[last])
+    # Splines are walked in order, never backwards
+    spline_i = np.maximum.accumulate(low)
+
+    return spline_i, displacement - spline_starts[spline_i], past_end
+
+
+# The TrajectoryGenerator a sample_parallel worker process samples with, sent once when the worker starts
+worker_generator = None
+
+
+def init_sample_worker(generator):
+    global worker_generator
+    worker_generator = generator
+
+
+def sample_shared(name, length, start, stop):
+    '''
+        Sample displacements start to stop of the shared (4, length) block made by sample_parallel: row 0 holds the
+        displacements, and x, y and heading are written to rows 1 to 3. Runs in a worker process, with the generator
+        given to init_sample_worker.
+    '''
+    block = shared_memory.SharedMemory(name=name)
+    try:
+        data = np.ndarray((4, length), dtype=float, buffer=block.buf)
+        data[1:, start:stop] = worker_generator.sample(data[0, start:stop])
+        del data
+    finally:
+        block.close()
 
 
 class TrajectoryGenerator:
-    def __init__(self, path, config, fit_type=FitType.CUBIC):
-        self.path = path
+    def __init__(self, path, config, fit_type=FitType.CUBIC, profiler=NULL_PROFILER):
+        self.path = list(path)
         self.config = config
+        self.profiler = profiler
         self.splineGenerator = SplineGenerator(fit_type)
         self.trajectory = Trajectory()
         self.splineUtils = SplineUtils()
@@ -23,65 +87,380 @@ class TrajectoryGenerator:
         self.trajectory.spline_list = []
         self.trajectory.length_list = []
 
-        self.trajectory.total_length = 0
         for i in range(len(self.path) - 1):
-            s = self.splineGenerator.fit(self.path[i], self.path[i + 1])
-            dist = self.splineUtils.get_arc_length(s, self.config.sample_count)
+            s, dist = self.fit_spline(i)
             self.trajectory.spline_list.append(s)
             self.trajectory.length_list.append(dist)
+
+        self.prepare_planner()
+
+    def fit_spline(self, i):
+        '''
+            Fit the spline between waypoints i and i + 1 and integrate its arc length.
+            :return the spline and its arc length
+        '''
+        with self.profiler.stage('spline fitting', splines=1):
+            s = self.splineGenerator.fit(self.path[i], self.path[i + 1])
+        with self.profiler.stage('arc length integration', splines=1):
+            if self.config.arc_length_tolerance > 0:
+                dist = self.splineUtils.get_arc_length_adaptive(s, self.config.arc_length_tolerance)
+            else:
+                dist = self.splineUtils.get_arc_length(s, self.config.sample_count)
+        return s, dist
+
+    def prepare_planner(self):
+        self.trajectory.total_length = 0
+        for dist in self.trajectory.length_list:
             self.trajectory.total_length = self.trajectory.total_length + dist
 
         self.config.dest_pos = self.trajectory.total_length
         self.config.src_theta = self.path[0].angle
         self.config.dest_theta = self.path[0].angle
 
-        self.planner.prepare()
+        with self.profiler.stage('planner prepare'):
+            self.planner.prepare()
 
         self.trajectory.length = self.planner.info.length
         self.trajectory.path_length = len(self.path)
         self.trajectory.config = self.config
 
-    def generate(self):
-        trajectory_length = self.trajectory.length
-        path_length = self.trajectory.path_length
-
-        splines = self.trajectory.spline_list
-
-        spline_lengths = self.trajectory.length_list
-
-        segments = self.planner.create()
-
-        spline_i = 0
-        spline_pos_initial = 0.0
-
-        for i in range(trajectory_length):
-            displacement = segments[i].displacement
-
-            while True:
-                pos_relative = displacement - spline_pos_initial
-                # all but the last point on a spline
-                if(pos_relative <= spline_lengths[spline_i]):
-                    si = splines[spline_i]
-                    percentage = self.splineUtils.get_progress_for_distance(si, pos_relative, self.config.sample_count)
-                    coords = self.splineUtils.get_coords(si, percentage)
-                    segments[i].heading = self.splineUtils.get_angle(si, percentage)
-                    segments[i].x = coords.x
-                    segments[i].y = coords.y
-                    break
-                # finish a spline
-                elif spline_i < path_length - 2:
-                    spline_pos_initial += spline_lengths[spline_i]
-                    spline_i += 1
-                # Very last point
-                else:
-                    si = splines[path_length - 2]
-                    segments[i].heading = self.splineUtils.get_angle(si, 1.0)
-                    coords = self.splineUtils.get_coords(si, 1.0)
-                    segments[i].x = coords.x
-                    segments[i].y = coords.y
-                    break
-
-        splines = []
-        spline_lengths = []
+    def update_waypoints(self, changes):
+        '''
+            Move some of the waypoints without preparing the whole path again. Only the splines on either side of a
+            moved waypoint are refitted; every other spline keeps its fit and arc length table. The planner is
+            prepared again, and the next generate() samples the updated path.
+            :param changes dict of waypoint index to its new Waypoint
+        '''
+        refit = set()
+        for index, waypoint in changes.items():
+            self.path[index] = waypoint
+            refit.update(i for i in (index - 1, index) if 0 <= i < len(self.path) - 1)
+
+        for i in sorted(refit):
+            self.trajectory.spline_list[i], self.trajectory.length_list[i] = self.fit_spline(i)
+
+        self.prepare_planner()
+
+    def generate(self, workers=1, chunk_size=PARALLEL_CHUNK_SIZE):
+        '''
+            :param workers Number of processes to sample the path with (None for the number of CPUs). Paths of no more
+                than chunk_size segments are always sampled in this process
+        '''
+        with self.profiler.stage('second order filter') as stage:
+            segments = self.planner.create()
+            stage.count(segments=len(segments))
+
+        if self.limits_curvature():
+            with self.profiler.stage('curvature limiting', segments=len(segments)):
+                segments = self.limit_velocity(segments)
+            self.trajectory.length = len(segments)
+
+        with self.profiler.stage('spline sampling', segments=len(segments)):
+            if workers != 1 and len(segments) > chunk_size:
+                segments.x, segments.y, segments.heading = self.sample_parallel(segments.displacement, workers)
+            else:
+                segments.x, segments.y, segments.heading = self.sample(segments.displacement)
 
         return segments
+
+    def generate_chunks(self, chunk_size):
+        '''
+            Like generate, but yields the segments chunk_size at a time as soon as they are computed, so the whole
+            trajectory never has to be held in memory. The curvature limit needs the whole profile, so with it on the
+            profile is planned up front, here rather than on the first chunk, and only the sampling is done chunk by
+            chunk. trajectory.length is the number of segments that will be yielded either way.
+        '''
+        if self.limits_curvature():
+            planned = self.limit_velocity(self.planner.create())
+            self.trajectory.length = len(planned)
+            chunks = (SegmentArray(data=planned.data[:, start:start + chunk_size])
+                      for start in range(0, len(planned), chunk_size))
+        else:
+            chunks = self.planner.create_chunks(chunk_size)
+        return self.sample_chunks(chunks)
+
+    def sample_chunks(self, chunks):
+        for segments in chunks:
+            segments.x, segments.y, segments.heading = self.sample(segments.displacement)
+            yield segments
+
+    def limits_curvature(self):
+        return self.config.max_lateral_a > 0 or self.config.wheelbase_width > 0
+
+    def limit_velocity(self, segments):
+        '''
+            Slow the planned profile down on curves. Each segment gets a velocity cap from the curvature of the path
+            at its displacement: sqrt(max_lateral_a / curvature) for the sideways acceleration, and the speed at
+            which the outer wheel of a wheelbase_width wide tank drive reaches max_v. A forward and a backward pass
+            then lower the caps so that no more than max_a is needed to brake into or speed out of a curve. Both
+            passes are running minimums: v^2 <= v_j^2 + 2 * max_a * (s - s_j) over all earlier (or later) j.
+
+            The capped velocities are spaced in distance, so the profile is timed again and resampled every dt.
+            Braking for curves is only limited by max_a, not max_j.
+            :return the segments unchanged if no cap is below the planned velocity, otherwise new segments
+        '''
+        displacement = segments.displacement
+        velocity = segments.velocity
+        curvature = np.abs(self.get_curvature(displacement))
+
+        limit = velocity.copy()
+        if self.config.max_lateral_a > 0:
+            with np.errstate(divide='ignore'):
+                np.minimum(limit, np.sqrt(self.config.max_lateral_a / curvature), out=limit)
+        if self.config.wheelbase_width > 0:
+            np.minimum(limit, self.config.max_v / (1 + curvature * (self.config.wheelbase_width / 2)), out=limit)
+        if np.array_equal(limit, velocity):
+            return segments
+
+        # Include the start of the profile, before the first segment
+        s = np.concatenate(([0.0], displacement))
+        v2 = np.concatenate(([self.planner.info.u], limit)) ** 2
+        braking = 2 * self.config.max_a * s
+        v2 = np.minimum.accumulate(v2 - braking) + braking
+        v2 = np.minimum(v2, np.minimum.accumulate((v2 + braking)[::-1])[::-1] - braking)
+        v = np.sqrt(np.maximum(v2, 0.0))
+
+        # Time to each distance, keeping the points the profile moves between
+        ds = np.diff(s)
+        speed = v[1:] + v[:-1]
+        moving = (ds > 0) & (speed > 0)
+        time = np.concatenate(([0.0], np.cumsum(2 * ds[moving] / speed[moving])))
+        v = np.concatenate((v[:1], v[1:][moving]))
+
+        dt = self.planner.info.dt
+        times = np.arange(1, int(np.ceil(time[-1] / dt)) + 1) * dt
+        segments = self.planner.integrate_velocity(np.interp(times, time, v))
+        self.planner.interpolate_heading(segments, segments.displacement[-1])
+        return segments
+
+    def get_spline_indices(self, displacement):
+        '''
+            Work out which spline every displacement falls on, the same way walking the splines in order does.
+            :return the spline index and the distance along that spline for each displacement. Displacements past
+                the end of the path are given the last spline and flagged in the returned past_end mask
+        '''
+        return find_spline_indices(self.trajectory.length_list, displacement)
+
+    def get_progress(self, displacement):
+        '''
+            :return the spline index and the percentage along that spline of each of the given displacements
+        '''
+        percentage = np.empty(len(displacement))
+
+        spline_i, pos_relative, past_end = self.get_spline_indices(displacement)
+        for i, si in enumerate(self.trajectory.spline_list):
+            on_spline = spline_i == i
+            if not on_spline.any():
+                continue
+            if self.config.arc_length_tolerance > 0:
+                progress = self.splineUtils.get_progress_for_distance_adaptive_array(
+                    si, pos_relative[on_spline], self.config.arc_length_tolerance)
+            else:
+                progress = self.splineUtils.get_progress_for_distance_array(si, pos_relative[on_spline],
+                                                                            self.config.sample_count)
+            # Very last point
+            progress[past_end[on_spline]] = 1.0
+            percentage[on_spline] = progress
+
+        return spline_i, percentage
+
+    def sample(self, displacement):
+        '''
+            Find the x, y and heading of the path at each of the given displacements, one numpy pass per spline.
+        '''
+        x = np.empty(len(displacement))
+        y = np.empty(len(displacement))
+        heading = np.empty(len(displacement))
+
+        spline_i, percentage = self.get_progress(displacement)
+        for i, si in enumerate(self.trajectory.spline_list):
+            on_spline = spline_i == i
+            if not on_spline.any():
+                continue
+            x[on_spline], y[on_spline] = self.splineUtils.get_coords_array(si, percentage[on_spline])
+            heading[on_spline] = self.splineUtils.get_angle_array(si, percentage[on_spline])
+
+        return x, y, heading
+
+    def sample_parallel(self, displacement, workers=None):
+        '''
+            sample, split into one chunk of displacements per worker process, which samples it straight into shared
+            memory. The generator is sent to each worker once, when it starts. Every displacement finds its spline and
+            position on it independently of the others, so the result is the same as sample's.
+            :param workers Number of processes (None for the number of CPUs)
+        '''
+        length = len(displacement)
+        workers = workers or os.cpu_count() or 1
+        bounds = np.linspace(0, length, min(workers, max(length, 1)) + 1).astype(int)
+        block = shared_memory.SharedMemory(create=True, size=max(4 * length * np.dtype(float).itemsize, 1))
+        try:
+            data = np.ndarray((4, length), dtype=float, buffer=block.buf)
+            data[0] = displacement
+
+            with ProcessPoolExecutor(max_workers=len(bounds) - 1, initializer=init_sample_worker,
+                                     initargs=(self,)) as executor:
+                futures = [executor.submit(sample_shared, block.name, length, start, stop)
+                           for start, stop in zip(bounds[:-1], bounds[1:])]
+                for future in futures:
+                    future.result()
+
+            x, y, heading = data[1:].copy()
+            del data
+        finally:
+            block.close()
+            block.unlink()
+
+        return x, y, heading
+
+    def get_curvature(self, displacement):
+        '''
+            The signed curvature of the path at each of the given displacements.
+        '''
+        curvature = np.empty(len(displacement))
+
+        spline_i, percentage = self.get_progress(displacement)
+        for i, si in enumerate(self.trajectory.spline_list):
+            on_spline = spline_i == i
+            if on_spline.any():
+                curvature[on_spline] = self.splineUtils.get_curvature_array(si, percentage[on_spline])
+
+        return curvature
+
+
+class BatchTrajectoryGenerator:
+    '''
+        Generates many paths together, e.g. every path of an autonomous routine. The splines of all the paths are
+        fitted, integrated and sampled in single numpy passes, rather than one TrajectoryGenerator per path doing
+        them spline by spline. Only the second order filter still runs path by path.
+
+        config is one TrajectoryConfig shared by all the paths, or a list with one per path. Each path gets its own
+        copy, since planning fills in the destination. Paths whose config integrates arc lengths adaptively
+        (arc_length_tolerance above zero) or limits the velocity on curves are handed to a TrajectoryGenerator.
+
+        The results come out in path order and match what a TrajectoryGenerator per path gives.
+    '''
+    def __init__(self, paths, config, fit_type=FitType.CUBIC, profiler=NULL_PROFILER):
+        self.paths = [list(path) for path in paths]
+        configs = config if isinstance(config, (list, tuple)) else [config] * len(self.paths)
+        self.configs = [copy.copy(c) for c in configs]
+        self.profiler = profiler
+        self.splineGenerator = SplineGenerator(fit_type)
+        self.splineUtils = SplineUtils()
+        self.prepare()
+
+    def prepare(self):
+        self.generators = {}
+        batched = []
+        for i, (path, config) in enumerate(zip(self.paths, self.configs)):
+            if len(path) < 2:
+                print("Error: TrajectoryGenerator preparation failed: path length is less than 2")
+            elif config.arc_length_tolerance > 0 or config.max_lateral_a > 0 or config.wheelbase_width > 0:
+                self.generators[i] = TrajectoryGenerator(path, config, self.splineGenerator.fit_type, self.profiler)
+            else:
+                batched.append(i)
+
+        # Spline j of the batch joins waypoints j and j + 1 of the batched paths laid end to end; the joins
+        # between one path and the next are dropped
+        waypoints = np.array([[w.x, w.y, w.angle] for i in batched for w in self.paths[i]], dtype=float)
+        path_sizes = np.array([len(self.paths[i]) for i in batched], dtype=np.intp)
+        starts = np.concatenate(([0], np.cumsum(path_sizes)[:-1])) if len(batched) else np.zeros(0, dtype=np.intp)
+        first = np.concatenate([np.arange(start, start + size - 1) for start, size in zip(starts, path_sizes)]
+                               ) if len(batched) else np.zeros(0, dtype=np.intp)
+
+        with self.profiler.stage('spline fitting', splines=len(first)):
+            if len(first):
+                self.splines = self.splineGenerator.fit_arrays(*waypoints[first].T, *waypoints[first + 1].T)
+
+        # Which batched splines belong to each path
+        self.spline_ranges = {}
+        first_spline = 0
+        for i, size in zip(batched, path_sizes.tolist()):
+            self.spline_ranges[i] = (first_spline, first_spline + size - 1)
+            first_spline += size - 1
+
+        # Splines are integrated together with the others using the same sample count
+        self.tables = {}
+        with self.profiler.stage('arc length integration', splines=len(first)):
+            for sample_count in set(self.configs[i].sample_count for i in batched):
+                group = np.concatenate([np.arange(*self.spline_ranges[i]) for i in batched
+                                        if self.configs[i].sample_count == sample_count])
+                splines = self.splines.take(group)
+                self.tables[sample_count] = group, self.splineUtils.get_arc_length_many(splines, sample_count)
+                self.splines.arc_length[group] = splines.arc_length
+
+        self.planners = {}
+        with self.profiler.stage('planner prepare'):
+            for i in batched:
+                config = self.configs[i]
+                config.dest_pos = float(np.sum(self.get_length_list(i)))
+                config.src_theta = self.paths[i][0].angle
+                config.dest_theta = self.paths[i][0].angle
+                self.planners[i] = TrajectoryPlanner(config)
+                self.planners[i].prepare()
+
+    def get_length_list(self, i):
+        '''
+            :return the arc lengths of the splines of (batched) path i
+        '''
+        return self.splines.arc_length[slice(*self.spline_ranges[i])]
+
+    def generate(self):
+        '''
+            :return a SegmentArray for every path, in path order. The batched ones are views of one shared array.
+        '''
+        planned = {}
+        with self.profiler.stage('second order filter') as stage:
+            for i, planner in self.planners.items():
+                planned[i] = planner.create()
+                stage.count(segments=len(planned[i]))
+
+        if planned:
+            segments = SegmentArray.concatenate(list(planned.values()))
+            with self.profiler.stage('spline sampling', segments=len(segments)):
+                segments.x, segments.y, segments.heading = self.sample(planned)
+
+        trajectories = []
+        start = 0
+        for i in range(len(self.paths)):
+            if i in self.generators:
+                trajectories.append(self.generators[i].generate())
+            elif i in planned:
+                trajectories.append(segments[start:start + len(planned[i])])
+                start += len(planned[i])
+            else:
+                trajectories.append(SegmentArray(0, self.configs[i].dt))
+        return trajectories
+
+    def sample(self, planned):
+        '''
+            Find the x, y and heading of every planned segment of every batched path in one pass.
+            :param planned dict of path index to its planned segments, in the order they are laid out
+        '''
+        spline_i = []
+        pos_relative = []
+        past_end = []
+        for i, segments in planned.items():
+            path_spline_i, path_pos_relative, path_past_end = find_spline_indices(self.get_length_list(i),
+                                                                                  segments.displacement)
+            spline_i.append(path_spline_i + self.spline_ranges[i][0])
+            pos_relative.append(path_pos_relative)
+            past_end.append(path_past_end)
+        spline_i = np.concatenate(spline_i)
+        pos_relative = np.concatenate(pos_relative)
+        past_end = np.concatenate(past_end)
+
+        percentage = np.empty(len(spline_i))
+        for sample_count, (group, tables) in self.tables.items():
+            # Row of each of the group's splines in its tables
+            rows = np.full(len(self.splines), -1, dtype=np.intp)
+            rows[group] = np.arange(len(group))
+            in_group = rows[spline_i] >= 0
+            percentage[in_group] = self.splineUtils.get_progress_for_distance_many(
+                self.splines.take(group), tables, rows[spline_i[in_group]], pos_relative[in_group], sample_count)
+        # Very last point
+        percentage[past_end] = 1.0
+
+        splines = self.splines.take(spline_i)
+        x, y = self.splineUtils.get_coords_array(splines, percentage)
+        heading = self.splineUtils.get_angle_array(splines, percentage)
+        return x, y, heading